@@ -1,99 +1,75 @@
-import google.generativeai as genai
+import argparse
+import json
+import logging
 import os
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from dotenv import load_dotenv
-from google.ai.generativelanguage import GoogleSearchRetrieval
+
+import config
+from batch_runner import parse_batch_items, parse_jsonl
+from resource_catalog import create_resource_catalog
 
 # Cargar variables de entorno
 load_dotenv(override=True) # Añadir override=True para sobrescribir variables existentes
 
-# Configurar credenciales de Google Application Credentials desde un archivo JSON
-credentials_path_from_env_file = os.getenv("GOOGLE_APPLICATION_CREDENTIALS_PATH")
-effective_credentials_path = None
-script_dir = os.path.dirname(os.path.abspath(__file__)) # Use abspath for __file__ robustness
-
-if credentials_path_from_env_file:
-    # Check if the path from .env is absolute
-    if os.path.isabs(credentials_path_from_env_file):
-        potential_path = credentials_path_from_env_file
-    else:
-        # If relative, resolve it with respect to the script's directory
-        potential_path = os.path.join(script_dir, credentials_path_from_env_file)
-    
-    # Normalize the path for consistent checking and printing
-    potential_path = os.path.normpath(potential_path)
-
-    if os.path.exists(potential_path):
-        os.environ["GOOGLE_APPLICATION_CREDENTIALS"] = potential_path
-        effective_credentials_path = potential_path
-        print(f"Usando credenciales de servicio desde el archivo: {effective_credentials_path}")
-    else:
-        # Provide both the original user-provided path and the resolved path in the error
-        raise FileNotFoundError(
-            f"El archivo de credenciales JSON especificado en GOOGLE_APPLICATION_CREDENTIALS_PATH ('{credentials_path_from_env_file}') no se encontró. "
-            f"Se intentó resolver como ruta absoluta: '{potential_path}'."
-        )
-elif os.getenv("GOOGLE_APPLICATION_CREDENTIALS"):
-    effective_credentials_path = os.getenv("GOOGLE_APPLICATION_CREDENTIALS")
-    if not os.path.exists(effective_credentials_path):
-        print(f"Advertencia: El archivo de credenciales JSON especificado por la variable de entorno GOOGLE_APPLICATION_CREDENTIALS ('{effective_credentials_path}') no se encontró, pero se intentará usar si las librerías de Google lo permiten.")
-    else:
-        print(f"Usando credenciales de servicio desde la variable de entorno GOOGLE_APPLICATION_CREDENTIALS: {effective_credentials_path}")
-else:
-    raise ValueError(
-        "No se encontraron credenciales de Google. "
-        "Define GOOGLE_APPLICATION_CREDENTIALS_PATH en tu archivo .env apuntando a tu archivo de credenciales JSON, "
-        "o configura la variable de entorno GOOGLE_APPLICATION_CREDENTIALS directamente en tu sistema."
-    )
-
-# Configurar la API de Gemini.
-# Al no pasar api_key, la librería usará Application Default Credentials (ADC),
-# que recogerá las credenciales del archivo JSON especificado por GOOGLE_APPLICATION_CREDENTIALS.
-try:
-    genai.configure() # No se pasa api_key, usará ADC
-except Exception as e:
-    print(f"Error al configurar genai con Application Default Credentials: {e}")
-    raise RuntimeError(
-        "No se pudo configurar la API de Gemini con las credenciales proporcionadas. "
-        "Verifica que el archivo de credenciales es válido y que la cuenta de servicio tiene los permisos necesarios (ej. 'Vertex AI User')."
-    ) from e
+# Los mensajes de config.py (credenciales, prompt) se muestran en consola como antes
+logging.basicConfig(level=logging.INFO, format="%(message)s")
 
 # --- Configuración del Asistente Virtual NEAE ---
+# Credenciales, SDK y prompt se cargan al inicializar el modelo (config.py), no al importar este script,
+# así que --help y los errores de argumentos son inmediatos
 
 # Selecciona el modelo.
-MODEL_NAME = "gemini-1.5-pro-latest"
-
-def cargar_prompt_desde_archivo(ruta_archivo):
-    """Carga el contenido de un archivo de texto."""
-    try:
-        with open(ruta_archivo, 'r', encoding='utf-8') as f:
-            return f.read()
-    except FileNotFoundError:
-        print(f"Error: No se encontró el archivo de prompt en {ruta_archivo}")
-        return None
-    except Exception as e:
-        print(f"Error al leer el archivo de prompt: {e}")
-        return None
-
-# Cargar el prompt de sistema desde prompt.txt
-# Asegúrate de que prompt.txt esté en el mismo directorio que asistente-virtual.py o proporciona la ruta completa.
-RUTA_PROMPT_TXT = os.path.join(os.path.dirname(__file__), "prompt.txt")
-SYSTEM_PROMPT_ASISTENTE_NEAE = cargar_prompt_desde_archivo(RUTA_PROMPT_TXT)
+MODEL_NAME = config.model_name()
+
+catalogo_recursos = None
+recursos_enviados = set()  # Recursos del catálogo ya incluidos en la conversación interactiva
+
+def configurar_gemini():
+    """Resuelve las credenciales y configura la API de Gemini; lanza una excepción si no es posible."""
+    # Sin credenciales el asistente de consola no puede funcionar: se exige configurarlas
+    config.resolve_credentials(strict=True)
+    # Al no pasar api_key (salvo GOOGLE_API_KEY), la librería usará Application Default Credentials (ADC)
+    if not config.configure_genai():
+        raise RuntimeError(
+            "No se pudo configurar la API de Gemini con las credenciales proporcionadas. "
+            "Verifica que el archivo de credenciales es válido y que la cuenta de servicio tiene los permisos necesarios (ej. 'Vertex AI User')."
+        )
 
-if not SYSTEM_PROMPT_ASISTENTE_NEAE:
-    raise ValueError("No se pudo cargar el prompt del sistema desde prompt.txt. Verifica el archivo y la ruta.")
+def cargar_prompt_sistema():
+    """Carga prompt.txt (del mismo directorio que este script)."""
+    prompt = config.read_prompt_file()
+    if not prompt:
+        raise ValueError("No se pudo cargar el prompt del sistema desde prompt.txt. Verifica el archivo y la ruta.")
+    return prompt
+
+def usar_busqueda():
+    """Búsqueda de Google en cada respuesta solo si no hay catálogo de recursos verificados, salvo que
+    GEMINI_SEARCH_TOOL la active (1) o desactive (0) explícitamente."""
+    valor = os.getenv("GEMINI_SEARCH_TOOL", "").strip().lower()
+    if not valor:
+        return catalogo_recursos is None  # Con catálogo el modelo cita sus enlaces sin buscar
+    return valor in ("1", "true", "yes")
 
 # --- Funciones del Asistente ---
 
 def inicializar_modelo():
     """Inicializa el modelo generativo de Gemini."""
     try:
-        # Configurar la herramienta de búsqueda de Google
-        google_search_tool = GoogleSearchRetrieval()
+        cargar_prompt_sistema()
+        configurar_gemini()
+        tools = None
+        if usar_busqueda():
+            # Importación diferida: el SDK tarda casi un segundo en cargarse
+            from google.ai.generativelanguage import GoogleSearchRetrieval
+
+            # Configurar la herramienta de búsqueda de Google
+            tools = [GoogleSearchRetrieval()]
 
-        model = genai.GenerativeModel(
+        model = config.get_genai().GenerativeModel(
             MODEL_NAME,
             # system_instruction=SYSTEM_PROMPT_ASISTENTE_NEAE, # Usamos el prompt cargado de prompt.txt
-            tools=[google_search_tool] # Habilitar la búsqueda en Google
+            tools=tools # Búsqueda en Google solo sin catálogo de recursos o con GEMINI_SEARCH_TOOL=1
         )
         return model
     except Exception as e:
@@ -104,33 +80,116 @@ def iniciar_chat(model):
     """Inicia una sesión de chat con el modelo."""
     if model:
         initial_history = [
-            {"role": "user", "parts": [SYSTEM_PROMPT_ASISTENTE_NEAE]},
+            {"role": "user", "parts": [cargar_prompt_sistema()]},
             {"role": "model", "parts": ["Entendido. Estoy listo para asistir como un especialista en NEAE para Andalucía."]}
         ]
         chat = model.start_chat(history=initial_history) # Historial vacío para empezar
         return chat
     return None
 
+def con_recursos_verificados(pregunta, ya_enviados=frozenset()):
+    """Antepone a la pregunta los recursos del catálogo local que encajan con ella y no están en `ya_enviados`.
+
+    Devuelve (mensaje, ids añadidos). El bloque queda en el historial del chat, así que en una conversación
+    solo se envían los recursos nuevos: si los de la pregunta ya se citaron, el mensaje es la pregunta tal cual.
+    """
+    if catalogo_recursos is None:
+        return pregunta, []
+    nuevos = [resource_id for resource_id in catalogo_recursos.match(pregunta) if resource_id not in ya_enviados]
+    recursos = catalogo_recursos.render(nuevos)
+    return (f"{recursos}\n\n{pregunta}", nuevos) if recursos else (pregunta, [])
+
 def preguntar_al_asistente(chat_session, pregunta_usuario):
     """Envía una pregunta al chat y obtiene una respuesta."""
     if not chat_session:
         return "Error: La sesión de chat no está iniciada."
     try:
         print("🤖 Asistente NEAE está pensando...")
-        response = chat_session.send_message(pregunta_usuario)
+        mensaje, nuevos = con_recursos_verificados(pregunta_usuario, recursos_enviados)
+        response = chat_session.send_message(mensaje)
+        recursos_enviados.update(nuevos)
         # El descargo de responsabilidad y la leyenda de iconos deben ser manejados por el LLM
         # según las instrucciones en prompt.txt
         return response.text
     except Exception as e:
         return f"Error al comunicarse con el modelo: {e}"
 
+# --- Modo por lotes ---
+
+def cargar_resultados_previos(ruta_salida):
+    """Resultados correctos de una ejecución anterior, indexados por id"""
+    resultados = {}
+    if not os.path.exists(ruta_salida):
+        return resultados
+    with open(ruta_salida, 'r', encoding='utf-8') as f:
+        for linea in f:
+            try:
+                resultado = json.loads(linea)
+            except json.JSONDecodeError:
+                continue  # Línea truncada por una interrupción
+            if resultado.get("status") == "ok":
+                resultados[str(resultado["id"])] = resultado
+    return resultados
+
+def responder_en_sesion_nueva(model, pregunta):
+    """Responde una pregunta del lote en su propia sesión de chat; lanza la excepción si falla."""
+    mensaje, _ = con_recursos_verificados(pregunta)
+    response = iniciar_chat(model).send_message(mensaje)
+    return response.text
+
+def procesar_lote(model, ruta_lote, ruta_salida, concurrencia):
+    """Responde todas las preguntas de un JSONL y escribe un JSONL de resultados en orden de llegada.
+
+    Las preguntas que ya tienen un resultado correcto en `ruta_salida` se
+    omiten, así que repetir el comando reanuda un lote interrumpido.
+    """
+    with open(ruta_lote, 'r', encoding='utf-8') as f:
+        preguntas = parse_batch_items(parse_jsonl(f.read()))
+    previos = cargar_resultados_previos(ruta_salida)
+    pendientes = [item for item in preguntas if item.id not in previos]
+    print(f"📦 {len(preguntas)} preguntas en el lote: {len(previos)} ya respondidas, {len(pendientes)} pendientes.")
+
+    # Se reescribe la salida solo con los resultados correctos: los errores anteriores se reintentan
+    with open(ruta_salida, 'w', encoding='utf-8') as salida:
+        for resultado in previos.values():
+            salida.write(json.dumps(resultado, ensure_ascii=False) + "\n")
+        fallidas = 0
+        with ThreadPoolExecutor(max_workers=max(1, concurrencia)) as executor:
+            futuros = {executor.submit(responder_en_sesion_nueva, model, item.pregunta): item for item in pendientes}
+            for completadas, futuro in enumerate(as_completed(futuros), start=1):
+                item = futuros[futuro]
+                try:
+                    resultado = {"id": item.id, "status": "ok", "pregunta": item.pregunta, "respuesta": futuro.result()}
+                except Exception as e:
+                    fallidas += 1
+                    resultado = {"id": item.id, "status": "error", "pregunta": item.pregunta,
+                                 "error": f"Error al comunicarse con el modelo: {e}"}
+                salida.write(json.dumps(resultado, ensure_ascii=False) + "\n")
+                salida.flush()
+                print(f"{'✅' if resultado['status'] == 'ok' else '❌'} [{completadas}/{len(pendientes)}] {item.id}")
+    print(f"💾 Resultados guardados en {ruta_salida} ({fallidas} con error; vuelve a ejecutar el comando para reintentarlas).")
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Asistente Virtual NEAE en consola")
+    parser.add_argument("--batch", metavar="FICHERO.jsonl",
+                        help="Responder las preguntas de un JSONL (texto u objeto con 'id' y 'pregunta' por línea)")
+    parser.add_argument("--output", metavar="FICHERO.jsonl", help="Fichero de resultados del lote (por defecto <lote>.resultados.jsonl)")
+    parser.add_argument("--concurrency", type=int, default=4, help="Preguntas del lote procesadas a la vez")
+    return parser.parse_args()
+
 # --- Interfaz de Usuario Simple (Consola) ---
 if __name__ == "__main__":
+    args = parse_args()
     print("Iniciando Asistente Virtual NEAE...")
+    # El catálogo se carga antes que el modelo: si existe, sustituye a la búsqueda de Google
+    catalogo_recursos = create_resource_catalog()
     modelo_gemini = inicializar_modelo()
 
     if not modelo_gemini:
         print("No se pudo iniciar el asistente. Revisa la configuración de credenciales y el archivo prompt.txt.")
+    elif args.batch:
+        ruta_salida = args.output or os.path.splitext(args.batch)[0] + ".resultados.jsonl"
+        procesar_lote(modelo_gemini, args.batch, ruta_salida, args.concurrency)
     else:
         chat_sesion = iniciar_chat(modelo_gemini)
         if not chat_sesion:
@@ -0,0 +1,163 @@
+import asyncio
+import json
+import logging
+import os
+import time
+import uuid
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+
+class BatchItem:
+    __slots__ = ("id", "pregunta")
+
+    def __init__(self, item_id: str, pregunta: str):
+        self.id = item_id
+        self.pregunta = pregunta
+
+
+def parse_batch_items(raw_items, max_items: int | None = None) -> list:
+    """Validate a list of questions (strings or {"id", "pregunta"} objects) into BatchItems.
+
+    Items without an id get their 1-based position. Raises ValueError with a
+    message suitable for a 400 response.
+    """
+    if not isinstance(raw_items, list) or not raw_items:
+        raise ValueError("El lote no contiene una lista de preguntas.")
+    if max_items is not None and len(raw_items) > max_items:
+        raise ValueError(f"El lote supera el máximo de {max_items} preguntas.")
+    items, seen = [], set()
+    for position, raw in enumerate(raw_items, start=1):
+        if isinstance(raw, str):
+            raw = {"pregunta": raw}
+        if not isinstance(raw, dict):
+            raise ValueError(f"Elemento {position}: se esperaba un texto o un objeto con 'pregunta'.")
+        pregunta = raw.get("pregunta")
+        if not isinstance(pregunta, str) or not pregunta.strip():
+            raise ValueError(f"Elemento {position}: la pregunta no puede estar vacía.")
+        item_id = str(raw.get("id") or position)
+        if item_id in seen:
+            raise ValueError(f"Elemento {position}: el id '{item_id}' está repetido.")
+        seen.add(item_id)
+        items.append(BatchItem(item_id, pregunta))
+    return items
+
+
+def parse_jsonl(text: str) -> list:
+    """Decode a JSONL body (one question string or object per line), skipping blank lines"""
+    raw_items = []
+    for number, line in enumerate(text.splitlines(), start=1):
+        if not line.strip():
+            continue
+        try:
+            raw_items.append(json.loads(line))
+        except json.JSONDecodeError as e:
+            raise ValueError(f"Línea {number}: JSON no válido ({e.msg}).")
+    return raw_items
+
+
+class BatchProgress:
+    __slots__ = ("batch_id", "auth_key", "total", "results", "running", "updated_at")
+
+    def __init__(self, batch_id: str, auth_key: str, total: int):
+        self.batch_id = batch_id
+        self.auth_key = auth_key
+        self.total = total
+        self.results = {}  # id -> línea NDJSON ya emitida de cada pregunta completada
+        self.running = False
+        self.updated_at = time.time()
+
+
+class BatchProgressStore:
+    """In-memory record of completed batch items, so an interrupted batch can be resumed.
+
+    Only successful items are kept: resuming a batch replays their results
+    without calling the model or charging quota again, and re-runs the rest.
+    Batches expire `ttl` seconds after their last update and at most
+    `max_batches` are kept (LRU). Progress is per process, so a resumed batch
+    must reach the same worker.
+    """
+
+    def __init__(self, max_batches: int = 200, ttl: float = 86400):
+        self.max_batches = max_batches
+        self.ttl = ttl
+        self._batches = OrderedDict()
+        self._started = 0
+        self._resumed = 0
+
+    def open(self, batch_id: str | None, auth_key: str, total: int) -> BatchProgress:
+        """Start a new batch or resume an existing one owned by `auth_key`.
+
+        Raises KeyError for an unknown or foreign batch_id and RuntimeError when
+        that batch is still running.
+        """
+        self._expire()
+        if batch_id is None:
+            progress = BatchProgress(str(uuid.uuid4()), auth_key, total)
+            self._batches[progress.batch_id] = progress
+            self._started += 1
+        else:
+            progress = self._batches.get(batch_id)
+            if progress is None or progress.auth_key != auth_key:
+                raise KeyError(batch_id)
+            if progress.running:
+                raise RuntimeError(batch_id)
+            progress.total = total
+            self._batches.move_to_end(batch_id)
+            self._resumed += 1
+        progress.running = True
+        progress.updated_at = time.time()
+        while len(self._batches) > self.max_batches:
+            self._batches.popitem(last=False)
+        return progress
+
+    def record(self, progress: BatchProgress, item_id: str, line: dict):
+        progress.results[item_id] = line
+        progress.updated_at = time.time()
+
+    def close(self, progress: BatchProgress):
+        progress.running = False
+        progress.updated_at = time.time()
+
+    def _expire(self):
+        cutoff = time.time() - self.ttl
+        for batch_id in [batch_id for batch_id, progress in self._batches.items()
+                         if not progress.running and progress.updated_at < cutoff]:
+            del self._batches[batch_id]
+
+    def stats(self):
+        return {
+            "batches": len(self._batches),
+            "running": sum(1 for progress in self._batches.values() if progress.running),
+            "started_total": self._started,
+            "resumed_total": self._resumed,
+        }
+
+
+async def run_batch(items, answer, concurrency: int):
+    """Run `answer(item)` for every item with at most `concurrency` in flight.
+
+    Yields (item, result) in completion order. If the consumer stops early
+    (e.g. the client disconnects) the remaining tasks are cancelled.
+    """
+    semaphore = asyncio.Semaphore(max(1, concurrency))
+
+    async def guarded(item):
+        async with semaphore:
+            return item, await answer(item)
+
+    tasks = [asyncio.ensure_future(guarded(item)) for item in items]
+    try:
+        for next_done in asyncio.as_completed(tasks):
+            yield await next_done
+    finally:
+        for task in tasks:
+            task.cancel()
+
+
+def create_batch_progress_store() -> BatchProgressStore:
+    return BatchProgressStore(
+        max_batches=int(os.getenv("BATCH_PROGRESS_MAX", "200")),
+        ttl=float(os.getenv("BATCH_PROGRESS_TTL", "86400")),
+    )
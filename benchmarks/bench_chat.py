@@ -0,0 +1,243 @@
+"""Offline load test of the chat API against the local fake model backend.
+
+Drives /login -> /chat/start -> N x /chat/send (or /chat/stream) in-process
+through httpx.ASGITransport, so no server, network or Gemini quota is needed.
+
+    python benchmarks/bench_chat.py --sessions 50 --turns 5 --concurrency 10
+    python benchmarks/bench_chat.py --save fake-send-50x5
+    python benchmarks/bench_chat.py --compare benchmarks/baselines/fake-send-50x5.json
+"""
+import argparse
+import asyncio
+import json
+import os
+import platform
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+ROOT = Path(__file__).resolve().parent.parent
+BASELINES_DIR = Path(__file__).resolve().parent / "baselines"
+
+# Métricas donde un valor mayor es peor / mejor al comparar con una línea base
+LOWER_IS_BETTER = ("p50", "p95", "p99")
+HIGHER_IS_BETTER = ("requests_per_second",)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Benchmark offline de la API de chat con el modelo simulado")
+    parser.add_argument("--sessions", type=int, default=50, help="Sesiones de chat (una clave por sesión)")
+    parser.add_argument("--turns", type=int, default=5, help="Mensajes enviados por sesión")
+    parser.add_argument("--concurrency", type=int, default=10, help="Sesiones simultáneas")
+    parser.add_argument("--stream", action="store_true", help="Usar /chat/stream en lugar de /chat/send")
+    parser.add_argument("--latency", type=float, default=0.05, help="Segundos hasta el primer token del modelo simulado")
+    parser.add_argument("--tokens-per-second", type=float, default=2000, help="Velocidad de generación simulada")
+    parser.add_argument("--response-tokens", type=int, default=150, help="Tokens aproximados por respuesta")
+    parser.add_argument("--chunk-tokens", type=int, default=16, help="Tokens por fragmento en streaming")
+    parser.add_argument("--shared-questions", action="store_true",
+                        help="Todas las sesiones envían las mismas preguntas (mide la agrupación de single-flight)")
+    parser.add_argument("--save", metavar="NAME", help="Guardar el resultado en benchmarks/baselines/NAME.json")
+    parser.add_argument("--compare", metavar="FILE", help="Comparar con una línea base guardada")
+    parser.add_argument("--tolerance", type=float, default=0.15,
+                        help="Regresión relativa permitida al comparar (0.15 = 15%%)")
+    return parser.parse_args()
+
+
+def configure_environment(args, workdir: Path, keys):
+    """Point main.py at the fake backend and a throwaway key file before importing it"""
+    keys_file = workdir / "user_keys.json"
+    keys_file.write_text(json.dumps({
+        key: {"count": 0, "max_uses": args.turns + 1, "user_id": key, "description": "benchmark"} for key in keys
+    }), encoding="utf-8")
+    os.environ.update({
+        "MODEL_BACKEND": "fake",
+        "FAKE_MODEL_LATENCY": str(args.latency),
+        "FAKE_MODEL_TOKENS_PER_SECOND": str(args.tokens_per_second),
+        "FAKE_MODEL_RESPONSE_TOKENS": str(args.response_tokens),
+        "FAKE_MODEL_CHUNK_TOKENS": str(args.chunk_tokens),
+        "USER_KEYS_FILE": str(keys_file),
+        "SESSION_DB_PATH": str(workdir / "chat_sessions.db"),
+        "USER_KEYS_DB": str(workdir / "user_keys.db"),
+        "PROMPT_DELIVERY": os.getenv("PROMPT_DELIVERY", "system_instruction"),
+        "LOG_LEVEL": os.getenv("LOG_LEVEL", "WARNING"),
+        # Sin límite de ritmo por defecto: una sesión del benchmark envía sus turnos seguidos
+        "RATE_LIMIT_RPM": os.getenv("RATE_LIMIT_RPM", "0"),
+    })
+    # El resto de variables (SESSION_BACKEND, USER_KEYS_BACKEND, GEMINI_MAX_CONCURRENCY...) se respetan
+
+
+def percentile(values, fraction: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, round(fraction * (len(ordered) - 1))))
+    return ordered[index]
+
+
+def summarize(latencies):
+    return {
+        "count": len(latencies),
+        "p50": round(percentile(latencies, 0.50), 4),
+        "p95": round(percentile(latencies, 0.95), 4),
+        "p99": round(percentile(latencies, 0.99), 4),
+        "max": round(max(latencies), 4) if latencies else 0.0,
+    }
+
+
+def max_rss_kb():
+    if resource is None:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss // 1024 if sys.platform == "darwin" else rss
+
+
+async def run_session(client, index, key, args, latencies, errors):
+    async def timed(name, method, url, **kwargs):
+        start = time.perf_counter()
+        if name == "message" and args.stream:
+            async with client.stream(method, url, **kwargs) as response:
+                body = b"".join([chunk async for chunk in response.aiter_bytes()])
+            failed = response.status_code != 200 or b'"error": null' not in body
+        else:
+            response = await client.request(method, url, **kwargs)
+            failed = response.status_code != 200
+        latencies[name].append(time.perf_counter() - start)
+        if failed:
+            errors[f"{name}:{response.status_code}"] = errors.get(f"{name}:{response.status_code}", 0) + 1
+        return response
+
+    await timed("login", "POST", "/login", data={"key": key})
+    response = await timed("start", "POST", "/chat/start")
+    if response.status_code != 200:
+        return
+    session_id = response.json()["session_id"]
+    endpoint = "/chat/stream" if args.stream else "/chat/send"
+    for turn in range(args.turns):
+        pregunta = f"Pregunta {turn} sobre adaptaciones para alumnado con TDAH en 3º de primaria"
+        if not args.shared_questions:
+            # Primera pregunta distinta por sesión: si no, single-flight las agrupa en una sola llamada al modelo
+            pregunta += f" (sesión {index})"
+        await timed("message", "POST", endpoint, json={"session_id": session_id, "pregunta": pregunta})
+
+
+async def run_benchmark(args):
+    import httpx
+    import main
+
+    keys = list(main.user_keys.snapshot())
+    latencies = {"login": [], "start": [], "message": []}
+    errors = {}
+    sessions_before = main.chat_sessions.stats()
+    rss_before = max_rss_kb()
+    transport = httpx.ASGITransport(app=main.app)
+    semaphore = asyncio.Semaphore(args.concurrency)
+
+    async def worker(index, key):
+        async with semaphore:
+            async with httpx.AsyncClient(transport=transport, base_url="http://bench") as client:
+                await run_session(client, index, key, args, latencies, errors)
+
+    async with main.app.router.lifespan_context(main.app):
+        start = time.perf_counter()
+        await asyncio.gather(*(worker(index, key) for index, key in enumerate(keys)))
+        elapsed = time.perf_counter() - start
+        sessions_after = main.chat_sessions.stats()
+        user_keys_stats = main.user_keys.stats()
+        pool_stats = main.model_pool.stats()
+        single_flight_stats = main.single_flight.stats() if main.single_flight is not None else None
+    # Tras el cierre, la escritura final de user_keys.json ya está contada
+    user_keys_final = main.user_keys.stats()
+
+    total_requests = sum(len(values) for values in latencies.values())
+    rss_after = max_rss_kb()
+    return {
+        "config": {
+            "sessions": args.sessions,
+            "turns": args.turns,
+            "concurrency": args.concurrency,
+            "endpoint": "/chat/stream" if args.stream else "/chat/send",
+            "fake_latency": args.latency,
+            "fake_tokens_per_second": args.tokens_per_second,
+            "fake_response_tokens": args.response_tokens,
+            "session_backend": sessions_after["backend"],
+            "user_keys_backend": user_keys_stats["backend"],
+            "model_pool_concurrency": pool_stats["max_concurrency"],
+            "shared_questions": args.shared_questions,
+        },
+        "environment": {"python": platform.python_version(), "platform": platform.platform()},
+        "elapsed_seconds": round(elapsed, 3),
+        "requests": total_requests,
+        "requests_per_second": round(total_requests / elapsed, 2) if elapsed else 0.0,
+        "messages_per_second": round(len(latencies["message"]) / elapsed, 2) if elapsed else 0.0,
+        "latency": {name: summarize(values) for name, values in latencies.items()},
+        "errors": errors,
+        "chat_sessions": {
+            "sessions": sessions_after["sessions"] - sessions_before["sessions"],
+            "resident_bytes_growth": sessions_after["resident_bytes"] - sessions_before["resident_bytes"],
+            "evictions": sessions_after["evictions_total"] - sessions_before["evictions_total"],
+        },
+        "single_flight": single_flight_stats,
+        "process_max_rss_growth_kb": rss_after - rss_before if rss_before is not None else None,
+        "user_keys": {
+            "backend": user_keys_final["backend"],
+            "file_writes": user_keys_final.get("file_writes"),
+            "reserved": user_keys_final.get("reserved"),
+        },
+    }
+
+
+def compare(result, baseline, tolerance: float):
+    """Print metric deltas against a baseline; returns the list of regressions"""
+    regressions = []
+    rows = [("requests_per_second", baseline.get("requests_per_second"), result["requests_per_second"])]
+    # Solo los mensajes: login y start duran milisegundos y su variación es ruido
+    for stat in LOWER_IS_BETTER:
+        rows.append((f"message.{stat}", baseline["latency"]["message"].get(stat), result["latency"]["message"][stat]))
+    print(f"\n{'métrica':<24}{'base':>12}{'actual':>12}{'cambio':>10}")
+    for label, before, after in rows:
+        if not before:
+            continue
+        change = (after - before) / before
+        worse = change < -tolerance if label in HIGHER_IS_BETTER else change > tolerance
+        if worse:
+            regressions.append(label)
+        print(f"{label:<24}{before:>12}{after:>12}{change:>+10.1%}{'  ⚠️' if worse else ''}")
+    writes_before = baseline.get("user_keys", {}).get("file_writes")
+    writes_after = result["user_keys"]["file_writes"]
+    if writes_before is not None and writes_after is not None:
+        print(f"{'user_keys.file_writes':<24}{writes_before:>12}{writes_after:>12}")
+    return regressions
+
+
+def main_cli():
+    args = parse_args()
+    sys.path.insert(0, str(ROOT))
+    os.chdir(ROOT)  # main.py monta frontend/static con una ruta relativa
+    with tempfile.TemporaryDirectory(prefix="bench-neae-") as workdir:
+        keys = [f"bench-{index:05d}" for index in range(args.sessions)]
+        configure_environment(args, Path(workdir), keys)
+        result = asyncio.run(run_benchmark(args))
+
+    print(json.dumps(result, indent=2, ensure_ascii=False))
+    if args.save:
+        BASELINES_DIR.mkdir(exist_ok=True)
+        path = BASELINES_DIR / f"{args.save}.json"
+        path.write_text(json.dumps(result, indent=2, ensure_ascii=False) + "\n", encoding="utf-8")
+        print(f"💾 Línea base guardada en {path}")
+    if args.compare:
+        baseline = json.loads(Path(args.compare).read_text(encoding="utf-8"))
+        regressions = compare(result, baseline, args.tolerance)
+        if regressions:
+            print(f"❌ Regresiones por encima del {args.tolerance:.0%}: {', '.join(regressions)}")
+            sys.exit(1)
+        print("✅ Sin regresiones respecto a la línea base")
+
+
+if __name__ == "__main__":
+    main_cli()
@@ -0,0 +1,209 @@
+import asyncio
+import functools
+import logging
+import os
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+# Referencia para medir el tiempo desde el arranque del proceso hasta que el modelo está listo
+BOOT_STARTED = time.perf_counter()
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+PROMPT_PATH = os.path.join(SCRIPT_DIR, "prompt.txt")
+DEFAULT_MODEL_NAME = "gemini-1.5-pro-latest"
+DEFAULT_SYSTEM_PROMPT = "Eres un asistente virtual de apoyo docente especializado en Necesidades Específicas de Apoyo Educativo (NEAE) para Andalucía."
+
+
+def model_name() -> str:
+    return os.getenv("GEMINI_MODEL_NAME", DEFAULT_MODEL_NAME)
+
+
+def once(function):
+    """Run a no-argument initializer at most once, even with concurrent callers, and cache its result"""
+    lock = threading.Lock()
+    result = []
+
+    @functools.wraps(function)
+    def wrapper():
+        if not result:
+            with lock:
+                if not result:
+                    result.append(function())
+        return result[0]
+
+    return wrapper
+
+
+def resolve_credentials(strict: bool = False) -> str | None:
+    """Point GOOGLE_APPLICATION_CREDENTIALS at the service account file, if one is configured.
+
+    GOOGLE_APPLICATION_CREDENTIALS_PATH (from .env, relative to this directory)
+    takes precedence over GOOGLE_APPLICATION_CREDENTIALS. With `strict` a
+    missing file or missing configuration raises instead of logging a warning.
+    """
+    credentials_path_from_env_file = os.getenv("GOOGLE_APPLICATION_CREDENTIALS_PATH")
+    if credentials_path_from_env_file:
+        if os.path.isabs(credentials_path_from_env_file):
+            potential_path = credentials_path_from_env_file
+        else:
+            potential_path = os.path.join(SCRIPT_DIR, credentials_path_from_env_file)
+        potential_path = os.path.normpath(potential_path)
+        if os.path.exists(potential_path):
+            os.environ["GOOGLE_APPLICATION_CREDENTIALS"] = potential_path
+            logger.info(f"Usando credenciales de servicio desde el archivo: {potential_path}")
+            return potential_path
+        message = (f"El archivo de credenciales JSON especificado en GOOGLE_APPLICATION_CREDENTIALS_PATH "
+                   f"('{credentials_path_from_env_file}') no se encontró en '{potential_path}'.")
+        if strict:
+            raise FileNotFoundError(message)
+        logger.warning(f"Advertencia: {message}")
+        return None
+    if os.getenv("GOOGLE_APPLICATION_CREDENTIALS"):
+        effective_credentials_path = os.getenv("GOOGLE_APPLICATION_CREDENTIALS")
+        if not os.path.exists(effective_credentials_path):
+            logger.warning(f"Advertencia: El archivo de credenciales JSON especificado por GOOGLE_APPLICATION_CREDENTIALS ('{effective_credentials_path}') no se encontró.")
+        else:
+            logger.info(f"Usando credenciales de servicio desde GOOGLE_APPLICATION_CREDENTIALS: {effective_credentials_path}")
+        return effective_credentials_path
+    if strict and not os.getenv("GOOGLE_API_KEY"):
+        raise ValueError(
+            "No se encontraron credenciales de Google. "
+            "Define GOOGLE_APPLICATION_CREDENTIALS_PATH en tu archivo .env apuntando a tu archivo de credenciales JSON, "
+            "configura GOOGLE_APPLICATION_CREDENTIALS en tu sistema o define GOOGLE_API_KEY."
+        )
+    return None
+
+
+@once
+def get_genai():
+    """google.generativeai, imported on first use: the SDK alone takes most of a cold start"""
+    import google.generativeai as genai
+    return genai
+
+
+@once
+def configure_genai() -> bool:
+    """Resolve credentials and call genai.configure() once; returns whether it succeeded"""
+    effective_credentials_path = resolve_credentials()
+    genai = get_genai()
+    try:
+        api_key_from_env = os.getenv("GOOGLE_API_KEY")
+        if api_key_from_env:
+            genai.configure(api_key=api_key_from_env)
+            logger.info("Usando GOOGLE_API_KEY para configurar Gemini.")
+        elif effective_credentials_path and os.path.exists(effective_credentials_path):
+            genai.configure()
+            logger.info("Intentando configurar Gemini usando Application Default Credentials (ADC) a través de GOOGLE_APPLICATION_CREDENTIALS.")
+        else:
+            # Puede funcionar si ADC está configurado de otra forma; si no, fallará al crear el modelo
+            genai.configure()
+            logger.info("Intentando configurar Gemini (puede usar ADC si está disponible de otra forma, o fallará si no hay credenciales).")
+        return True
+    except Exception as e:
+        logger.error(f"Error inicial al configurar genai: {e}. El modelo no estará disponible.")
+        return False
+
+
+@once
+def read_prompt_file() -> str | None:
+    """Contents of prompt.txt, or None if it cannot be read"""
+    try:
+        with open(PROMPT_PATH, 'r', encoding='utf-8') as f:
+            prompt = f.read()
+        logger.info(f"Prompt del sistema cargado desde {PROMPT_PATH}")
+        return prompt
+    except FileNotFoundError:
+        logger.warning(f"No se encontró el archivo de prompt en {PROMPT_PATH}")
+    except Exception as e:
+        logger.error(f"Error al leer el archivo de prompt: {e}")
+    return None
+
+
+class ModelBootstrap:
+    """Creates the model once, off the import path, and reports readiness.
+
+    `initialize` is a blocking callable that returns the model or None. It runs
+    in a background thread started by start(), or on the first call to get()
+    if nothing started it. A failure is final, like a failed start used to be.
+    With `warmup`, a tiny model call runs after initialization so the first
+    real chat does not pay for connection and auth setup; readiness waits for
+    it (chat requests do not), and a failed warm-up does not make the service
+    unready.
+    """
+
+    def __init__(self, initialize, warmup=None):
+        self._initialize = initialize
+        self._warmup = warmup
+        self._lock = threading.Lock()
+        self._initialized = threading.Event()
+        self._ready = threading.Event()
+        self._thread = None
+        self.model = None
+        self.state = "pending"
+        self.error = None
+        self.init_seconds = None
+        self.warmup_state = "pending" if warmup else "disabled"
+        self.warmup_seconds = None
+        self.ready_after_boot_seconds = None
+
+    def start(self):
+        """Initialize (and warm up) in a daemon thread"""
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="model-bootstrap", daemon=True)
+                self._thread.start()
+
+    def get(self):
+        """The model, blocking until initialization (not the warm-up) has finished; None if it failed"""
+        self.start()
+        self._initialized.wait()
+        return self.model
+
+    async def wait(self):
+        if self._initialized.is_set():
+            return self.model
+        return await asyncio.to_thread(self.get)
+
+    @property
+    def ready(self) -> bool:
+        return self._ready.is_set() and self.model is not None
+
+    def _run(self):
+        started = time.perf_counter()
+        self.state = "initializing"
+        try:
+            self.model = self._initialize()
+            self.state = "ready" if self.model is not None else "failed"
+        except Exception as e:
+            self.error = str(e)
+            self.state = "failed"
+            logger.error(f"Error al inicializar el modelo: {e}")
+        self.init_seconds = round(time.perf_counter() - started, 3)
+        self._initialized.set()
+        if self.model is not None and self._warmup:
+            warmup_started = time.perf_counter()
+            self.warmup_state = "running"
+            try:
+                self._warmup()
+                self.warmup_state = "done"
+            except Exception as e:
+                self.warmup_state = "failed"
+                logger.warning(f"⚠️ Falló la llamada de calentamiento del modelo: {e}")
+            self.warmup_seconds = round(time.perf_counter() - warmup_started, 3)
+        self.ready_after_boot_seconds = round(time.perf_counter() - BOOT_STARTED, 3)
+        self._ready.set()
+        if self.model is not None:
+            logger.info(f"🚀 Modelo listo {self.ready_after_boot_seconds} s después del arranque "
+                        f"(inicialización {self.init_seconds} s, calentamiento {self.warmup_state})")
+
+    def status(self):
+        return {
+            "state": self.state,
+            "error": self.error,
+            "init_seconds": self.init_seconds,
+            "warmup": self.warmup_state,
+            "warmup_seconds": self.warmup_seconds,
+            "ready_after_boot_seconds": self.ready_after_boot_seconds,
+        }
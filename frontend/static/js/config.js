@@ -7,6 +7,7 @@ const CONFIG = {
     MAX_MESSAGE_LENGTH: 1000,
     AUTO_SCROLL: true,
     SHOW_TYPING_INDICATOR: true,
+    USE_STREAMING: true, // Respuestas progresivas vía /chat/stream (SSE)
     
     // Error Messages
     ERRORS: {
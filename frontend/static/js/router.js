@@ -5,6 +5,16 @@ const routes = {
 
 const rootDiv = document.getElementById('app');
 
+// Vistas incluidas en index.html por el servidor (STATIC_VIEWS=bundle); si no, se piden por URL
+const viewBundle = window.NEAE_VIEW_BUNDLE || {};
+
+async function fetchViewHtml(htmlPath) {
+    if (htmlPath in viewBundle) return viewBundle[htmlPath];
+    const response = await fetch(htmlPath);
+    if (!response.ok) throw new Error(`Failed to load HTML: ${htmlPath} (${response.status})`);
+    return response.text();
+}
+
 function navigateTo(path) {
     window.location.hash = path;
 }
@@ -41,9 +51,7 @@ async function loadPage(pageName) {
             removeViewScript();
             return;
     }    try {
-        const response = await fetch(htmlPath);
-        if (!response.ok) throw new Error(`Failed to load HTML: ${htmlPath} (${response.status})`);
-        content = await response.text();
+        content = await fetchViewHtml(htmlPath);
         
         // Safely update DOM content with protection against extension interference
         try {
@@ -102,9 +110,8 @@ async function loadAndExecuteViewScript(scriptPath, initFunctionName) {
     return new Promise((resolve, reject) => {
         const script = document.createElement('script');
         script.id = 'view-script';
-        // Add cache busting to force fresh load
-        script.src = scriptPath + '?v=' + Date.now();
-        script.onload = async () => {
+        // Sin parámetro anti-caché: el servidor sirve las vistas con URL con hash (inmutables) o con ETag
+        const onScriptReady = async () => {
             // Wait a bit for the script to fully load and parse
             setTimeout(async () => {
                 if (typeof window[initFunctionName] === 'function') {                    try {
@@ -120,6 +127,15 @@ async function loadAndExecuteViewScript(scriptPath, initFunctionName) {
                 }
             }, 50); // Small delay to ensure script is fully parsed
         };
+        if (scriptPath in viewBundle) {
+            // Un script en línea se ejecuta al insertarlo, sin evento onload
+            script.text = viewBundle[scriptPath];
+            document.body.appendChild(script);
+            onScriptReady();
+            return;
+        }
+        script.src = scriptPath;
+        script.onload = onScriptReady;
         script.onerror = () => {
             console.error(`Failed to load script: ${scriptPath}`);
             reject(new Error(`Failed to load script: ${scriptPath}`));
@@ -166,6 +166,11 @@ if (window.NEAE_CHAT_LOADED) {
             this.chatInput.value = '';
             this.setLoading(true);
             const loadingMessage = this.addMessage('El asistente está pensando', 'assistant', true);
+
+            if (CONFIG.USE_STREAMING && window.ReadableStream && window.TextDecoder) {
+                this.streamMessage(message, loadingMessage);
+                return;
+            }
             
             fetch(this.apiBaseUrl + '/chat/send', { 
                 method: 'POST',
@@ -195,7 +200,94 @@ if (window.NEAE_CHAT_LOADED) {
             }).finally(function() {
                 self.setLoading(false);
             });
-        },        addMessage: function(content, sender, isLoading) {
+        },        streamMessage: function(message, loadingMessage) {
+            const self = this;
+            let assistantText = null;
+            let fullText = '';
+
+            const renderChunk = function(text) {
+                if (!assistantText) {
+                    if (loadingMessage && loadingMessage.remove) loadingMessage.remove();
+                    const wrapper = self.addMessage('', 'assistant');
+                    assistantText = wrapper ? wrapper.querySelector('.message-text') : null;
+                }
+                fullText += text;
+                if (assistantText) {
+                    assistantText.innerHTML = self.processMessageContent(fullText);
+                    self.chatMessages.scrollTop = self.chatMessages.scrollHeight;
+                }
+            };
+
+            // Returns the payload of the final "done" event, if any
+            const handleEvent = function(block) {
+                let eventName = 'message';
+                let data = '';
+                block.split('\n').forEach(function(line) {
+                    if (line.startsWith('event:')) eventName = line.slice(6).trim();
+                    else if (line.startsWith('data:')) data += line.slice(5).trim();
+                });
+                if (!data) return null;
+                const payload = JSON.parse(data);
+                if (eventName === 'chunk') {
+                    renderChunk(payload.text);
+                    return null;
+                }
+                return eventName === 'done' ? payload : null;
+            };
+
+            fetch(this.apiBaseUrl + '/chat/stream', {
+                method: 'POST',
+                headers: {
+                    'Content-Type': 'application/json',
+                    'Accept': 'text/event-stream'
+                },
+                credentials: 'include',
+                body: JSON.stringify({ session_id: this.sessionId, pregunta: message })
+            }).then(function(response) {
+                if (!response.ok) {
+                    return ErrorHandler.handleAPIError(response, 'sending message').then(function(errorMessage) {
+                        throw new Error(errorMessage);
+                    });
+                }
+                const reader = response.body.getReader();
+                const decoder = new TextDecoder();
+                let buffer = '';
+                let donePayload = null;
+
+                const read = function() {
+                    return reader.read().then(function(result) {
+                        if (result.done) return donePayload;
+                        buffer += decoder.decode(result.value, { stream: true });
+                        let boundary = buffer.indexOf('\n\n');
+                        while (boundary !== -1) {
+                            const payload = handleEvent(buffer.slice(0, boundary));
+                            if (payload) donePayload = payload;
+                            buffer = buffer.slice(boundary + 2);
+                            boundary = buffer.indexOf('\n\n');
+                        }
+                        return read();
+                    });
+                };
+                return read();
+            }).then(function(donePayload) {
+                if (loadingMessage && loadingMessage.remove) loadingMessage.remove();
+                if (!donePayload || donePayload.error) {
+                    throw new Error((donePayload && donePayload.error) || 'La respuesta se interrumpió');
+                }
+                // Increment usage counter in real-time
+                if (window.SessionManager && window.SessionManager.incrementUsageCounter) {
+                    window.SessionManager.incrementUsageCounter();
+                }
+            }).catch(function(error) {
+                console.error('Error streaming message:', error);
+                if (loadingMessage && loadingMessage.remove) loadingMessage.remove();
+                ErrorHandler.showError(error.message || 'Error al enviar el mensaje');
+            }).finally(function() {
+                self.setLoading(false);
+            });
+        },
+
+        addMessage: function(content, sender, isLoading) {
             if (!this.chatMessages) return;
             
             // Create message wrapper
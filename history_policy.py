@@ -0,0 +1,171 @@
+import logging
+import os
+import re
+import threading
+
+from model_backend import gemini_model
+
+logger = logging.getLogger(__name__)
+
+SUMMARY_PREFIX = "Resumen de la conversación anterior (turnos más antiguos condensados):"
+SUMMARY_ACKNOWLEDGEMENT = "Entendido. Tendré en cuenta este resumen en mis próximas respuestas."
+
+SUMMARY_INSTRUCTIONS = (
+    "Resume en español, en un máximo de {max_chars} caracteres, la siguiente conversación entre un docente "
+    "y un asistente sobre Necesidades Específicas de Apoyo Educativo. Conserva la NEAE, la etapa y el curso, "
+    "los datos del alumno y las adaptaciones o recursos ya propuestos. No añadas información nueva.\n\n{conversation}"
+)
+
+
+def estimate_tokens(history) -> int:
+    """Rough token count of a serialized history (about 4 characters per token)"""
+    return sum(len(text) for content in history for text in content["parts"]) // 4
+
+
+def is_summary_turn(content) -> bool:
+    return content["role"] == "user" and bool(content["parts"]) and content["parts"][0].startswith(SUMMARY_PREFIX)
+
+
+class HistoryPolicy:
+    """Keeps the history sent to Gemini within a token budget.
+
+    The system prompt is delivered separately (see PromptDelivery) and is never
+    touched. Once the conversation exceeds `token_budget` estimated tokens, the
+    last `keep_turns` question/answer pairs are kept verbatim and everything
+    older is collapsed into one summary turn, either extractive (no model call)
+    or generated by the model when `summarizer` is set. compact() never calls
+    the model: the caller awaits summarize() through the model pool first and
+    passes its result in.
+    """
+
+    def __init__(self, token_budget: int = 8000, keep_turns: int = 4,
+                 summary_max_chars: int = 2000, summarizer=None):
+        self.token_budget = token_budget
+        self.keep_turns = keep_turns
+        self.summary_max_chars = summary_max_chars
+        self.summarizer = summarizer
+        self._lock = threading.Lock()
+        self._turns = 0
+        self._compactions = 0
+        self._summary_failures = 0
+        self._tokens_total = 0
+        self._tokens_removed = 0
+        self._last_tokens = 0
+
+    def needs_compaction(self, history) -> bool:
+        return bool(self.token_budget) and estimate_tokens(history) > self.token_budget \
+            and len(history) > 2 * self.keep_turns
+
+    def _split(self, history):
+        split = len(history) - 2 * self.keep_turns
+        return history[:split], history[split:]
+
+    async def summarize(self, history, run) -> str | None:
+        """Model summary of the turns compact() would collapse, via `run(fn, *args)` (the model pool).
+
+        Returns None without a summarizer, when no compaction is needed or if
+        the call fails (compact() then falls back to the extractive summary).
+        """
+        if self.summarizer is None or not self.needs_compaction(history):
+            return None
+        try:
+            return await run(self.summarizer, self._summary_request(self._split(history)[0]))
+        except Exception as e:
+            logger.error(f"⚠️ Error al resumir el historial con el modelo ({e}); usando resumen extractivo")
+            with self._lock:
+                self._summary_failures += 1
+            return None
+
+    def compact(self, history, summary: str | None = None) -> list:
+        """Return the history with older turns collapsed into `summary` (extractive if none is given)"""
+        if not self.needs_compaction(history):
+            return history
+        older, recent = self._split(history)
+        if not summary:
+            summary = self._extractive_summary(older)
+        compacted = [
+            {"role": "user", "parts": [f"{SUMMARY_PREFIX}\n{summary[:self.summary_max_chars]}"]},
+            {"role": "model", "parts": [SUMMARY_ACKNOWLEDGEMENT]},
+        ] + recent
+        with self._lock:
+            self._compactions += 1
+            self._tokens_removed += estimate_tokens(history) - estimate_tokens(compacted)
+        return compacted
+
+    def _summary_request(self, older) -> str:
+        lines = []
+        for content in older:
+            speaker = "Docente" if content["role"] == "user" else "Asistente"
+            lines.append(f"{speaker}: {' '.join(content['parts'])}")
+        return SUMMARY_INSTRUCTIONS.format(max_chars=self.summary_max_chars, conversation="\n".join(lines))
+
+    def _extractive_summary(self, older) -> str:
+        """Keep each question and the headings / first sentence of each answer"""
+        lines = []
+        for content in older:
+            text = " ".join(content["parts"])
+            if is_summary_turn(content):
+                lines.append(text[len(SUMMARY_PREFIX):].strip())
+            elif content["role"] == "user":
+                lines.append(f"- Docente: {' '.join(text.split())[:300]}")
+            elif content["parts"] and content["parts"][0] != SUMMARY_ACKNOWLEDGEMENT:
+                headings = [line.strip("*# ").strip() for line in text.splitlines()
+                            if re.match(r"^\s*(#+|\*\*)", line)]
+                first_sentence = re.split(r"(?<=[.!?])\s", " ".join(text.split()), maxsplit=1)[0]
+                lines.append(f"- Asistente: {first_sentence[:300]}" + (f" (apartados: {'; '.join(headings[:8])})" if headings else ""))
+        summary = "\n".join(lines)
+        if len(summary) > self.summary_max_chars:
+            # Se conservan los turnos más recientes del tramo resumido
+            summary = "…" + summary[-(self.summary_max_chars - 1):]
+        return summary
+
+    def record_turn(self, history) -> int:
+        """Account the history size sent on one turn; returns its estimated tokens"""
+        tokens = estimate_tokens(history)
+        with self._lock:
+            self._turns += 1
+            self._tokens_total += tokens
+            self._last_tokens = tokens
+        return tokens
+
+    def stats(self):
+        with self._lock:
+            return {
+                "token_budget": self.token_budget,
+                "keep_turns": self.keep_turns,
+                "summary_mode": "model" if self.summarizer else "extractive",
+                "turns": self._turns,
+                "compactions": self._compactions,
+                "summary_failures": self._summary_failures,
+                "history_tokens_last_turn": self._last_tokens,
+                "history_tokens_per_turn": round(self._tokens_total / self._turns, 1) if self._turns else 0,
+                "tokens_removed_total": self._tokens_removed,
+            }
+
+
+def lazy_model_summarizer(model_name: str, model_factory=None):
+    """Blocking summarizer whose model is created on its first call (in a pool worker), not at import time"""
+    lock = threading.Lock()
+    models = []
+
+    def summarizer(request_text):
+        with lock:
+            if not models:
+                models.append((model_factory or gemini_model)(model_name))
+        return models[0].generate_content(request_text).text
+
+    return summarizer
+
+
+def create_history_policy(model_name: str, model_factory=None) -> HistoryPolicy:
+    """Build the policy from HISTORY_* environment variables"""
+    summarizer = None
+    if os.getenv("HISTORY_SUMMARY_MODE", "extractive").lower() == "model":
+        summarizer = lazy_model_summarizer(os.getenv("HISTORY_SUMMARY_MODEL_NAME", model_name), model_factory)
+
+    return HistoryPolicy(
+        token_budget=int(os.getenv("HISTORY_TOKEN_BUDGET", "8000")),
+        keep_turns=int(os.getenv("HISTORY_KEEP_TURNS", "4")),
+        summary_max_chars=int(os.getenv("HISTORY_SUMMARY_MAX_CHARS", "2000")),
+        summarizer=summarizer,
+    )
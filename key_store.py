@@ -0,0 +1,304 @@
+import argparse
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from pathlib import Path
+
+from usage_ledger import UsageLedger, with_usage_percentage
+
+logger = logging.getLogger(__name__)
+
+KNOWN_FIELDS = ("count", "max_uses", "user_id", "description")
+
+
+class SQLiteKeyStore:
+    """User keys and usage counters in a SQLite database (WAL mode).
+
+    Exposes the same interface as UsageLedger. Every lookup goes through the
+    primary-key index and reserve()/refund() are single conditional UPDATEs, so
+    quotas hold across threads and across uvicorn worker processes. Triggers
+    keep the totals over all keys in `key_totals` as counts change. Every call
+    reads or commits to disk, so the server runs them in a worker thread
+    (`blocking`); each thread gets its own connection and close() closes them all.
+    """
+
+    blocking = True
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS user_keys (
+            key TEXT PRIMARY KEY,
+            user_id TEXT NOT NULL DEFAULT '',
+            description TEXT NOT NULL DEFAULT '',
+            count INTEGER NOT NULL DEFAULT 0,
+            max_uses INTEGER NOT NULL DEFAULT 0,
+            extra TEXT NOT NULL DEFAULT '{}'
+        ) WITHOUT ROWID;
+        CREATE INDEX IF NOT EXISTS idx_user_keys_user_id ON user_keys (user_id);
+        CREATE TABLE IF NOT EXISTS key_store_meta (
+            name TEXT PRIMARY KEY,
+            value TEXT NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS key_totals (
+            id INTEGER PRIMARY KEY CHECK (id = 1),
+            keys INTEGER NOT NULL,
+            uses INTEGER NOT NULL,
+            max_uses INTEGER NOT NULL,
+            exhausted INTEGER NOT NULL
+        );
+        CREATE TRIGGER IF NOT EXISTS user_keys_totals_insert AFTER INSERT ON user_keys BEGIN
+            UPDATE key_totals SET keys = keys + 1, uses = uses + NEW.count, max_uses = max_uses + NEW.max_uses,
+                exhausted = exhausted + (NEW.count >= NEW.max_uses) WHERE id = 1;
+        END;
+        CREATE TRIGGER IF NOT EXISTS user_keys_totals_delete AFTER DELETE ON user_keys BEGIN
+            UPDATE key_totals SET keys = keys - 1, uses = uses - OLD.count, max_uses = max_uses - OLD.max_uses,
+                exhausted = exhausted - (OLD.count >= OLD.max_uses) WHERE id = 1;
+        END;
+        CREATE TRIGGER IF NOT EXISTS user_keys_totals_update AFTER UPDATE OF count, max_uses ON user_keys BEGIN
+            UPDATE key_totals SET uses = uses + NEW.count - OLD.count, max_uses = max_uses + NEW.max_uses - OLD.max_uses,
+                exhausted = exhausted + (NEW.count >= NEW.max_uses) - (OLD.count >= OLD.max_uses) WHERE id = 1;
+        END;
+        -- Bases de datos anteriores a los totales: se calculan una vez
+        INSERT OR IGNORE INTO key_totals (id, keys, uses, max_uses, exhausted)
+            SELECT 1, COUNT(*), COALESCE(SUM(count), 0), COALESCE(SUM(max_uses), 0), COALESCE(SUM(count >= max_uses), 0)
+            FROM user_keys;
+    """
+
+    def __init__(self, path: str | Path, json_path: str | Path | None = None):
+        self.path = str(path)
+        self.json_path = Path(json_path) if json_path else None
+        self._local = threading.local()
+        self._conns = []  # Conexiones de todos los hilos, para cerrarlas en close()
+        self._conns_lock = threading.Lock()
+        self._reserved = 0
+        self._rejected = 0
+        self._refunded = 0
+        self._stats_lock = threading.Lock()
+        conn = self._conn()
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.executescript(self.SCHEMA)
+
+    def _conn(self):
+        # Una conexión por hilo: sqlite3 no comparte conexiones entre hilos de forma segura
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            # check_same_thread=False solo para que close() pueda cerrarla desde otro hilo; cada hilo usa la suya
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None, check_same_thread=False)
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute("PRAGMA busy_timeout=30000")
+            self._local.conn = conn
+            with self._conns_lock:
+                self._conns.append(conn)
+        return conn
+
+    def load(self):
+        """Open the store, importing user_keys.json the first time the database is empty"""
+        conn = self._conn()
+        imported = conn.execute("SELECT value FROM key_store_meta WHERE name = 'imported_from'").fetchone()
+        empty = conn.execute("SELECT NOT EXISTS (SELECT 1 FROM user_keys)").fetchone()[0]
+        if not imported and empty and self.json_path and self.json_path.exists():
+            count = self.import_json(self.json_path, with_counts=True)
+            logger.info(f"📥 {count} claves importadas de {self.json_path} a {self.path}")
+        logger.info(f"✅ User keys loaded from {self.path}")
+        logger.info(f"📊 Found {len(self)} user keys configured")
+        return len(self)
+
+    def import_json(self, json_path: str | Path, with_counts: bool = False) -> int:
+        """Upsert the keys defined in a user_keys.json file.
+
+        Definitions (max_uses, user_id, description, extra fields) are always
+        updated; usage counts are only taken from the file when `with_counts`.
+        """
+        with open(json_path, 'r', encoding='utf-8') as f:
+            keys_data = json.load(f)
+        rows = [self._json_row(key, data, with_counts) for key, data in keys_data.items()]
+        update_count = ", count = excluded.count" if with_counts else ""
+        conn = self._conn()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            conn.executemany(
+                "INSERT INTO user_keys (key, user_id, description, count, max_uses, extra) VALUES (?, ?, ?, ?, ?, ?) "
+                "ON CONFLICT(key) DO UPDATE SET user_id = excluded.user_id, description = excluded.description, "
+                f"max_uses = excluded.max_uses, extra = excluded.extra{update_count}",
+                rows,
+            )
+            conn.execute(
+                "INSERT OR REPLACE INTO key_store_meta (name, value) VALUES ('imported_from', ?)",
+                (json.dumps({"path": str(json_path), "at": time.time()}),),
+            )
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        return len(rows)
+
+    @staticmethod
+    def _json_row(key: str, data: dict, with_counts: bool):
+        return (
+            key,
+            data.get("user_id", ""),
+            data.get("description", ""),
+            int(data.get("count", 0)) if with_counts else 0,
+            int(data.get("max_uses", 0)),
+            json.dumps({k: v for k, v in data.items() if k not in KNOWN_FIELDS}, ensure_ascii=False),
+        )
+
+    def reload(self):
+        """Apply the differences between user_keys.json and the database.
+
+        New keys are inserted (with the count in the file), edited definitions
+        are updated and keys no longer in the file are deleted; usage counts of
+        existing keys are never touched. Returns the keys added, updated and removed.
+        """
+        changes = {"added": [], "updated": [], "removed": []}
+        if not self.json_path or not self.json_path.exists():
+            return changes
+        with open(self.json_path, 'r', encoding='utf-8') as f:
+            keys_data = json.load(f)
+        conn = self._conn()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            current = {row[0]: row[1:] for row in conn.execute(
+                "SELECT key, user_id, description, max_uses, extra FROM user_keys")}
+            for key, data in keys_data.items():
+                row = self._json_row(key, data, with_counts=True)
+                definition = row[1:3] + row[4:]
+                if key not in current:
+                    conn.execute("INSERT INTO user_keys (key, user_id, description, count, max_uses, extra) "
+                                 "VALUES (?, ?, ?, ?, ?, ?)", row)
+                    changes["added"].append(key)
+                elif tuple(current[key]) != definition:
+                    conn.execute("UPDATE user_keys SET user_id = ?, description = ?, max_uses = ?, extra = ? WHERE key = ?",
+                                 definition + (key,))
+                    changes["updated"].append(key)
+            changes["removed"] = [key for key in current if key not in keys_data]
+            conn.executemany("DELETE FROM user_keys WHERE key = ?", [(key,) for key in changes["removed"]])
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        logger.info(f"🔄 User keys reloaded from {self.json_path}: {len(changes['added'])} added, "
+                    f"{len(changes['updated'])} updated, {len(changes['removed'])} removed")
+        return changes
+
+    def start(self):
+        pass  # Cada reserva se confirma en la base de datos; no hay escritura diferida
+
+    def close(self):
+        with self._conns_lock:
+            conns, self._conns = self._conns, []
+        for conn in conns:
+            conn.close()
+        # Los hilos que sigan vivos abrirán una conexión nueva si vuelven a usar el almacén
+        self._local = threading.local()
+
+    def flush(self, force: bool = False):
+        return False
+
+    def __contains__(self, key):
+        return self._conn().execute("SELECT 1 FROM user_keys WHERE key = ?", (key,)).fetchone() is not None
+
+    def __len__(self):
+        return self._conn().execute("SELECT COUNT(*) FROM user_keys").fetchone()[0]
+
+    @staticmethod
+    def _row_to_entry(row):
+        user_id, description, count, max_uses, extra = row
+        entry = json.loads(extra) if extra else {}
+        entry.update(count=count, max_uses=max_uses, user_id=user_id, description=description)
+        return entry
+
+    def get(self, key: str):
+        row = self._conn().execute(
+            "SELECT user_id, description, count, max_uses, extra FROM user_keys WHERE key = ?", (key,)
+        ).fetchone()
+        return self._row_to_entry(row) if row else None
+
+    def snapshot(self):
+        rows = self._conn().execute(
+            "SELECT key, user_id, description, count, max_uses, extra FROM user_keys ORDER BY key"
+        ).fetchall()
+        return {row[0]: self._row_to_entry(row[1:]) for row in rows}
+
+    def page(self, cursor: str | None = None, limit: int = 100, min_usage: float | None = None,
+             user_id_prefix: str | None = None):
+        """Entries after `cursor` in key order that pass the filters, as ([(key, entry)], next_cursor)"""
+        query = "SELECT key, user_id, description, count, max_uses, extra FROM user_keys WHERE key > ?"
+        params = [cursor or ""]
+        if user_id_prefix:
+            query += " AND substr(user_id, 1, ?) = ?"
+            params += [len(user_id_prefix), user_id_prefix]
+        if min_usage is not None:
+            # Igual que usage_percentage(): una clave sin usos cuenta como consumida al 100 %
+            query += " AND (max_uses = 0 OR round(count * 100.0 / max_uses, 1) >= ?)"
+            params.append(min_usage)
+        rows = self._conn().execute(query + " ORDER BY key LIMIT ?", params + [limit]).fetchall()
+        items = [(row[0], self._row_to_entry(row[1:])) for row in rows]
+        return items, items[-1][0] if len(items) >= limit else None
+
+    def totals(self):
+        """Keys, uses and exhausted keys over the whole store, maintained by triggers"""
+        row = self._conn().execute("SELECT keys, uses, max_uses, exhausted FROM key_totals WHERE id = 1").fetchone()
+        return with_usage_percentage(dict(zip(("keys", "uses", "max_uses", "exhausted"), row)))
+
+    def reserve(self, key: str) -> bool:
+        cursor = self._conn().execute(
+            "UPDATE user_keys SET count = count + 1 WHERE key = ? AND count < max_uses", (key,)
+        )
+        with self._stats_lock:
+            if cursor.rowcount == 1:
+                self._reserved += 1
+            else:
+                self._rejected += 1
+        return cursor.rowcount == 1
+
+    def refund(self, key: str):
+        cursor = self._conn().execute("UPDATE user_keys SET count = count - 1 WHERE key = ? AND count > 0", (key,))
+        if cursor.rowcount:
+            with self._stats_lock:
+                self._refunded += 1
+
+    def stats(self):
+        with self._stats_lock:
+            return {
+                "backend": "sqlite",
+                "database": self.path,
+                "keys_file": str(self.json_path) if self.json_path else None,
+                "reserved": self._reserved,
+                "rejected": self._rejected,
+                "refunded": self._refunded,
+            }
+
+
+def create_key_store(json_path: str | Path):
+    """Build the key store selected by USER_KEYS_BACKEND (json or sqlite)"""
+    backend = os.getenv("USER_KEYS_BACKEND", "json").lower()
+    if backend == "sqlite":
+        db_path = os.getenv("USER_KEYS_DB", str(Path(json_path).with_suffix(".db")))
+        return SQLiteKeyStore(db_path, json_path=json_path)
+    if backend != "json":
+        logger.warning(f"⚠️ USER_KEYS_BACKEND '{backend}' desconocido; usando {json_path}")
+    if int(os.getenv("WEB_CONCURRENCY", "1") or 1) > 1:
+        # uvicorn y gunicorn arrancan WEB_CONCURRENCY procesos y cada uno reescribiría el fichero con sus contadores
+        raise RuntimeError("USER_KEYS_BACKEND=json solo admite un worker; con WEB_CONCURRENCY > 1 usa USER_KEYS_BACKEND=sqlite.")
+    return UsageLedger(
+        json_path,
+        flush_interval=float(os.getenv("USER_KEYS_FLUSH_INTERVAL", "5")),
+        flush_every=int(os.getenv("USER_KEYS_FLUSH_EVERY", "50")),
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Gestión del almacén SQLite de claves de usuario")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    import_parser = subparsers.add_parser("import", help="Importar (o actualizar) claves desde un user_keys.json")
+    import_parser.add_argument("json_path", nargs="?", default=str(Path(__file__).parent / "user_keys.json"))
+    import_parser.add_argument("--db", default=os.getenv("USER_KEYS_DB", str(Path(__file__).parent / "user_keys.db")))
+    import_parser.add_argument("--with-counts", action="store_true", help="Sobrescribir también los contadores de uso")
+    args = parser.parse_args()
+
+    store = SQLiteKeyStore(args.db)
+    imported = store.import_json(args.json_path, with_counts=args.with_counts)
+    print(f"📥 {imported} claves importadas de {args.json_path} a {args.db} ({len(store)} en total)")
@@ -1,87 +1,90 @@
+import asyncio
 import json
+import logging
 import os
+import time
 from pathlib import Path
-import json
+import config  # Primero: marca el inicio del arranque para /ready
 from dotenv import load_dotenv
 # Removed: from google.ai.generativelanguage import GoogleSearchRetrieval
-from fastapi import FastAPI, HTTPException, Request, Form, Depends
+from fastapi import FastAPI, HTTPException, Request, Form, Depends, Query
 from fastapi.staticfiles import StaticFiles
-from fastapi.responses import FileResponse, HTMLResponse, RedirectResponse, JSONResponse
+from fastapi.responses import FileResponse, HTMLResponse, RedirectResponse, JSONResponse, StreamingResponse, PlainTextResponse
 from fastapi.middleware.cors import CORSMiddleware
 from pydantic import BaseModel
 import uuid
-import google.generativeai as genai
-import uvicorn
+import weakref
+from model_pool import ModelCallPool, PoolSaturatedError, ModelCallTimeoutError
+from prompt_delivery import PromptDelivery
+from session_store import create_session_backend, SessionRecord
+from key_store import create_key_store
+from usage_ledger import usage_percentage
+from response_cache import ResponseCache, normalize_question, prompt_version
+from history_policy import create_history_policy
+from model_backend import create_model_factory
+from model_router import create_model_router, ModelUnavailableError, TRANSIENT_ERRORS
+from prompt_engine import create_prompt_engine
+from resource_catalog import create_resource_catalog
+from rate_limit import FairScheduler, create_rate_limiter
+from batch_runner import create_batch_progress_store, parse_batch_items, parse_jsonl, run_batch
+from singleflight import create_single_flight
+from static_assets import create_static_assets
+import metrics
+from metrics import MetricsMiddleware, span
 
 # Cargar variables de entorno
 load_dotenv(override=True)
 
+# Registro estructurado: id de petición en cada línea y un registro de acceso por petición (texto clave=valor o JSON)
+metrics.configure_logging(os.getenv("LOG_LEVEL", "INFO"), os.getenv("LOG_FORMAT", "text").lower())
+logger = logging.getLogger("asistente_neae")
+
 # --- Configuración del Modelo Gemini ---
-# Adaptado de asistente-virtual.py y la lógica previa de main.py
-credentials_path_from_env_file = os.getenv("GOOGLE_APPLICATION_CREDENTIALS_PATH")
-effective_credentials_path = None
-script_dir = os.path.dirname(os.path.abspath(__file__))
-
-if credentials_path_from_env_file:
-    if os.path.isabs(credentials_path_from_env_file):
-        potential_path = credentials_path_from_env_file
-    else:
-        potential_path = os.path.join(script_dir, credentials_path_from_env_file)
-    potential_path = os.path.normpath(potential_path)
-    if os.path.exists(potential_path):
-        os.environ["GOOGLE_APPLICATION_CREDENTIALS"] = potential_path
-        effective_credentials_path = potential_path
-        print(f"Usando credenciales de servicio desde el archivo: {effective_credentials_path}")
-    else:
-        print(f"Advertencia: El archivo de credenciales JSON especificado en GOOGLE_APPLICATION_CREDENTIALS_PATH ('{credentials_path_from_env_file}') no se encontró en '{potential_path}'.")
-elif os.getenv("GOOGLE_APPLICATION_CREDENTIALS"):
-    effective_credentials_path = os.getenv("GOOGLE_APPLICATION_CREDENTIALS")
-    if not os.path.exists(effective_credentials_path):
-        print(f"Advertencia: El archivo de credenciales JSON especificado por GOOGLE_APPLICATION_CREDENTIALS ('{effective_credentials_path}') no se encontró.")
-    else:
-        print(f"Usando credenciales de servicio desde GOOGLE_APPLICATION_CREDENTIALS: {effective_credentials_path}")
-
-try:
-    api_key_from_env = os.getenv("GOOGLE_API_KEY")
-    if api_key_from_env:
-        genai.configure(api_key=api_key_from_env)
-        print("Usando GOOGLE_API_KEY para configurar Gemini.")
-    elif effective_credentials_path and os.path.exists(effective_credentials_path):
-        genai.configure() 
-        print("Intentando configurar Gemini usando Application Default Credentials (ADC) a través de GOOGLE_APPLICATION_CREDENTIALS.")
-    else:
-        # Fallback a intentar configurar sin nada explícito, puede que funcione si ADC está configurado de otra manera
-        genai.configure()
-        print("Intentando configurar Gemini (puede usar ADC si está disponible de otra forma, o fallará si no hay credenciales).")
-
-except Exception as e:
-    print(f"Error inicial al configurar genai: {e}. El modelo no estará disponible.")
-    # No levantar RuntimeError aquí para permitir que la app inicie y muestre errores en endpoints
-    # modelo_gemini se manejará como None si la configuración falla.
-
-MODEL_NAME = os.getenv("GEMINI_MODEL_NAME", "gemini-1.5-pro-latest") # Usar variable de entorno o default
-SYSTEM_PROMPT_ASISTENTE_NEAE = "Eres un asistente virtual de apoyo docente especializado en Necesidades Específicas de Apoyo Educativo (NEAE) para Andalucía." # Default simple
-RUTA_PROMPT_TXT = os.path.join(script_dir, "prompt.txt")
-if os.path.exists(RUTA_PROMPT_TXT):
-    with open(RUTA_PROMPT_TXT, 'r', encoding='utf-8') as f:
-        SYSTEM_PROMPT_ASISTENTE_NEAE = f.read()
-        print(f"Prompt del sistema cargado desde {RUTA_PROMPT_TXT}")
-
-modelo_gemini = None
-try:
-    # Directly attempt to initialize the model.
-    # genai.configure() should have been called in the preceding block.
-    # If configuration failed, GenerativeModel() will likely raise an error, caught below.
-    modelo_gemini = genai.GenerativeModel(
-        MODEL_NAME
-        # system_instruction=SYSTEM_PROMPT_ASISTENTE_NEAE, # Removed: system_instruction not supported by this version
-        # tools=[GoogleSearchRetrieval()] # Descomentar si se necesita Google Search
-        # safety_settings=SAFETY_SETTINGS # Descomentar y definir si se necesitan ajustes de seguridad
-    )
-    print(f"Modelo Gemini '{MODEL_NAME}' inicializado correctamente.")
-except Exception as e:
-    print(f"Error al inicializar el modelo Gemini '{MODEL_NAME}': {e}")
-    # modelo_gemini will remain None, and endpoints will report 503 if they rely on it.
+# Credenciales, SDK y prompt se resuelven en config.py; el modelo se crea en segundo plano
+# al arrancar (ModelBootstrap), así que importar este módulo no bloquea en llamadas a Gemini
+MODEL_NAME = config.model_name()
+SYSTEM_PROMPT_ASISTENTE_NEAE = config.read_prompt_file() or config.DEFAULT_SYSTEM_PROMPT
+
+# Backend del modelo: Gemini real o, con MODEL_BACKEND=fake, un modelo local determinista para pruebas de carga
+MODEL_BACKEND = os.getenv("MODEL_BACKEND", "gemini").lower()
+model_factory = create_model_factory()
+
+# Entrega del prompt: caché de contexto > system_instruction > historial (fallback)
+prompt_delivery = PromptDelivery(
+    MODEL_NAME,
+    SYSTEM_PROMPT_ASISTENTE_NEAE,
+    mode=os.getenv("PROMPT_DELIVERY", "auto"),
+    cache_model_name=os.getenv("PROMPT_CACHE_MODEL_NAME"),
+    cache_ttl=int(os.getenv("PROMPT_CACHE_TTL", "3600")),
+    model_factory=model_factory,
+)
+
+def initialize_model():
+    """Configure the SDK and create the model for the first prompt delivery mode that works"""
+    if MODEL_BACKEND != "fake":
+        config.configure_genai()
+    # Si la configuración falló, todos los modos fallan y el modelo queda en None (503 en los endpoints)
+    model = prompt_delivery.initialize()
+    if model:
+        logger.info(f"Modelo Gemini '{MODEL_NAME}' inicializado correctamente (backend '{MODEL_BACKEND}').")
+    return model
+
+def warm_up_model():
+    """Tiny call without the system prompt, so the first chat does not pay for connection and auth setup"""
+    model_factory(MODEL_NAME).generate_content("Hola", generation_config={"max_output_tokens": 1})
+
+model_bootstrap = config.ModelBootstrap(
+    initialize_model,
+    warmup=warm_up_model if os.getenv("GEMINI_WARMUP", "").lower() in ("1", "true", "yes") else None,
+)
+
+# Prompt por secciones (PROMPT_SECTIONS_ENABLED=1): cada sesión recibe todas las reglas y solo las secciones opcionales
+# de prompt.txt relevantes para su primera pregunta (no aplica en modo caché, que ya factura el prompt completo a precio reducido)
+prompt_engine = create_prompt_engine(SYSTEM_PROMPT_ASISTENTE_NEAE)
+
+# Catálogo local de recursos con enlaces verificados (resource_catalog.py): los que encajan con la
+# primera pregunta se añaden al prompt de la sesión para que el modelo los cite sin buscarlos
+resource_catalog = create_resource_catalog()
 # --- Fin Configuración del Modelo Gemini ---
 
 app = FastAPI(
@@ -97,91 +100,185 @@ app.add_middleware(
     allow_methods=["*"],
     allow_headers=["*"],
 )
+app.add_middleware(MetricsMiddleware, access_log=os.getenv("ACCESS_LOG", "1").lower() in ("1", "true", "yes"))
+
+# Estáticos del SPA en memoria: URL con hash inmutables, ETag y variantes comprimidas (STATIC_PIPELINE=0: desde disco)
+static_assets = create_static_assets("frontend/static")
+app.mount("/static", static_assets or StaticFiles(directory="frontend/static"), name="static")
+
+def spa_shell(request: Request):
+    """index.html for every SPA route"""
+    if static_assets is None:
+        return FileResponse("frontend/static/index.html")
+    return static_assets.index_response(request)
+
+# Pool acotado para las llamadas bloqueantes al SDK de Gemini, fuera del event loop
+model_pool = ModelCallPool.from_env()
+
+# Cola justa por clave delante del pool: con todos los huecos ocupados, los turnos se reparten en round-robin
+model_scheduler = FairScheduler(
+    model_pool.max_concurrency,
+    model_pool.max_queue,
+    retry_after=model_pool.retry_after,
+    on_wait=metrics.scheduler_queue_wait.observe,
+)
+
+# Enrutado entre modelos (GEMINI_MODELS): nivel rápido para seguimientos cortos, reintentos, hedging y circuit breaker
+model_router = create_model_router(MODEL_NAME)
+
+PROMPT_CACHE_CHECK_INTERVAL = 60  # segundos entre comprobaciones del TTL de la caché del prompt
+
+async def keep_prompt_cache_fresh():
+    while True:
+        await asyncio.sleep(PROMPT_CACHE_CHECK_INTERVAL)
+        try:
+            await asyncio.to_thread(prompt_delivery.refresh_if_needed)
+        except Exception as e:
+            logger.error(f"Error al renovar la caché del prompt: {e}")
 
-app.mount("/static", StaticFiles(directory="frontend/static"), name="static")
+@app.on_event("startup")
+async def start_model_bootstrap():
+    model_bootstrap.start()
+
+@app.on_event("startup")
+async def start_prompt_cache_refresher():
+    # El modo se conoce tras la inicialización en segundo plano; refresh_if_needed no hace nada fuera del modo caché
+    app.state.prompt_cache_task = asyncio.create_task(keep_prompt_cache_fresh())
+
+@app.on_event("shutdown")
+async def shutdown_model_pool():
+    model_pool.shutdown()
 
 # Remove template dependency for pure SPA approach
 # templates = Jinja2Templates(directory="frontend/templates")
 
 # User keys management
-USER_KEYS_FILE = Path(__file__).parent / "user_keys.json"
+USER_KEYS_FILE = Path(os.getenv("USER_KEYS_FILE", Path(__file__).parent / "user_keys.json"))
 
-def load_user_keys():
-    """Load user keys from external JSON file"""
-    try:
-        if USER_KEYS_FILE.exists():
-            with open(USER_KEYS_FILE, 'r', encoding='utf-8') as f:
-                keys_data = json.load(f)
-                print(f"✅ User keys loaded from {USER_KEYS_FILE}")
-                print(f"📊 Found {len(keys_data)} user keys configured")
-                return keys_data
-        else:
-            print(f"⚠️ User keys file not found: {USER_KEYS_FILE}")
-            print("📝 Creating default user keys file...")
-            default_keys = {
-                "supersecretkey": {"count": 0, "max_uses": 100, "user_id": "user1", "description": "Usuario principal"},
-                "anothersecretkey": {"count": 0, "max_uses": 50, "user_id": "user2", "description": "Usuario secundario"}
-            }
-            save_user_keys(default_keys)
-            return default_keys
-    except json.JSONDecodeError as e:
-        print(f"❌ Error parsing user keys JSON: {e}")
-        return {}
-    except Exception as e:
-        print(f"❌ Error loading user keys: {e}")
-        return {}
+# Claves y contadores de uso: user_keys.json con escritura diferida, o SQLite (USER_KEYS_BACKEND=sqlite)
+user_keys = create_key_store(USER_KEYS_FILE)
+
+# Load user keys at startup
+user_keys.load()
+
+# Límites de ritmo por clave (rate_limit_rpm / rate_limit_tpm en el fichero de claves, o RATE_LIMIT_*)
+rate_limiter = create_rate_limiter(user_keys.get, blocking=user_keys.blocking)
+
+@app.on_event("startup")
+async def start_usage_ledger():
+    user_keys.start()
+
+@app.on_event("shutdown")
+async def flush_usage_ledger():
+    user_keys.close()
+
+# Caché opcional de respuestas a la primera pregunta de cada sesión
+response_cache = None
+
+def response_cache_version():
+    """Prompt version for cache keys: prompt.txt, section settings and the loaded resource catalog"""
+    return prompt_version(
+        SYSTEM_PROMPT_ASISTENTE_NEAE
+        + (f"\0{prompt_engine.signature()}" if prompt_engine else "")
+        + (f"\0{resource_catalog.signature()}" if resource_catalog else ""),
+        MODEL_NAME,
+    )
 
-def save_user_keys(keys_data):
-    """Save user keys to external JSON file"""
+first_turn_version = response_cache_version()
+
+if os.getenv("RESPONSE_CACHE_ENABLED", "").lower() in ("1", "true", "yes"):
+    response_cache = ResponseCache(
+        first_turn_version,
+        max_entries=int(os.getenv("RESPONSE_CACHE_MAX_ENTRIES", "500")),
+        ttl=float(os.getenv("RESPONSE_CACHE_TTL", "86400")),
+        persist_path=os.getenv("RESPONSE_CACHE_PATH") or None,
+    )
+
+@app.on_event("shutdown")
+async def persist_response_cache():
+    if response_cache:
+        response_cache.close()
+
+# Primeras preguntas idénticas en curso a la vez (p. ej. un taller entero) comparten una sola llamada al modelo
+single_flight = create_single_flight()
+
+def first_turn_key(pregunta: str) -> str:
+    """Same key as the response cache: prompt/model version plus the normalized question"""
+    return f"{first_turn_version}:{normalize_question(pregunta)}"
+
+# Ventana deslizante / resumen del historial para que cada turno mantenga un coste acotado
+history_policy = create_history_policy(MODEL_NAME, model_factory)
+
+# Almacén acotado y con caducidad para sesiones de chat (memoria o SQLite compartido entre workers)
+chat_sessions = create_session_backend()
+SESSION_SWEEP_INTERVAL = float(os.getenv("SESSION_SWEEP_INTERVAL", "60"))
+
+async def key_io(fn, *args):
+    """Call the key store, in a worker thread when it does disk I/O (SQLite) so the event loop never waits on it"""
+    if user_keys.blocking:
+        # shield: una reserva o devolución ya lanzada termina aunque se cancele la petición
+        return await asyncio.shield(asyncio.to_thread(fn, *args))
+    return fn(*args)
+
+def refund_from_finalizer(loop, auth_key: str):
+    """Give back a reserved use from a weakref finalizer, which cannot await.
+
+    With a blocking key store the refund is handed to the loop's thread pool
+    instead of writing to SQLite on whatever thread collected the object.
+    """
+    if not user_keys.blocking:
+        user_keys.refund(auth_key)
+        return
     try:
-        with open(USER_KEYS_FILE, 'w', encoding='utf-8') as f:
-            json.dump(keys_data, f, indent=4, ensure_ascii=False)
-        print(f"💾 User keys saved to {USER_KEYS_FILE}")
-    except Exception as e:
-        print(f"❌ Error saving user keys: {e}")
-
-def get_user_keys():
-    """Get current user keys, reload if needed"""
-    global fake_keys_db
-    if not fake_keys_db:
-        fake_keys_db = load_user_keys()
-    return fake_keys_db
-
-def reload_user_keys():
-    """Force reload user keys from file"""
-    global fake_keys_db
-    fake_keys_db = load_user_keys()
-    return fake_keys_db
-
-def increment_user_usage(user_key: str):
-    """Increment usage count for a user key and save to file"""
-    global fake_keys_db
-    if user_key in fake_keys_db:
-        fake_keys_db[user_key]["count"] += 1
-        save_user_keys(fake_keys_db)
-        print(f"📈 Usage incremented for key {user_key}: {fake_keys_db[user_key]['count']}/{fake_keys_db[user_key]['max_uses']}")
+        loop.call_soon_threadsafe(loop.run_in_executor, None, user_keys.refund, auth_key)
+    except RuntimeError:
+        user_keys.refund(auth_key)  # Event loop ya cerrado (apagado del servidor)
 
-# Load user keys at startup
-fake_keys_db = load_user_keys()
+async def known_key(auth_key: str | None) -> bool:
+    return bool(auth_key) and await key_io(user_keys.__contains__, auth_key)
+
+async def session_io(fn, *args):
+    """Call the session store, in a worker thread when it does disk I/O (SQLite) so the event loop never waits on it"""
+    if chat_sessions.blocking:
+        return await asyncio.to_thread(fn, *args)
+    return fn(*args)
+
+async def sweep_chat_sessions():
+    while True:
+        await asyncio.sleep(SESSION_SWEEP_INTERVAL)
+        removed = await session_io(chat_sessions.sweep)
+        if removed:
+            logger.info(f"🧹 {removed} sesiones de chat caducadas eliminadas")
+
+@app.on_event("startup")
+async def start_session_sweeper():
+    app.state.session_sweeper_task = asyncio.create_task(sweep_chat_sessions())
 
-chat_sessions = {} # Almacén en memoria para sesiones de chat
+@app.on_event("shutdown")
+async def close_chat_sessions():
+    chat_sessions.close()
+
+# Consultas por lotes (/chat/batch): progreso en memoria para reanudar lotes interrumpidos
+batch_progress = create_batch_progress_store()
+BATCH_MAX_ITEMS = int(os.getenv("BATCH_MAX_ITEMS", "50"))
+BATCH_MAX_CONCURRENCY = int(os.getenv("BATCH_MAX_CONCURRENCY", "4"))
 
 def get_current_user_key(request: Request):
     return request.cookies.get("auth_key")
 
-@app.get("/", response_class=FileResponse)
-async def read_root():
+@app.get("/", response_class=HTMLResponse)
+async def read_root(request: Request):
     # Serve the SPA shell for all routes
-    return FileResponse("frontend/static/index.html")
+    return spa_shell(request)
 
-@app.get("/login", response_class=FileResponse)
-async def login_page_get():
+@app.get("/login", response_class=HTMLResponse)
+async def login_page_get(request: Request):
     # SPA handles all routing, serve the same index.html
-    return FileResponse("frontend/static/index.html")
+    return spa_shell(request)
 
 @app.post("/login")
 async def login_submit(request: Request, key: str = Form(...)):
-    if key in fake_keys_db:
+    if await known_key(key):
         # For SPA, set cookie and return success. Client will re-route.
         response = JSONResponse(content={"message": "Inicio de sesión exitoso. Cookie establecida."})
         response.set_cookie(key="auth_key", value=key)
@@ -190,10 +287,10 @@ async def login_submit(request: Request, key: str = Form(...)):
         # SPA expects a JSON error for failed login
         raise HTTPException(status_code=401, detail="Clave no válida")
 
-@app.get("/chat", response_class=FileResponse)
-async def chat_interface_get():
+@app.get("/chat", response_class=HTMLResponse)
+async def chat_interface_get(request: Request):
     # SPA handles all routing, serve the same index.html
-    return FileResponse("frontend/static/index.html")
+    return spa_shell(request)
 
 @app.get("/logout")
 async def logout(request: Request):
@@ -206,10 +303,10 @@ async def logout(request: Request):
 # New endpoint for SPA to fetch user data
 @app.get("/api/user-data", tags=["User"])
 async def get_user_data(request: Request, auth_key: str = Depends(get_current_user_key)):
-    if not auth_key or auth_key not in fake_keys_db:
+    if not await known_key(auth_key):
         raise HTTPException(status_code=401, detail="No autenticado o clave inválida")
     
-    key_data = fake_keys_db[auth_key]
+    key_data = await key_io(user_keys.get, auth_key)
     return {
         "user_key": auth_key, # Optional: if client needs to be aware of the key itself
         "usage_count": key_data["count"],
@@ -228,104 +325,696 @@ class ChatMessageResponse(BaseModel):
     session_id: str
     respuesta: str
     error: str | None = None
+    usage: dict | None = None
+
+def get_response_text(response):
+    """Extract the text of a Gemini response (or stream chunk), or None if it has none"""
+    # Asegurarse de que response.text exista. Algunos modelos/SDKs pueden tener response.parts[0].text
+    try:
+        if hasattr(response, 'text') and response.text:
+            return response.text
+    except ValueError:
+        pass  # response.text lanza ValueError si el candidato no tiene partes de texto
+    if hasattr(response, 'parts') and response.parts and hasattr(response.parts[0], 'text'):
+        return response.parts[0].text
+    return None
+
+def get_usage(response):
+    """Token counts reported by Gemini in usage_metadata"""
+    metadata = getattr(response, "usage_metadata", None)
+    if not metadata:
+        return None
+    return {
+        "prompt_tokens": getattr(metadata, "prompt_token_count", 0),
+        "response_tokens": getattr(metadata, "candidates_token_count", 0),
+        "cached_tokens": getattr(metadata, "cached_content_token_count", 0),
+        "total_tokens": getattr(metadata, "total_token_count", 0),
+    }
+
+async def check_rate_limit(auth_key: str):
+    """429 with Retry-After when the key exceeds its requests/min or tokens/min"""
+    limited = await rate_limiter.admit(auth_key)
+    if limited:
+        limit, retry_after = limited
+        metrics.rate_limit_rejections.inc(limit=limit)
+        raise HTTPException(
+            status_code=429,
+            detail="Demasiadas consultas seguidas con esta clave. Inténtalo de nuevo en unos segundos.",
+            headers={"Retry-After": str(retry_after)},
+        )
+
+async def require_model():
+    """Wait for the background model initialization; 503 if it failed"""
+    if not await model_bootstrap.wait():
+        raise HTTPException(status_code=503, detail="Servicio de chat no disponible: Modelo no cargado.")
+
+async def validate_chat_message(request: ChatMessageRequest, auth_key: str):
+    """Common checks for /chat/send and /chat/stream; reserves one use and returns the session record"""
+    if not await known_key(auth_key):
+        raise HTTPException(status_code=401, detail="No autenticado o clave inválida")
+
+    record = await session_io(chat_sessions.get, request.session_id, auth_key)
+    if not record:
+        raise HTTPException(status_code=404, detail=f"Sesión de chat '{request.session_id}' no encontrada.")
+    if not request.pregunta or not request.pregunta.strip():
+        raise HTTPException(status_code=400, detail="La pregunta no puede estar vacía.")
+    await require_model()
+    await check_rate_limit(auth_key)
+    # Reserva atómica de un uso antes de llamar al modelo; se devuelve si la llamada falla
+    if not await key_io(user_keys.reserve, auth_key):
+        rate_limiter.release(auth_key)  # Una petición rechazada por cuota no gasta el límite de ritmo
+        metrics.quota_rejections.inc()
+        raise HTTPException(status_code=403, detail="Máximo uso de API alcanzado para esta clave.")
+    return record
+
+async def save_chat_turns(record, chat_session):
+    """Store the history of a ChatSession rebuilt from `record` after a successful turn"""
+    record.history = prompt_delivery.conversation_turns(chat_session)
+    await session_io(chat_sessions.save, record)
+
+async def prepare_history(record) -> int:
+    """Apply the history policy to a session before sending; returns the history's estimated tokens"""
+    if history_policy.needs_compaction(record.history):
+        # Con HISTORY_SUMMARY_MODE=model el resumen se pide al modelo a través del pool, nunca en el event loop
+        summary = await history_policy.summarize(record.history, model_pool.run)
+        record.history = history_policy.compact(record.history, summary)
+    return history_policy.record_turn(record.history)
+
+def session_prompt(record, pregunta: str):
+    """System prompt assembled for this session (sections and catalog resources), or None to send the full prompt"""
+    if prompt_engine is None and resource_catalog is None:
+        return None
+    if record.prompt_selection is None:
+        # Se elige con la primera pregunta y se guarda con la sesión (save_chat_turns)
+        cache_mode = prompt_delivery.mode == "cache"
+        record.prompt_selection = prompt_engine.select(pregunta) if prompt_engine and not cache_mode else {}
+        if resource_catalog:
+            record.prompt_selection["resources"] = resource_catalog.match(pregunta)
+    if prompt_delivery.mode == "cache":
+        return None  # El prompt cacheado no se puede ampliar: los recursos van en el primer turno (model_content)
+    selection = record.prompt_selection
+    prompt = prompt_engine.render(selection) if prompt_engine and "sections" in selection else None
+    resources = resource_catalog.render(selection.get("resources")) if resource_catalog else ""
+    if resources:
+        return f"{prompt or SYSTEM_PROMPT_ASISTENTE_NEAE}\n\n{resources}"
+    return prompt
+
+def model_content(record, pregunta: str) -> str:
+    """Message sent to the model for a turn.
+
+    In cache mode the system prompt is the cached one, so the session's catalog
+    resources (chosen by session_prompt) are put in front of its first question
+    instead, as the console assistant does; they stay in the history from then on.
+    """
+    if prompt_delivery.mode != "cache" or resource_catalog is None or record.history or not record.prompt_selection:
+        return pregunta
+    resources = resource_catalog.render(record.prompt_selection.get("resources"))
+    return f"{resources}\n\n{pregunta}" if resources else pregunta
+
+async def cached_first_answer(record, pregunta: str):
+    """Answer from the response cache when this is the session's first question.
+
+    On a hit the question and answer are appended to the session history, so
+    follow-up turns see the same conversation as if the model had answered.
+    """
+    if response_cache is None or record.history:
+        return None
+    cached = response_cache.get(pregunta)
+    if cached is None:
+        return None
+    # La selección de secciones y recursos se fija con esta primera pregunta, no con la siguiente
+    session_prompt(record, pregunta)
+    record.history = [
+        # Mismo turno de usuario que si hubiera respondido el modelo (en modo caché lleva los recursos del catálogo)
+        {"role": "user", "parts": [model_content(record, pregunta)]},
+        {"role": "model", "parts": [cached["respuesta"]]},
+    ]
+    await session_io(chat_sessions.save, record)
+    return cached["respuesta"]
+
+def cache_first_answer(record, pregunta: str, respuesta: str, usage: dict | None):
+    if response_cache is not None and not record.history:
+        response_cache.put(pregunta, respuesta, usage)
+
+def pool_saturated_exception(e: PoolSaturatedError):
+    return HTTPException(
+        status_code=503,
+        detail="El asistente está atendiendo demasiadas consultas. Inténtalo de nuevo en unos segundos.",
+        headers={"Retry-After": str(e.retry_after)},
+    )
+
+def model_unavailable_exception(retry_after: int):
+    return HTTPException(
+        status_code=503,
+        detail="El modelo de Gemini no está disponible temporalmente. Inténtalo de nuevo en unos segundos.",
+        headers={"Retry-After": str(retry_after)},
+    )
+
+def routed_chat_factory(record, pregunta: str):
+    """start_chat(model_name) callable for the router: a fresh ChatSession rebuilt from the stored history"""
+    system_prompt = session_prompt(record, pregunta)
+    return lambda model_name: prompt_delivery.start_chat(record.history, system_prompt, model_name)
 
 @app.post("/chat/start", response_model=ChatInitResponse, tags=["Chat"])
 async def start_chat_session(auth_key: str = Depends(get_current_user_key)):
-    if not auth_key or auth_key not in fake_keys_db:
+    if not await known_key(auth_key):
         raise HTTPException(status_code=401, detail="No autenticado o clave inválida")
-    if not modelo_gemini:
-        raise HTTPException(status_code=503, detail="Servicio de chat no disponible: Modelo no cargado.")
+    await require_model()
     try:
-        initial_history = [
-            {"role": "user", "parts": [SYSTEM_PROMPT_ASISTENTE_NEAE]},
-            {"role": "model", "parts": ["Entendido. Estoy listo para asistir como un especialista en NEAE para Andalucía."]}
-        ]
-        chat = modelo_gemini.start_chat(history=initial_history)
         session_id = str(uuid.uuid4())
-        chat_sessions[session_id] = chat
+        with span("session_create"):
+            await session_io(chat_sessions.create, session_id, auth_key)
         return ChatInitResponse(
             session_id=session_id,
             message="Hola, soy tu Asistente NEAE. Sesión iniciada."
         )
     except Exception as e:
-        print(f"Error al iniciar sesión de chat: {e}")
+        logger.error(f"Error al iniciar sesión de chat: {e}")
         raise HTTPException(status_code=500, detail=f"Error interno al iniciar el chat: {str(e)}")
 
 @app.post("/chat/send", response_model=ChatMessageResponse, tags=["Chat"])
 async def send_chat_message(request: ChatMessageRequest, auth_key: str = Depends(get_current_user_key)):
-    if not auth_key or auth_key not in fake_keys_db:
-        raise HTTPException(status_code=401, detail="No autenticado o clave inválida")
+    record = await validate_chat_message(request, auth_key)
 
-    key_data = fake_keys_db[auth_key]
-    if key_data["count"] >= key_data["max_uses"]:
-        raise HTTPException(status_code=403, detail="Máximo uso de API alcanzado para esta clave.")
+    charged = False
+    try:
+        cached_answer = await cached_first_answer(record, request.pregunta)
+        if cached_answer is not None:
+            charged = True
+            return ChatMessageResponse(session_id=request.session_id, respuesta=cached_answer)
 
-    chat_session = chat_sessions.get(request.session_id)
-    if not chat_session:
-        raise HTTPException(status_code=404, detail=f"Sesión de chat '{request.session_id}' no encontrada.")
-    if not request.pregunta or not request.pregunta.strip():
-        raise HTTPException(status_code=400, detail="La pregunta no puede estar vacía.")
-    if not modelo_gemini: # Comprobar de nuevo si el modelo está disponible
-        raise HTTPException(status_code=503, detail="Servicio de chat no disponible: Modelo no cargado.")
+        # Se crea antes de la llamada para que cada sesión guarde su selección de prompt aunque no la haga ella
+        chat_factory = routed_chat_factory(record, request.pregunta)
+        content = model_content(record, request.pregunta)
 
-    try:
-        print(f"🤖 Asistente NEAE (API) pensando para sesión {request.session_id}...")
-        response = chat_session.send_message(request.pregunta)
-        # Asegurarse de que response.text exista. Algunos modelos/SDKs pueden tener response.parts[0].text
-        response_text = ""
-        if hasattr(response, 'text') and response.text:
-            response_text = response.text
-        elif hasattr(response, 'parts') and response.parts and hasattr(response.parts[0], 'text'):
-            response_text = response.parts[0].text
+        async def call_model():
+            slot = await model_scheduler.acquire(auth_key)
+            try:
+                # La ChatSession se reconstruye desde el historial serializado en cada turno
+                history_tokens = await prepare_history(record)
+                logger.debug("🤖 Asistente NEAE (API) pensando para sesión %s...", request.session_id)
+                with span("gemini_call", model=True):
+                    routed = await model_router.send(
+                        model_pool,
+                        chat_factory,
+                        content,
+                        record.history,
+                        request_options={"timeout": model_pool.timeout},
+                    )
+            finally:
+                slot.release()
+            return routed, history_tokens
+
+        coalesced = False
+        if single_flight is not None and not record.history:
+            # Primera pregunta: si otra sesión idéntica ya está esperando al modelo, se comparte su respuesta
+            (routed, history_tokens), coalesced = await single_flight.do(first_turn_key(request.pregunta), call_model)
         else:
+            routed, history_tokens = await call_model()
+        response, chat_session = routed.response, routed.chat
+        response_text = get_response_text(response)
+        if response_text is None:
             # Fallback o log de estructura de respuesta inesperada
-            print(f"Respuesta inesperada del modelo: {response}")
+            logger.info(f"Respuesta inesperada del modelo: {response}")
             raise HTTPException(status_code=500, detail="Formato de respuesta inesperado del modelo.")
 
-        increment_user_usage(auth_key)
-        return ChatMessageResponse(session_id=request.session_id, respuesta=response_text)
+        usage = {**(get_usage(response) or {}), "history_tokens": history_tokens, "model": routed.model}
+        if not coalesced:
+            # Antes de guardar el turno: la caché solo guarda respuestas a la primera pregunta (historial vacío)
+            cache_first_answer(record, request.pregunta, response_text, usage)
+        with span("session_save"):
+            if coalesced:
+                # Respuesta compartida: el turno se guarda con la pregunta tal como la escribió este usuario
+                record.history = [
+                    {"role": "user", "parts": [content]},
+                    {"role": "model", "parts": [response_text]},
+                ]
+                await session_io(chat_sessions.save, record)
+            else:
+                await save_chat_turns(record, chat_session)
+        if coalesced:
+            # Los tokens ya los contabilizó la petición que hizo la llamada
+            usage["coalesced"] = True
+            metrics.coalesced_requests.inc()
+        else:
+            prompt_delivery.record_usage(usage)
+            metrics.record_usage(usage)
+        rate_limiter.consume_tokens(auth_key, usage.get("total_tokens"))
+        charged = True
+        return ChatMessageResponse(session_id=request.session_id, respuesta=response_text, usage=usage)
+    except PoolSaturatedError as e:
+        raise pool_saturated_exception(e)
+    except ModelUnavailableError as e:
+        raise model_unavailable_exception(e.retry_after)
+    except TRANSIENT_ERRORS as e:
+        logger.error(f"Gemini sigue fallando tras los reintentos: {e}")
+        raise model_unavailable_exception(model_pool.retry_after)
+    except ModelCallTimeoutError as e:
+        raise HTTPException(status_code=504, detail=str(e))
     except Exception as e:
-        print(f"Error al enviar mensaje a Gemini: {e}")
+        logger.error(f"Error al enviar mensaje a Gemini: {e}")
         # Podrías querer ser más específico con el error aquí
         if isinstance(e, HTTPException): # Re-raise si ya es una HTTPException
              raise
         raise HTTPException(status_code=500, detail=f"Error interno al procesar el mensaje: {str(e)}")
+    finally:
+        if not charged:
+            await key_io(user_keys.refund, auth_key)
+
+def stream_response_chunks(chat_session, pregunta: str, result: dict):
+    """Blocking generator (runs in the model pool) yielding text chunks as Gemini produces them"""
+    response = chat_session.send_message(
+        pregunta,
+        stream=True,
+        request_options={"timeout": model_pool.timeout},
+    )
+    for chunk in response:
+        text = get_response_text(chunk)
+        if text:
+            yield text
+    result["usage"] = {**result.get("usage", {}), **(get_usage(response) or {})}
+
+def sse_event(event: str, data: dict) -> str:
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+@app.post("/chat/stream", tags=["Chat"])
+async def stream_chat_message(request: ChatMessageRequest, auth_key: str = Depends(get_current_user_key)):
+    """Like /chat/send, but streams the answer as Server-Sent Events.
+
+    Emits `chunk` events ({"text": ...}) while the model generates and a final
+    `done` event with usage and error. Usage is only charged when the stream
+    completes successfully.
+    """
+    record = await validate_chat_message(request, auth_key)
+    try:
+        cached_answer = await cached_first_answer(record, request.pregunta)
+    except Exception as e:
+        await key_io(user_keys.refund, auth_key)
+        raise HTTPException(status_code=500, detail=f"Error interno al procesar el mensaje: {str(e)}")
+    if cached_answer is not None:
+        async def cached_stream():
+            yield sse_event("chunk", {"text": cached_answer})
+            yield sse_event("done", {"session_id": request.session_id, "usage": None, "error": None})
+        return StreamingResponse(cached_stream(), media_type="text/event-stream", headers={"Cache-Control": "no-cache"})
+
+    result = {}
+    slot = None
+    try:
+        # El hueco de la cola justa se mantiene hasta que termina el stream
+        slot = await model_scheduler.acquire(auth_key)
+        history_tokens = await prepare_history(record)
+        chat_factory = routed_chat_factory(record, request.pregunta)
+        chunks = model_router.stream(
+            model_pool,
+            chat_factory,
+            stream_response_chunks,
+            model_content(record, request.pregunta),
+            record.history,
+            result,
+        )
+    except BaseException as e:
+        await key_io(user_keys.refund, auth_key)
+        if slot:
+            slot.release()
+        if isinstance(e, PoolSaturatedError):
+            raise pool_saturated_exception(e)
+        if isinstance(e, ModelUnavailableError):
+            raise model_unavailable_exception(e.retry_after)
+        if isinstance(e, Exception):
+            raise HTTPException(status_code=500, detail=f"Error interno al procesar el mensaje: {str(e)}")
+        raise
+
+    async def event_stream():
+        abandoned.detach()  # A partir de aquí el finally del generador libera el hueco y devuelve el uso
+        result.setdefault("usage", {})["history_tokens"] = history_tokens
+        error = None
+        charged = False
+        received_text = []
+        logger.debug("🤖 Asistente NEAE (API) generando en streaming para sesión %s...", request.session_id)
+        stream_start = waiting_since = time.perf_counter()
+        try:
+            try:
+                async for text in chunks:
+                    # Solo cuenta como tiempo de modelo la espera de cada fragmento, no el envío al cliente
+                    now = time.perf_counter()
+                    if not received_text:
+                        metrics.model_time_to_first_chunk.observe(now - stream_start)
+                    metrics.add_model_time(now - waiting_since)
+                    received_text.append(text)
+                    yield sse_event("chunk", {"text": text})
+                    waiting_since = time.perf_counter()
+                if not received_text:
+                    error = "Formato de respuesta inesperado del modelo."
+            except ModelCallTimeoutError as e:
+                error = str(e)
+            except PoolSaturatedError as e:
+                # El pool se llenó entre la comprobación y el primer fragmento
+                error = pool_saturated_exception(e).detail
+            except Exception as e:
+                logger.error(f"Error en streaming con Gemini: {e}")
+                error = f"Error interno al procesar el mensaje: {str(e)}"
+            metrics.add_model_time(time.perf_counter() - waiting_since)
+            metrics.span_duration.observe(time.perf_counter() - stream_start, span="gemini_stream")
+
+            if error is None:
+                result["usage"]["model"] = result["model"]
+                cache_first_answer(record, request.pregunta, "".join(received_text), result.get("usage"))
+                # Un stream interrumpido no se guarda: el turno fallido no entra en el historial
+                with span("session_save"):
+                    await save_chat_turns(record, result["chat"])
+                prompt_delivery.record_usage(result.get("usage"))
+                metrics.record_usage(result.get("usage"))
+                rate_limiter.consume_tokens(auth_key, result["usage"].get("total_tokens"))
+                charged = True
+            yield sse_event("done", {
+                "session_id": request.session_id,
+                "usage": result.get("usage"),
+                "error": error,
+            })
+        finally:
+            # También cubre la desconexión del cliente a mitad del stream
+            slot.release()
+            if not charged:
+                await key_io(user_keys.refund, auth_key)
+
+    loop = asyncio.get_running_loop()
+
+    def release_unstarted():
+        slot.release()
+        refund_from_finalizer(loop, auth_key)
+
+    body = event_stream()
+    # Si el cliente se va antes de que empiece el cuerpo, el generador nunca llega a su finally: se libera
+    # el hueco de la cola justa y se devuelve el uso reservado (chunks no toma nada del pool hasta iterarse)
+    abandoned = weakref.finalize(body, release_unstarted)
+    return StreamingResponse(
+        body,
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+async def answer_batch_item(auth_key: str, batch_id: str, item):
+    """Answer one batch question as a standalone first turn; returns its NDJSON line.
+
+    Each item reserves one use before calling the model and gets it back if the
+    call fails, exactly like /chat/send. Errors are reported in the line instead
+    of aborting the batch.
+    """
+    line = {"type": "item", "id": item.id}
+    # En un lote, superar el límite de ritmo no es un error: la pregunta espera su turno
+    await rate_limiter.throttle(auth_key)
+    if not await key_io(user_keys.reserve, auth_key):
+        rate_limiter.release(auth_key)
+        metrics.quota_rejections.inc()
+        return {**line, "status": "error", "error": "Máximo uso de API alcanzado para esta clave."}
+    charged = False
+    try:
+        cached = response_cache.get(item.pregunta) if response_cache is not None else None
+        if cached is not None:
+            charged = True
+            return {**line, "status": "ok", "respuesta": cached["respuesta"], "usage": None}
+
+        # Sesión efímera: cada pregunta del lote es una conversación nueva que no se guarda
+        record = SessionRecord(f"batch-{batch_id}-{item.id}", auth_key)
+        chat_factory = routed_chat_factory(record, item.pregunta)
+        slot = await model_scheduler.acquire(auth_key)
+        try:
+            with span("gemini_call", model=True):
+                routed = await model_router.send(
+                    model_pool,
+                    chat_factory,
+                    model_content(record, item.pregunta),
+                    record.history,
+                    request_options={"timeout": model_pool.timeout},
+                )
+        finally:
+            slot.release()
+        response_text = get_response_text(routed.response)
+        if response_text is None:
+            logger.info(f"Respuesta inesperada del modelo: {routed.response}")
+            return {**line, "status": "error", "error": "Formato de respuesta inesperado del modelo."}
+
+        usage = {**(get_usage(routed.response) or {}), "model": routed.model}
+        cache_first_answer(record, item.pregunta, response_text, usage)
+        prompt_delivery.record_usage(usage)
+        metrics.record_usage(usage)
+        rate_limiter.consume_tokens(auth_key, usage.get("total_tokens"))
+        charged = True
+        return {**line, "status": "ok", "respuesta": response_text, "usage": usage}
+    except PoolSaturatedError as e:
+        return {**line, "status": "error", "error": pool_saturated_exception(e).detail}
+    except (ModelUnavailableError, *TRANSIENT_ERRORS) as e:
+        logger.error(f"Gemini no disponible para la pregunta '{item.id}' del lote {batch_id}: {e}")
+        return {**line, "status": "error", "error": model_unavailable_exception(model_pool.retry_after).detail}
+    except ModelCallTimeoutError as e:
+        return {**line, "status": "error", "error": str(e)}
+    except Exception as e:
+        logger.error(f"Error en la pregunta '{item.id}' del lote {batch_id}: {e}")
+        return {**line, "status": "error", "error": f"Error interno al procesar el mensaje: {str(e)}"}
+    finally:
+        if not charged:
+            await key_io(user_keys.refund, auth_key)
+
+def ndjson_line(data: dict) -> str:
+    return json.dumps(data, ensure_ascii=False) + "\n"
+
+@app.post("/chat/batch", tags=["Chat"])
+async def batch_chat(request: Request, auth_key: str = Depends(get_current_user_key)):
+    """Answer a list of independent questions concurrently, streaming NDJSON in completion order.
+
+    The body is either JSON ({"preguntas": [...], "batch_id": ...}) or JSONL
+    (one question per line, batch_id in the query string); each question is a
+    string or {"id", "pregunta"}. The stream starts with a `batch` line carrying
+    the batch_id, then one `item` line per question and a final `done` line.
+    Sending the same batch_id again resumes it: completed items are replayed
+    (marked `resumed`) without charging again and only the rest are run.
+    """
+    if not await known_key(auth_key):
+        raise HTTPException(status_code=401, detail="No autenticado o clave inválida")
+    await require_model()
+
+    batch_id = request.query_params.get("batch_id") or None
+    try:
+        body = (await request.body()).decode("utf-8")
+        if request.headers.get("content-type", "").startswith("application/json"):
+            payload = json.loads(body)
+            if not isinstance(payload, dict):
+                raise ValueError("se esperaba un objeto con 'preguntas'.")
+            raw_items = payload.get("preguntas")
+            batch_id = payload.get("batch_id") or batch_id
+        else:
+            # application/x-ndjson, application/jsonl o text/plain: una pregunta por línea
+            raw_items = parse_jsonl(body)
+        items = parse_batch_items(raw_items, BATCH_MAX_ITEMS)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=f"Lote no válido: {e}")
+
+    try:
+        progress = batch_progress.open(batch_id, auth_key, len(items))
+    except KeyError:
+        raise HTTPException(status_code=404, detail=f"Lote '{batch_id}' no encontrado o caducado.")
+    except RuntimeError:
+        raise HTTPException(status_code=409, detail=f"El lote '{batch_id}' ya se está procesando.")
+
+    pending = [item for item in items if item.id not in progress.results]
+
+    async def batch_stream():
+        abandoned.detach()  # A partir de aquí el finally del generador cierra el lote
+        completed = failed = 0
+        try:
+            yield ndjson_line({
+                "type": "batch", "batch_id": progress.batch_id, "total": len(items),
+                "pending": len(pending), "resumed": len(items) - len(pending),
+            })
+            for item in items:
+                if item.id in progress.results:
+                    completed += 1
+                    yield ndjson_line({**progress.results[item.id], "resumed": True})
+            logger.info(f"📦 Lote {progress.batch_id}: {len(pending)} preguntas pendientes de {len(items)}")
+            async for item, line in run_batch(
+                    pending, lambda item: answer_batch_item(auth_key, progress.batch_id, item), BATCH_MAX_CONCURRENCY):
+                metrics.batch_items.inc(status=line["status"])
+                if line["status"] == "ok":
+                    completed += 1
+                    batch_progress.record(progress, item.id, line)
+                else:
+                    failed += 1
+                yield ndjson_line(line)
+            yield ndjson_line({"type": "done", "batch_id": progress.batch_id, "completed": completed, "failed": failed})
+        finally:
+            # También cubre la desconexión del cliente: lo completado queda guardado para reanudar
+            batch_progress.close(progress)
+
+    body = batch_stream()
+    # Si el cliente se va antes de que empiece el cuerpo, el generador nunca llega a su finally y
+    # el lote quedaría "en curso" para siempre (409 en cada reintento)
+    abandoned = weakref.finalize(body, batch_progress.close, progress)
+    return StreamingResponse(
+        body,
+        media_type="application/x-ndjson",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
 
 # Admin endpoints for user key management
 @app.post("/admin/reload-keys", tags=["Admin"])
 async def reload_keys():
-    """Reload user keys from the configuration file"""
+    """Apply the entries added, edited or removed in the keys file, keeping in-flight usage counts"""
     try:
-        new_keys = reload_user_keys()
+        changes = await asyncio.to_thread(user_keys.reload)
         return {
             "message": "Claves de usuario recargadas exitosamente",
-            "keys_count": len(new_keys),
-            "keys": list(new_keys.keys())
+            "keys_count": await key_io(user_keys.__len__),
+            **changes,
         }
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error al recargar claves: {str(e)}")
 
 @app.get("/admin/keys-status", tags=["Admin"])
-async def get_keys_status():
-    """Get current status of all user keys"""
+async def get_keys_status(
+    cursor: str | None = Query(None, description="next_cursor de la página anterior"),
+    limit: int = Query(100, ge=1, le=1000),
+    min_usage: float | None = Query(None, ge=0, description="Solo claves con al menos este porcentaje de uso"),
+    user_id_prefix: str | None = Query(None, description="Solo claves cuyo user_id empieza así"),
+):
+    """Get a page of user keys (in key order) and the totals over all of them"""
     try:
+        entries, next_cursor = await key_io(user_keys.page, cursor, limit, min_usage, user_id_prefix)
         keys_status = {}
-        for key, data in fake_keys_db.items():            keys_status[key] = {
+        for key, data in entries:
+            keys_status[key] = {
                 "user_id": data.get("user_id", "desconocido"),
                 "description": data.get("description", "Sin descripción"),
                 "usage_count": data["count"],
                 "max_uses": data["max_uses"],
-                "usage_percentage": round((data["count"] / data["max_uses"]) * 100, 1),
-                "remaining_uses": data["max_uses"] - data["count"]
+                "usage_percentage": usage_percentage(data),
+                "remaining_uses": max(data["max_uses"] - data["count"], 0)
             }
+        totals = await key_io(user_keys.totals)
         return {
-            "total_keys": len(fake_keys_db),
+            "total_keys": totals["keys"],
+            "totals": totals,
             "keys_file": str(USER_KEYS_FILE),
-            "keys_status": keys_status
+            "keys_status": keys_status,
+            "next_cursor": next_cursor,
         }
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error al obtener estado de claves: {str(e)}")
 
+@app.get("/ready", tags=["Admin"])
+async def readiness():
+    """Readiness probe: 200 once the model is initialized (and warmed up), 503 before that or if it failed"""
+    status = {
+        "ready": model_bootstrap.ready,
+        "backend": MODEL_BACKEND,
+        "model": {"name": MODEL_NAME, "prompt_delivery": prompt_delivery.mode, **model_bootstrap.status()},
+        "prompt": {
+            "source": config.PROMPT_PATH if config.read_prompt_file() else "default",
+            "chars": len(SYSTEM_PROMPT_ASISTENTE_NEAE),
+            "sections": len(prompt_engine.sections) if prompt_engine else None,
+        },
+    }
+    return JSONResponse(content=status, status_code=200 if status["ready"] else 503)
+
+@app.get("/admin/prompt-status", tags=["Admin"])
+async def get_prompt_status():
+    """Get how the system prompt is delivered and the input tokens it saves"""
+    return {
+        **prompt_delivery.stats(),
+        "sections": prompt_engine.stats() if prompt_engine else {"enabled": False},
+    }
+
+@app.get("/admin/resource-catalog", tags=["Admin"])
+async def get_resource_catalog_status():
+    """Get how many verified resources are loaded, link health and how often they are injected"""
+    if resource_catalog is None:
+        return {"enabled": False}
+    return resource_catalog.stats()
+
+@app.post("/admin/resource-catalog/reload", tags=["Admin"])
+async def reload_resource_catalog():
+    """Reload the verified resources after an import or link check"""
+    global first_turn_version
+    if resource_catalog is None:
+        raise HTTPException(status_code=404, detail="El catálogo de recursos no está activado")
+    loaded = await asyncio.to_thread(resource_catalog.load)
+    first_turn_version = response_cache_version()
+    if response_cache:
+        response_cache.version = first_turn_version  # Las respuestas guardadas citaban el catálogo anterior
+    return {"message": "Catálogo de recursos recargado", "loaded": loaded}
+
+@app.get("/admin/sessions-status", tags=["Admin"])
+async def get_sessions_status():
+    """Get size, limits and eviction counts of the chat session store"""
+    return await session_io(chat_sessions.stats)
+
+@app.get("/admin/usage-ledger", tags=["Admin"])
+async def get_usage_ledger_status():
+    """Get the key store backend and its write / reservation counters"""
+    return await key_io(user_keys.stats)
+
+@app.get("/admin/response-cache", tags=["Admin"])
+async def get_response_cache_status():
+    """Get hit/miss counters of the first-turn response cache"""
+    if response_cache is None:
+        return {"enabled": False}
+    return response_cache.stats()
+
+@app.get("/admin/history-policy", tags=["Admin"])
+async def get_history_policy_status():
+    """Get the history token budget and how often sessions have been compacted"""
+    return history_policy.stats()
+
+@app.get("/admin/batches", tags=["Admin"])
+async def get_batches_status():
+    """Get how many batches are kept for resuming and how many are running"""
+    return {**batch_progress.stats(), "max_items": BATCH_MAX_ITEMS, "max_concurrency": BATCH_MAX_CONCURRENCY}
+
+@app.get("/admin/single-flight", tags=["Admin"])
+async def get_single_flight_status():
+    """Get how many identical first questions shared an in-flight model call"""
+    if single_flight is None:
+        return {"enabled": False}
+    return single_flight.stats()
+
+@app.get("/admin/model-router", tags=["Admin"])
+async def get_model_router_status():
+    """Get per-model latency, error rate and circuit breaker state used for routing"""
+    return model_router.stats()
+
+@app.get("/admin/rate-limits", tags=["Admin"])
+async def get_rate_limits_status():
+    """Get per-key rate limit settings and rejections, and the fair scheduler queue"""
+    return {"rate_limits": rate_limiter.stats(), "scheduler": model_scheduler.stats()}
+
+@app.get("/admin/static-assets", tags=["Admin"])
+async def get_static_assets_status():
+    """Get how many static files are served from memory and their compressed sizes"""
+    if static_assets is None:
+        return {"enabled": False}
+    return static_assets.stats()
+
+@app.get("/admin/model-pool", tags=["Admin"])
+async def get_model_pool_status():
+    """Get current load of the Gemini worker pool"""
+    return model_pool.stats()
+
+metrics.registry.gauge(
+    "chat_sessions_active", "Sesiones de chat abiertas en el almacén",
+    callback=lambda: chat_sessions.stats()["sessions"])
+metrics.registry.gauge(
+    "gemini_scheduler_queued", "Peticiones esperando turno en la cola justa por clave",
+    callback=lambda: model_scheduler.stats()["queued"])
+metrics.registry.gauge(
+    "gemini_pool_requests", "Llamadas al modelo en curso o en cola", ("state",),
+    callback=lambda: {state: model_pool.stats()[state] for state in ("running", "queued")})
+
+@app.get("/metrics", response_class=PlainTextResponse, tags=["Admin"])
+async def get_metrics():
+    """Prometheus metrics: latency per endpoint, model time, tokens, sessions and pool load"""
+    # Los gauges leen el almacén de sesiones (SQLite incluido): se renderiza fuera del event loop
+    body = await asyncio.to_thread(metrics.registry.render)
+    return PlainTextResponse(body, media_type="text/plain; version=0.0.4")
+
 # Debug endpoint to test logout button issues
 @app.get("/debug/elements", tags=["Debug"])
 async def debug_elements():
@@ -342,4 +1031,5 @@ async def debug_elements():
     }
 
 if __name__ == "__main__":
+    import uvicorn
     uvicorn.run(app, host="0.0.0.0", port=8000)
\ No newline at end of file
@@ -0,0 +1,355 @@
+import bisect
+import contextvars
+import hashlib
+import json
+import logging
+import re
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 40, 60, 120)
+TOKEN_BUCKETS = (100, 500, 1000, 2500, 5000, 10000, 20000, 40000, 80000)
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_labels(labelnames, labelvalues, extra=()):
+    pairs = list(zip(labelnames, labelvalues)) + list(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in pairs) + "}"
+
+
+def _format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class _Metric:
+    kind = None
+
+    def __init__(self, name: str, documentation: str, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+
+    def _key(self, labels):
+        if set(labels) != set(self.labelnames):
+            raise ValueError(f"{self.name} espera las etiquetas {self.labelnames}, recibió {tuple(labels)}")
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        lines.extend(self._samples())
+        return "\n".join(lines)
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._values = {}
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels):
+        with self._lock:
+            return self._values.get(self._key(labels), 0)
+
+    def _samples(self):
+        with self._lock:
+            items = sorted(self._values.items())
+        return [f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}" for key, value in items]
+
+
+class Gauge(_Metric):
+    """Gauge whose value is either set explicitly or read from a callback at scrape time"""
+
+    kind = "gauge"
+
+    def __init__(self, *args, callback=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._values = {}
+        self._callback = callback
+
+    def set(self, value: float, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+    def _samples(self):
+        if self._callback is not None:
+            try:
+                value = self._callback()
+            except Exception:
+                return []
+            values = value if isinstance(value, dict) else {(): value}
+            return [f"{self.name}{_format_labels(self.labelnames, key if isinstance(key, tuple) else (key,))} {_format_value(v)}"
+                    for key, v in sorted(values.items())]
+        with self._lock:
+            items = sorted(self._values.items())
+        return [f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}" for key, value in items]
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, *args, buckets=DEFAULT_BUCKETS, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.buckets = tuple(sorted(buckets))
+        self._series = {}
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = {"buckets": [0] * len(self.buckets), "sum": 0.0, "count": 0}
+            index = bisect.bisect_left(self.buckets, value)
+            if index < len(self.buckets):
+                series["buckets"][index] += 1
+            series["sum"] += value
+            series["count"] += 1
+
+    def _samples(self):
+        lines = []
+        with self._lock:
+            items = sorted((key, dict(series, buckets=list(series["buckets"]))) for key, series in self._series.items())
+        for key, series in items:
+            cumulative = 0
+            for bound, count in zip(self.buckets, series["buckets"]):
+                cumulative += count
+                lines.append(f"{self.name}_bucket{_format_labels(self.labelnames, key, [('le', _format_value(float(bound)))])} {cumulative}")
+            lines.append(f"{self.name}_bucket{_format_labels(self.labelnames, key, [('le', '+Inf')])} {series['count']}")
+            lines.append(f"{self.name}_sum{_format_labels(self.labelnames, key)} {_format_value(series['sum'])}")
+            lines.append(f"{self.name}_count{_format_labels(self.labelnames, key)} {series['count']}")
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = []
+
+    def register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def counter(self, name, documentation, labelnames=()):
+        return self.register(Counter(name, documentation, labelnames))
+
+    def gauge(self, name, documentation, labelnames=(), callback=None):
+        return self.register(Gauge(name, documentation, labelnames, callback=callback))
+
+    def histogram(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        return self.register(Histogram(name, documentation, labelnames, buckets=buckets))
+
+    def render(self) -> str:
+        """All metrics in Prometheus text exposition format (version 0.0.4)"""
+        return "\n".join(metric.render() for metric in self._metrics) + "\n"
+
+
+registry = Registry()
+
+http_request_duration = registry.histogram(
+    "http_request_duration_seconds", "Latencia de las peticiones HTTP hasta el último byte",
+    ("method", "endpoint", "status"))
+http_request_overhead = registry.histogram(
+    "http_request_overhead_seconds", "Tiempo de servidor por petición descontando la espera al modelo",
+    ("endpoint",))
+span_duration = registry.histogram(
+    "span_duration_seconds", "Duración de tramos instrumentados explícitamente", ("span",))
+model_time_to_first_chunk = registry.histogram(
+    "gemini_time_to_first_chunk_seconds", "Tiempo hasta el primer fragmento en /chat/stream")
+model_tokens = registry.counter(
+    "gemini_tokens_total", "Tokens informados por usage_metadata", ("kind",))
+model_prompt_tokens = registry.histogram(
+    "gemini_prompt_tokens", "Tokens de entrada por llamada al modelo", buckets=TOKEN_BUCKETS)
+model_response_tokens = registry.histogram(
+    "gemini_response_tokens", "Tokens de salida por llamada al modelo", buckets=TOKEN_BUCKETS)
+model_requests = registry.counter(
+    "gemini_model_requests_total", "Llamadas a cada modelo de Gemini por resultado", ("model", "outcome"))
+model_hedges = registry.counter(
+    "gemini_hedged_requests_total", "Peticiones duplicadas en el modelo de respaldo por lentitud")
+batch_items = registry.counter(
+    "chat_batch_items_total", "Preguntas procesadas en /chat/batch por resultado", ("status",))
+scheduler_queue_wait = registry.histogram(
+    "gemini_scheduler_queue_wait_seconds", "Espera en la cola justa por clave antes de llamar al modelo")
+rate_limit_rejections = registry.counter(
+    "rate_limit_rejections_total", "Peticiones rechazadas con 429 por límite de ritmo", ("limit",))
+coalesced_requests = registry.counter(
+    "chat_coalesced_requests_total", "Primeras preguntas respondidas con la llamada en curso de otra sesión idéntica")
+quota_rejections = registry.counter(
+    "quota_rejections_total", "Peticiones rechazadas por haber agotado el máximo de usos")
+
+# Tiempo de modelo acumulado por la petición en curso (lo lee el middleware)
+_model_time = contextvars.ContextVar("model_time", default=None)
+# Identificador de la petición en curso: se añade a cada línea de log que se escribe mientras se atiende
+_request_id = contextvars.ContextVar("request_id", default=None)
+REQUEST_ID_RE = re.compile(r"^[\w.:-]{1,64}$")
+
+access_logger = logging.getLogger("asistente_neae.access")
+
+
+class RequestContextFilter(logging.Filter):
+    """Adds `request_id` (or "-") to every record, for both log formats"""
+
+    def filter(self, record):
+        record.request_id = _request_id.get() or "-"
+        return True
+
+
+class TextLogFormatter(logging.Formatter):
+    """Plain text line followed by the record's structured `fields` as key=value pairs"""
+
+    def format(self, record):
+        line = super().format(record)
+        fields = getattr(record, "fields", None)
+        if fields:
+            line += " " + " ".join(f"{name}={value}" for name, value in fields.items())
+        return line
+
+
+class JsonLogFormatter(logging.Formatter):
+    """One JSON object per line with time, level, logger, message, request_id and the record's `fields`"""
+
+    def format(self, record):
+        entry = {
+            "time": self.formatTime(record),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+            "request_id": getattr(record, "request_id", "-"),
+            **getattr(record, "fields", {}),
+        }
+        if record.exc_info:
+            entry["exc_info"] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+def configure_logging(level: str = "INFO", log_format: str = "text"):
+    """Root handler with the request id on every line: LOG_FORMAT=text (key=value fields) or json"""
+    handler = logging.StreamHandler()
+    handler.addFilter(RequestContextFilter())
+    if log_format == "json":
+        handler.setFormatter(JsonLogFormatter())
+    else:
+        handler.setFormatter(TextLogFormatter("%(asctime)s %(levelname)s %(name)s [%(request_id)s]: %(message)s"))
+    logging.basicConfig(level=level.upper(), handlers=[handler])
+
+
+def key_fingerprint(key: str | None) -> str:
+    """Short, non-reversible identifier of a user key for logs (never the key itself)"""
+    return hashlib.sha256(key.encode("utf-8")).hexdigest()[:12] if key else "-"
+
+
+def _header(scope, name: bytes) -> str | None:
+    for header, value in scope.get("headers", ()):
+        if header == name:
+            return value.decode("latin-1")
+    return None
+
+
+def _cookie(scope, name: str) -> str | None:
+    for pair in (_header(scope, b"cookie") or "").split(";"):
+        cookie, _, value = pair.strip().partition("=")
+        if cookie == name:
+            return value
+    return None
+
+
+@contextmanager
+def span(name: str, model: bool = False):
+    """Time a block; with model=True the time also counts as model time for the current request"""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        span_duration.observe(elapsed, span=name)
+        if model:
+            add_model_time(elapsed)
+
+
+def add_model_time(seconds: float):
+    holder = _model_time.get()
+    if holder is not None:
+        holder[0] += seconds
+
+
+def record_usage(usage: dict | None):
+    if not usage:
+        return
+    for kind in ("prompt_tokens", "response_tokens", "cached_tokens"):
+        if usage.get(kind):
+            model_tokens.inc(usage[kind], kind=kind.removesuffix("_tokens"))
+    if usage.get("prompt_tokens"):
+        model_prompt_tokens.observe(usage["prompt_tokens"])
+    if usage.get("response_tokens"):
+        model_response_tokens.observe(usage["response_tokens"])
+
+
+class MetricsMiddleware:
+    """ASGI middleware recording per-endpoint latency (until the last body byte, so
+    streaming responses are measured in full) and server overhead vs. model time.
+
+    Each request gets an id (the client's X-Request-ID if valid, or a new one),
+    returned in the X-Request-ID header and attached to every log line written
+    while it is handled. When it finishes, one structured access record is
+    logged with the id, method, endpoint, status, latency, model time and a
+    fingerprint of the user key.
+    """
+
+    def __init__(self, app, access_log: bool = True):
+        self.app = app
+        self.access_log = access_log
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        start = time.perf_counter()
+        holder = [0.0]
+        token = _model_time.set(holder)
+        request_id = _header(scope, b"x-request-id")
+        if not request_id or not REQUEST_ID_RE.match(request_id):
+            request_id = uuid.uuid4().hex
+        request_token = _request_id.set(request_id)
+        status = {"code": 500}
+
+        async def send_wrapper(message):
+            if message["type"] == "http.response.start":
+                status["code"] = message["status"]
+                message = {**message, "headers": [*message.get("headers", []), (b"x-request-id", request_id.encode("latin-1"))]}
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            _model_time.reset(token)
+            elapsed = time.perf_counter() - start
+            # Plantilla de la ruta (p. ej. /static/{path}) para no disparar la cardinalidad
+            route = scope.get("route")
+            endpoint = getattr(route, "path", None) or "unmatched"
+            http_request_duration.observe(elapsed, method=scope["method"], endpoint=endpoint, status=status["code"])
+            http_request_overhead.observe(max(elapsed - holder[0], 0.0), endpoint=endpoint)
+            if self.access_log:
+                access_logger.info("request", extra={"fields": {
+                    "method": scope["method"],
+                    "endpoint": endpoint,
+                    "path": scope["path"],
+                    "status": status["code"],
+                    "latency_ms": round(elapsed * 1000, 1),
+                    "model_ms": round(holder[0] * 1000, 1),
+                    "key": key_fingerprint(_cookie(scope, "auth_key")),
+                }})
+            _request_id.reset(request_token)
@@ -0,0 +1,127 @@
+import hashlib
+import os
+import time
+
+from config import get_genai
+
+FAKE_VOCABULARY = (
+    "alumnado", "adaptación", "curricular", "NEAE", "apoyo", "docente", "aula", "evaluación",
+    "orientación", "medidas", "atención", "diversidad", "recursos", "etapa", "Andalucía", "programa",
+    "refuerzo", "inclusión", "familia", "tutoría", "objetivos", "competencias", "seguimiento", "centro",
+)
+
+
+def estimate_text_tokens(text: str) -> int:
+    return max(1, len(text) // 4)
+
+
+class FakeUsageMetadata:
+    def __init__(self, prompt_tokens: int, response_tokens: int):
+        self.prompt_token_count = prompt_tokens
+        self.candidates_token_count = response_tokens
+        self.cached_content_token_count = 0
+        self.total_token_count = prompt_tokens + response_tokens
+
+
+class FakeResponse:
+    """Mimics a GenerateContentResponse: `text`, `usage_metadata` and iteration over stream chunks"""
+
+    def __init__(self, text: str, usage_metadata=None, chunks=None):
+        self.text = text
+        self.parts = []
+        self.usage_metadata = usage_metadata
+        self._chunks = chunks
+
+    def __iter__(self):
+        if self._chunks is None:
+            yield self
+            return
+        yield from self._chunks
+
+
+class FakeChatSession:
+    """In-process stand-in for genai.ChatSession with deterministic answers and simulated latency"""
+
+    def __init__(self, model, history=None):
+        self.model = model
+        self.history = list(history or [])
+
+    def send_message(self, content, stream: bool = False, request_options=None, **kwargs):
+        model = self.model
+        text = model.answer_for(content)
+        prompt_tokens = estimate_text_tokens(model.system_instruction or "") + estimate_text_tokens(content) + sum(
+            estimate_text_tokens(part) for turn in self.history for part in turn["parts"])
+        usage = FakeUsageMetadata(prompt_tokens, estimate_text_tokens(text))
+        turns = [{"role": "user", "parts": [content]}, {"role": "model", "parts": [text]}]
+        time.sleep(model.latency)
+        if not stream:
+            time.sleep(usage.candidates_token_count / model.tokens_per_second)
+            self.history.extend(turns)
+            return FakeResponse(text, usage)
+
+        def chunks():
+            step = model.chunk_tokens * 4
+            for start in range(0, len(text), step):
+                piece = text[start:start + step]
+                time.sleep(estimate_text_tokens(piece) / model.tokens_per_second)
+                yield FakeResponse(piece)
+            # Igual que el SDK: el turno entra en el historial al consumir el stream completo
+            self.history.extend(turns)
+
+        return FakeResponse(text, usage, chunks())
+
+
+class FakeGenerativeModel:
+    """Local replacement for genai.GenerativeModel used for load tests and benchmarks.
+
+    Answers are derived from a hash of the question, so the same question always
+    gets the same answer. Each call waits `latency` seconds (time to first token)
+    and then `tokens_per_second` for its ~`response_tokens` tokens; streaming
+    responses are cut into chunks of `chunk_tokens` tokens.
+    """
+
+    def __init__(self, model_name: str = "fake", system_instruction: str | None = None, latency: float = 0.2,
+                 tokens_per_second: float = 200, response_tokens: int = 150, chunk_tokens: int = 16):
+        self.model_name = model_name
+        self.system_instruction = system_instruction
+        self.latency = latency
+        self.tokens_per_second = tokens_per_second
+        self.response_tokens = response_tokens
+        self.chunk_tokens = max(1, chunk_tokens)
+
+    def answer_for(self, question: str) -> str:
+        digest = hashlib.sha256(question.encode("utf-8")).digest()
+        words = []
+        while estimate_text_tokens(" ".join(words)) < self.response_tokens:
+            words.append(FAKE_VOCABULARY[digest[len(words) % len(digest)] % len(FAKE_VOCABULARY)])
+        return f"Respuesta simulada a «{question[:80]}»: " + " ".join(words) + "."
+
+    def start_chat(self, history=None):
+        return FakeChatSession(self, history)
+
+    def generate_content(self, contents, **kwargs):
+        return FakeChatSession(self).send_message(contents if isinstance(contents, str) else str(contents))
+
+
+def gemini_model(model_name, **kwargs):
+    """genai.GenerativeModel, importing the SDK only when the first model is built"""
+    return get_genai().GenerativeModel(model_name, **kwargs)
+
+
+def create_model_factory():
+    """Model constructor selected by MODEL_BACKEND: genai.GenerativeModel or the local fake"""
+    backend = os.getenv("MODEL_BACKEND", "gemini").lower()
+    if backend != "fake":
+        return gemini_model
+
+    def fake_model(model_name, system_instruction=None):
+        return FakeGenerativeModel(
+            model_name,
+            system_instruction=system_instruction,
+            latency=float(os.getenv("FAKE_MODEL_LATENCY", "0.2")),
+            tokens_per_second=float(os.getenv("FAKE_MODEL_TOKENS_PER_SECOND", "200")),
+            response_tokens=int(os.getenv("FAKE_MODEL_RESPONSE_TOKENS", "150")),
+            chunk_tokens=int(os.getenv("FAKE_MODEL_CHUNK_TOKENS", "16")),
+        )
+
+    return fake_model
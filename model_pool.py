@@ -0,0 +1,176 @@
+import asyncio
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+
+class PoolSaturatedError(Exception):
+    """Raised when the pool already has as many calls in flight and queued as it accepts"""
+
+    def __init__(self, retry_after: int):
+        super().__init__("Cola de peticiones al modelo llena")
+        self.retry_after = retry_after
+
+
+class ModelCallTimeoutError(Exception):
+    """Raised when a model call exceeds the per-request timeout"""
+
+
+class ModelCallPool:
+    """Bounded thread pool that runs blocking Gemini SDK calls off the event loop.
+
+    At most `max_concurrency` calls run at once, at most `max_queue` more wait for
+    a free worker, and anything beyond that is rejected with PoolSaturatedError so
+    the endpoint can answer 503 + Retry-After instead of piling up requests.
+    """
+
+    def __init__(self, max_concurrency: int = 8, max_queue: int = 32,
+                 timeout: float = 120.0, retry_after: int = 5):
+        self.max_concurrency = max_concurrency
+        self.max_queue = max_queue
+        self.timeout = timeout
+        self.retry_after = retry_after
+        self._executor = ThreadPoolExecutor(max_workers=max_concurrency, thread_name_prefix="gemini")
+        self._lock = threading.Lock()
+        self._pending = 0
+        self._running = 0
+        self._rejected = 0
+        self._timed_out = 0
+        self._completed = 0
+        self._failed = 0
+
+    @classmethod
+    def from_env(cls):
+        return cls(
+            max_concurrency=int(os.getenv("GEMINI_MAX_CONCURRENCY", "8")),
+            max_queue=int(os.getenv("GEMINI_MAX_QUEUE", "32")),
+            timeout=float(os.getenv("GEMINI_REQUEST_TIMEOUT", "120")),
+            retry_after=int(os.getenv("GEMINI_RETRY_AFTER", "5")),
+        )
+
+    def check_capacity(self):
+        """Raise PoolSaturatedError if a call started now would be rejected (reserves nothing)"""
+        with self._lock:
+            if self._pending >= self.max_concurrency + self.max_queue:
+                self._rejected += 1
+                raise PoolSaturatedError(self.retry_after)
+
+    def _acquire(self):
+        with self._lock:
+            if self._pending >= self.max_concurrency + self.max_queue:
+                self._rejected += 1
+                raise PoolSaturatedError(self.retry_after)
+            self._pending += 1
+
+    def _release(self, future):
+        with self._lock:
+            self._pending -= 1
+            if future is not None and not future.cancelled() and future.exception() is None:
+                self._completed += 1
+            else:
+                self._failed += 1
+
+    def _tracked(self, fn, *args, **kwargs):
+        with self._lock:
+            self._running += 1
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            with self._lock:
+                self._running -= 1
+
+    async def run(self, fn, *args, **kwargs):
+        """Run a blocking callable in the pool and await its result"""
+        self._acquire()
+        # The slot is released when the worker really finishes, not when the
+        # caller stops waiting, so timed-out calls keep counting against the limit.
+        future = self._executor.submit(self._tracked, fn, *args, **kwargs)
+        future.add_done_callback(self._release)
+        try:
+            return await asyncio.wait_for(asyncio.wrap_future(future), timeout=self.timeout)
+        except asyncio.TimeoutError:
+            with self._lock:
+                self._timed_out += 1
+            raise ModelCallTimeoutError(f"El modelo no respondió en {self.timeout:g} s")
+
+    def stream(self, fn, *args, **kwargs):
+        """Run a blocking callable that returns an iterable and relay its items.
+
+        A full pool raises PoolSaturatedError here (before any response has been
+        sent), but the slot is only reserved on first iteration, so a stream
+        that is never iterated (e.g. the client left before the response
+        started) holds nothing. The timeout applies to the wait for each item,
+        not to the whole stream.
+        """
+        self.check_capacity()
+        return self._relay(fn, args, kwargs)
+
+    async def _relay(self, fn, args, kwargs):
+        self._acquire()
+        loop = asyncio.get_running_loop()
+        queue = asyncio.Queue()
+        cancelled = threading.Event()
+
+        def publish(kind, value):
+            try:
+                loop.call_soon_threadsafe(queue.put_nowait, (kind, value))
+            except RuntimeError:
+                pass  # El event loop ya se cerró
+
+        def pump():
+            iterator = iter(fn(*args, **kwargs))
+            try:
+                for item in iterator:
+                    if cancelled.is_set():
+                        break
+                    publish("item", item)
+            finally:
+                if hasattr(iterator, "close"):
+                    iterator.close()
+
+        def worker():
+            try:
+                self._tracked(pump)
+            except BaseException as e:
+                publish("error", e)
+                raise
+            publish("end", None)
+
+        future = None
+        try:
+            future = self._executor.submit(worker)
+            future.add_done_callback(self._release)
+            while True:
+                try:
+                    kind, value = await asyncio.wait_for(queue.get(), timeout=self.timeout)
+                except asyncio.TimeoutError:
+                    with self._lock:
+                        self._timed_out += 1
+                    raise ModelCallTimeoutError(f"El modelo no respondió en {self.timeout:g} s")
+                if kind == "end":
+                    return
+                if kind == "error":
+                    raise value
+                yield value
+        finally:
+            # Si el cliente se desconecta o hay error, el hilo deja de leer el stream
+            cancelled.set()
+            if future is None:
+                self._release(None)  # El trabajo no llegó a enviarse al pool
+
+    def stats(self):
+        with self._lock:
+            return {
+                "max_concurrency": self.max_concurrency,
+                "max_queue": self.max_queue,
+                "timeout_seconds": self.timeout,
+                "running": self._running,
+                "queued": max(self._pending - self._running, 0),
+                "completed": self._completed,
+                "failed": self._failed,
+                "rejected": self._rejected,
+                "timed_out": self._timed_out,
+            }
+
+    def shutdown(self):
+        self._executor.shutdown(wait=False, cancel_futures=True)
@@ -0,0 +1,344 @@
+import asyncio
+import logging
+import os
+import random
+import threading
+import time
+
+from google.api_core import exceptions as google_exceptions
+
+import metrics
+from model_pool import ModelCallTimeoutError, PoolSaturatedError
+
+logger = logging.getLogger(__name__)
+
+# Errores de la API que suelen resolverse reintentando o cambiando de modelo
+TRANSIENT_ERRORS = (
+    google_exceptions.TooManyRequests,
+    google_exceptions.ResourceExhausted,
+    google_exceptions.ServiceUnavailable,
+    google_exceptions.InternalServerError,
+    google_exceptions.BadGateway,
+    google_exceptions.GatewayTimeout,
+    google_exceptions.DeadlineExceeded,
+    google_exceptions.Aborted,
+)
+
+CLOSED, OPEN, HALF_OPEN = "closed", "open", "half_open"
+
+
+class ModelUnavailableError(Exception):
+    """Raised when every configured model has its circuit breaker open"""
+
+    def __init__(self, retry_after: int):
+        super().__init__("Ningún modelo de Gemini está disponible en este momento")
+        self.retry_after = retry_after
+
+
+class RoutedResult:
+    __slots__ = ("response", "chat", "model", "attempts", "hedged")
+
+    def __init__(self, response, chat, model: str, attempts: int, hedged: bool):
+        self.response = response
+        self.chat = chat
+        self.model = model
+        self.attempts = attempts
+        self.hedged = hedged
+
+
+class ModelHealth:
+    """EWMA latency / error rate and circuit breaker state of one model"""
+
+    def __init__(self, name: str, alpha: float):
+        self.name = name
+        self.alpha = alpha
+        self.latency = None
+        self.error_rate = 0.0
+        self.requests = 0
+        self.failures = 0
+        self.consecutive_failures = 0
+        self.state = CLOSED
+        self.opened_at = 0.0
+        self.trial_in_flight = False
+
+    def record_success(self, latency: float):
+        self.requests += 1
+        self.latency = latency if self.latency is None else self.alpha * latency + (1 - self.alpha) * self.latency
+        self.error_rate *= 1 - self.alpha
+        self.consecutive_failures = 0
+        self.state = CLOSED
+        self.trial_in_flight = False
+
+    def record_failure(self, threshold: int, now: float) -> bool:
+        """Account a transient failure; returns True if it (re)opened the breaker"""
+        self.requests += 1
+        self.failures += 1
+        self.error_rate = self.alpha + (1 - self.alpha) * self.error_rate
+        self.consecutive_failures += 1
+        self.trial_in_flight = False
+        if self.state == HALF_OPEN or (self.state == CLOSED and self.consecutive_failures >= threshold):
+            self.state = OPEN
+            self.opened_at = now
+            return True
+        return False
+
+    def available(self, cooldown: float, now: float) -> bool:
+        if self.state == OPEN and now - self.opened_at >= cooldown:
+            self.state = HALF_OPEN
+        if self.state == HALF_OPEN:
+            return not self.trial_in_flight  # Una sola llamada de prueba tras el enfriamiento
+        return self.state == CLOSED
+
+    def snapshot(self):
+        return {
+            "state": self.state,
+            "latency_ewma_seconds": round(self.latency, 3) if self.latency is not None else None,
+            "error_rate_ewma": round(self.error_rate, 3),
+            "requests": self.requests,
+            "failures": self.failures,
+            "consecutive_failures": self.consecutive_failures,
+        }
+
+
+class ModelRouter:
+    """Chooses which Gemini model answers each turn.
+
+    - Short follow-up turns (history present, question up to `fast_max_chars`)
+      go to `fast_model` first; everything else follows the `models` order.
+    - Transient API errors are retried with full-jitter exponential backoff,
+      rotating through the healthy candidates.
+    - A call still running after the hedge delay (`hedge_after`, or twice the
+      model's EWMA latency with `hedge_min` as floor) is duplicated on the next
+      candidate and the first answer wins (`hedge_after=0` disables it). Chat sessions are rebuilt from the
+      stored history, so the duplicate does not share state with the original.
+    - `breaker_failures` consecutive transient failures open a model's breaker
+      for `breaker_cooldown` seconds, after which a single trial call decides.
+    """
+
+    def __init__(self, models: list, fast_model: str | None = None, fast_max_chars: int = 200,
+                 max_retries: int = 2, backoff_base: float = 0.5, backoff_max: float = 4.0,
+                 hedge_after: float | None = None, hedge_min: float = 5.0,
+                 breaker_failures: int = 5, breaker_cooldown: float = 30.0, ewma_alpha: float = 0.2):
+        self.models = list(dict.fromkeys(models))
+        self.fast_model = fast_model
+        self.fast_max_chars = fast_max_chars
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.hedge_after = hedge_after
+        self.hedge_min = hedge_min
+        self.breaker_failures = breaker_failures
+        self.breaker_cooldown = breaker_cooldown
+        names = self.models + ([fast_model] if fast_model and fast_model not in self.models else [])
+        self._health = {name: ModelHealth(name, ewma_alpha) for name in names}
+        self._lock = threading.Lock()
+        self._fast_routed = 0
+        self._retries = 0
+        self._hedges = 0
+        self._hedge_wins = 0
+
+    @property
+    def primary(self) -> str:
+        return self.models[0]
+
+    def candidates(self, question: str, history) -> list:
+        """Healthy models in the order they should be tried for this turn"""
+        order = list(self.models)
+        if self.fast_model and history and len(question) <= self.fast_max_chars:
+            order = [self.fast_model] + [name for name in order if name != self.fast_model]
+        now = time.monotonic()
+        with self._lock:
+            healthy = [name for name in order if self._health[name].available(self.breaker_cooldown, now)]
+            # Un modelo con tasa de error alta pasa detrás de los sanos, sin salir de la lista
+            healthy.sort(key=lambda name: self._health[name].error_rate > 0.5)
+            if not healthy:
+                reopen = min(self._health[name].opened_at for name in order) + self.breaker_cooldown
+                raise ModelUnavailableError(max(1, int(reopen - now) + 1))
+            if healthy[0] == self.fast_model and order[0] == self.fast_model:
+                self._fast_routed += 1
+        return healthy
+
+    def _claim(self, model: str):
+        with self._lock:
+            health = self._health[model]
+            if health.state == HALF_OPEN:
+                health.trial_in_flight = True
+
+    def _record(self, model: str, started: float, error: BaseException | None = None):
+        outcome = "ok"
+        with self._lock:
+            health = self._health[model]
+            if error is None:
+                health.record_success(time.perf_counter() - started)
+            elif isinstance(error, TRANSIENT_ERRORS + (ModelCallTimeoutError,)):
+                outcome = "transient_error"
+                if health.record_failure(self.breaker_failures, time.monotonic()):
+                    logger.warning(f"🔌 Circuito abierto para '{model}' tras {health.consecutive_failures} fallos")
+            else:
+                outcome = "error"
+                health.trial_in_flight = False
+        metrics.model_requests.inc(model=model, outcome=outcome)
+
+    def _hedge_delay(self, model: str) -> float:
+        if self.hedge_after is not None:
+            return self.hedge_after
+        with self._lock:
+            latency = self._health[model].latency
+        return max(self.hedge_min, 2 * latency) if latency is not None else None
+
+    def _backoff(self, attempt: int) -> float:
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** attempt))
+
+    async def _call(self, pool, start_chat, model: str, content, kwargs):
+        chat = start_chat(model)
+        self._claim(model)
+        started = time.perf_counter()
+        try:
+            response = await pool.run(chat.send_message, content, **kwargs)
+        except PoolSaturatedError:
+            with self._lock:
+                self._health[model].trial_in_flight = False
+            raise
+        except asyncio.CancelledError:
+            with self._lock:
+                self._health[model].trial_in_flight = False  # Perdió la carrera del hedging
+            raise
+        except Exception as e:
+            self._record(model, started, e)
+            raise
+        self._record(model, started)
+        return response, chat
+
+    async def _hedged_call(self, pool, start_chat, model: str, backup: str | None, content, kwargs):
+        """Call `model`; if it is still running after the hedge delay, race it against `backup`"""
+        primary_task = asyncio.ensure_future(self._call(pool, start_chat, model, content, kwargs))
+        delay = self._hedge_delay(model) if backup else None
+        if not delay:  # hedge_after=0 desactiva el hedging
+            return (*await primary_task, model, False)
+        done, _ = await asyncio.wait({primary_task}, timeout=delay)
+        if done:
+            return (*primary_task.result(), model, False)
+        backup_task = asyncio.ensure_future(self._call(pool, start_chat, backup, content, kwargs))
+        with self._lock:
+            self._hedges += 1
+        metrics.model_hedges.inc()
+        logger.info(f"⏱️ '{model}' supera {delay:g} s; lanzando petición de respaldo a '{backup}'")
+        tasks = {primary_task: model, backup_task: backup}
+        pending = set(tasks)
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task.exception() is None:
+                    for loser in pending:
+                        loser.cancel()
+                    if task is backup_task:
+                        with self._lock:
+                            self._hedge_wins += 1
+                    return (*task.result(), tasks[task], True)
+        # Ambas fallaron: manda el error del modelo elegido (el respaldo pudo fallar solo por el pool lleno)
+        raise primary_task.exception()
+
+    async def send(self, pool, start_chat, content, history, **kwargs) -> RoutedResult:
+        """Send one turn through the pool with routing, retries and hedging.
+
+        `start_chat(model_name)` must return a fresh ChatSession for that model
+        built from the session's stored history.
+        """
+        candidates = self.candidates(content, history)
+        attempt = 0
+        while True:
+            model = candidates[attempt % len(candidates)]
+            backup = candidates[(attempt + 1) % len(candidates)] if len(candidates) > 1 else None
+            try:
+                response, chat, winner, hedged = await self._hedged_call(pool, start_chat, model, backup, content, kwargs)
+                return RoutedResult(response, chat, winner, attempt + 1, hedged)
+            except TRANSIENT_ERRORS as e:
+                if attempt >= self.max_retries:
+                    raise
+                delay = self._backoff(attempt)
+                logger.warning(f"🔁 Error transitorio de '{model}' ({e}); reintento en {delay:.2f} s")
+                with self._lock:
+                    self._retries += 1
+                await asyncio.sleep(delay)
+                attempt += 1
+
+    def stream(self, pool, start_chat, fn, content, history, result: dict):
+        """Streaming counterpart of send(): `fn(chat, content, result)` is the blocking chunk generator.
+
+        Transient errors are retried (on the next candidate) only while no chunk
+        has been relayed yet; there is no hedging because chunks are already on
+        their way to the client. Open circuits and a full pool raise here, before
+        the response starts, but the chat and the pool slot are only taken on
+        first iteration. The chat that produced the answer is left in
+        result["chat"] and its model in result["model"].
+        """
+        candidates = self.candidates(content, history)
+        pool.check_capacity()
+        return self._relay_stream(pool, start_chat, fn, candidates, content, result)
+
+    def _start_stream(self, pool, start_chat, fn, model: str, content, result: dict):
+        chat = start_chat(model)
+        result["chat"], result["model"] = chat, model
+        self._claim(model)
+        return pool.stream(fn, chat, content, result)
+
+    async def _relay_stream(self, pool, start_chat, fn, candidates, content, result):
+        attempt = 0
+        while True:
+            model = candidates[attempt % len(candidates)]
+            started = time.perf_counter()
+            relayed = False
+            try:
+                chunks = self._start_stream(pool, start_chat, fn, model, content, result)
+                async for chunk in chunks:
+                    relayed = True
+                    yield chunk
+            except (asyncio.CancelledError, GeneratorExit, PoolSaturatedError):
+                with self._lock:
+                    self._health[model].trial_in_flight = False  # Cliente desconectado o pool lleno
+                raise
+            except Exception as e:
+                self._record(model, started, e)
+                if relayed or not isinstance(e, TRANSIENT_ERRORS) or attempt >= self.max_retries:
+                    raise
+                delay = self._backoff(attempt)
+                logger.warning(f"🔁 Error transitorio de '{model}' en streaming ({e}); reintento en {delay:.2f} s")
+                with self._lock:
+                    self._retries += 1
+                await asyncio.sleep(delay)
+                attempt += 1
+                continue
+            self._record(model, started)
+            return
+
+    def stats(self):
+        with self._lock:
+            return {
+                "models": self.models,
+                "primary": self.primary,
+                "fast_model": self.fast_model,
+                "fast_max_chars": self.fast_max_chars,
+                "hedge_after_seconds": self.hedge_after,
+                "fast_routed": self._fast_routed,
+                "retries": self._retries,
+                "hedges": self._hedges,
+                "hedge_wins": self._hedge_wins,
+                "health": {name: health.snapshot() for name, health in self._health.items()},
+            }
+
+
+def create_model_router(default_model: str) -> ModelRouter:
+    """Build the router from GEMINI_MODELS / GEMINI_FAST_MODEL / ROUTER_* variables"""
+    models = [name.strip() for name in os.getenv("GEMINI_MODELS", "").split(",") if name.strip()] or [default_model]
+    hedge_after = os.getenv("ROUTER_HEDGE_AFTER")
+    return ModelRouter(
+        models,
+        fast_model=os.getenv("GEMINI_FAST_MODEL") or None,
+        fast_max_chars=int(os.getenv("ROUTER_FAST_MAX_CHARS", "200")),
+        max_retries=int(os.getenv("ROUTER_MAX_RETRIES", "2")),
+        backoff_base=float(os.getenv("ROUTER_BACKOFF_BASE", "0.5")),
+        hedge_after=float(hedge_after) if hedge_after else None,
+        hedge_min=float(os.getenv("ROUTER_HEDGE_MIN", "5")),
+        breaker_failures=int(os.getenv("ROUTER_BREAKER_FAILURES", "5")),
+        breaker_cooldown=float(os.getenv("ROUTER_BREAKER_COOLDOWN", "30")),
+    )
@@ -0,0 +1,218 @@
+import datetime
+import logging
+import threading
+from collections import OrderedDict
+
+from config import get_genai
+from model_backend import gemini_model
+from session_store import serialize_history
+
+logger = logging.getLogger(__name__)
+
+MODE_CACHE = "cache"
+MODE_SYSTEM_INSTRUCTION = "system_instruction"
+MODE_HISTORY = "history"
+MODES = (MODE_CACHE, MODE_SYSTEM_INSTRUCTION, MODE_HISTORY)
+
+PROMPT_ACKNOWLEDGEMENT = "Entendido. Estoy listo para asistir como un especialista en NEAE para Andalucía."
+
+
+class PromptDelivery:
+    """Decides how the system prompt reaches Gemini and builds chat sessions accordingly.
+
+    Modes, in order of preference when mode is "auto":
+    - cache: the prompt is uploaded once as cached content and every session
+      references it, so its tokens are billed at the cached rate.
+    - system_instruction: the prompt goes in the model's system_instruction.
+    - history: the prompt is injected as the first user turn (original behaviour).
+
+    `model_factory` builds the models (genai.GenerativeModel unless a local
+    backend is configured, see model_backend); context caching needs the real SDK.
+    """
+
+    def __init__(self, model_name: str, system_prompt: str, mode: str = "auto",
+                 cache_model_name: str | None = None, cache_ttl: int = 3600,
+                 refresh_margin: int = 300, model_factory=None):
+        self.model_name = model_name
+        self.model_factory = model_factory or gemini_model
+        self.system_prompt = system_prompt
+        self.requested_mode = mode
+        self.cache_model_name = cache_model_name or model_name
+        self.cache_ttl = cache_ttl
+        self.refresh_margin = refresh_margin
+        self.mode = None
+        self.model = None
+        self.cached_content = None
+        self.cache_expires_at = None
+        self.prompt_tokens = None
+        self.last_error = None
+        self._lock = threading.Lock()
+        self._refresh_lock = threading.Lock()  # Una sola renovación a la vez; no lo toman las peticiones
+        self._turns = 0
+        self._cached_tokens_total = 0
+        self._last_cached_tokens = 0
+        self._cache_refreshes = 0
+        self._variant_models = OrderedDict()
+        self._max_variant_models = 32
+
+    def initialize(self):
+        """Create the model for the first mode that works; returns it or None"""
+        if self.requested_mode in MODES:
+            candidates = [self.requested_mode]
+            if self.requested_mode != MODE_HISTORY:
+                candidates.append(MODE_HISTORY)
+        else:
+            candidates = list(MODES)
+
+        for mode in candidates:
+            try:
+                self.model = self._create_model(mode)
+                self.mode = mode
+                logger.info(f"🧠 Prompt del sistema entregado en modo '{mode}' (modelo '{self.model_name}')")
+                return self.model
+            except Exception as e:
+                self.last_error = str(e)
+                logger.warning(f"⚠️ No se pudo usar el modo de prompt '{mode}': {e}")
+        return None
+
+    def _create_model(self, mode: str):
+        if mode == MODE_CACHE:
+            return self._create_cached_model()
+        if mode == MODE_SYSTEM_INSTRUCTION:
+            return self.model_factory(self.model_name, system_instruction=self.system_prompt)
+        return self.model_factory(self.model_name)
+
+    def _create_cached_model(self):
+        # Context caching requires an explicit model version (e.g. gemini-1.5-pro-002)
+        # and a minimum prompt size; on failure initialize() falls back to the next mode.
+        if self.model_factory is not gemini_model:
+            raise RuntimeError("la caché de contexto solo está disponible con el backend de Gemini")
+        model, cached = self._upload_prompt()
+        self.cached_content = cached
+        self.cache_expires_at = cached.expire_time
+        return model
+
+    def _upload_prompt(self):
+        """Upload the prompt as cached content (network call); returns (model, cached content)"""
+        genai = get_genai()
+        from google.generativeai import caching
+        cached = caching.CachedContent.create(
+            model=self.cache_model_name,
+            display_name="asistente-neae-prompt",
+            system_instruction=self.system_prompt,
+            ttl=datetime.timedelta(seconds=self.cache_ttl),
+        )
+        usage = getattr(cached, "usage_metadata", None)
+        self.prompt_tokens = getattr(usage, "total_token_count", None) if usage else None
+        return genai.GenerativeModel.from_cached_content(cached), cached
+
+    def _cache_expiring(self) -> bool:
+        if self.mode != MODE_CACHE or self.cached_content is None:
+            return False
+        now = datetime.datetime.now(datetime.timezone.utc)
+        return not self.cache_expires_at or (self.cache_expires_at - now).total_seconds() <= self.refresh_margin
+
+    def refresh_if_needed(self):
+        """Extend the cached prompt's TTL shortly before it expires, recreating it if it is gone.
+
+        Makes network calls, so it runs in a worker thread (main.keep_prompt_cache_fresh),
+        never on a request path; `_lock` is only held to swap in the result.
+        """
+        if not self._cache_expiring():
+            return
+        with self._refresh_lock:
+            if not self._cache_expiring():
+                return  # Otro hilo la acaba de renovar
+            model, mode, cached = self.model, MODE_CACHE, self.cached_content
+            try:
+                cached.update(ttl=datetime.timedelta(seconds=self.cache_ttl))
+                logger.info(f"🔄 Caché del prompt renovada hasta {cached.expire_time}")
+            except Exception as e:
+                logger.warning(f"⚠️ No se pudo renovar la caché del prompt ({e}); creando una nueva")
+                try:
+                    model, cached = self._upload_prompt()
+                except Exception as create_error:
+                    self.last_error = str(create_error)
+                    logger.error(f"❌ Error al recrear la caché del prompt: {create_error}; usando el modo '{MODE_HISTORY}'")
+                    model, mode, cached = self._create_model(MODE_HISTORY), MODE_HISTORY, None
+            with self._lock:
+                self.model, self.mode, self.cached_content = model, mode, cached
+                self.cache_expires_at = cached.expire_time if cached is not None else None
+                self._cache_refreshes += 1
+
+    def preamble(self, system_prompt: str | None = None):
+        """History turns that carry the prompt when it cannot be sent any other way"""
+        if self.mode != MODE_HISTORY:
+            return []
+        return [
+            {"role": "user", "parts": [system_prompt or self.system_prompt]},
+            {"role": "model", "parts": [PROMPT_ACKNOWLEDGEMENT]},
+        ]
+
+    def _model_for(self, system_prompt: str | None, model_name: str | None = None):
+        """Model for a session-specific prompt and/or another model tier (one per combination, LRU-bounded)"""
+        model_name = model_name or self.model_name
+        if model_name == self.model_name and (not system_prompt or self.mode != MODE_SYSTEM_INSTRUCTION):
+            return self.model
+        # La caché de contexto pertenece al modelo principal; los demás reciben el prompt como system_instruction
+        instruction = None if self.mode == MODE_HISTORY else (system_prompt or self.system_prompt)
+        key = (model_name, instruction)
+        with self._lock:
+            model = self._variant_models.get(key)
+            if model is not None:
+                self._variant_models.move_to_end(key)
+                return model
+        if instruction:
+            model = self.model_factory(model_name, system_instruction=instruction)
+        else:
+            model = self.model_factory(model_name)
+        with self._lock:
+            self._variant_models[key] = model
+            while len(self._variant_models) > self._max_variant_models:
+                self._variant_models.popitem(last=False)
+        return model
+
+    def start_chat(self, history=None, system_prompt: str | None = None, model_name: str | None = None):
+        """Start a ChatSession with the prompt delivered according to the active mode.
+
+        `system_prompt` replaces the full prompt for this session (see PromptEngine);
+        it is ignored in cache mode, where the full prompt is already cached.
+        `model_name` selects another model tier (see ModelRouter).
+        """
+        if self.mode == MODE_CACHE:
+            system_prompt = None
+        model = self._model_for(system_prompt, model_name)
+        return model.start_chat(history=self.preamble(system_prompt) + list(history or []))
+
+    def conversation_turns(self, chat_session) -> list:
+        """Serialized history of a ChatSession without the prompt preamble"""
+        return serialize_history(chat_session.history)[len(self.preamble()):]
+
+    def record_usage(self, usage: dict | None):
+        """Account the cached (not re-billed) prompt tokens reported for one turn"""
+        if not usage:
+            return
+        cached = usage.get("cached_tokens") or 0
+        with self._lock:
+            self._turns += 1
+            self._last_cached_tokens = cached
+            self._cached_tokens_total += cached
+
+    def stats(self):
+        with self._lock:
+            return {
+                "mode": self.mode,
+                "requested_mode": self.requested_mode,
+                "model": self.model_name,
+                "prompt_chars": len(self.system_prompt),
+                "prompt_tokens": self.prompt_tokens,
+                "cache_name": getattr(self.cached_content, "name", None),
+                "cache_expires_at": self.cache_expires_at.isoformat() if self.cache_expires_at else None,
+                "cache_refreshes": self._cache_refreshes,
+                "prompt_variant_models": len(self._variant_models),
+                "turns": self._turns,
+                "input_tokens_saved_last_turn": self._last_cached_tokens,
+                "input_tokens_saved_total": self._cached_tokens_total,
+                "input_tokens_saved_per_turn": round(self._cached_tokens_total / self._turns, 1) if self._turns else 0,
+                "last_error": self.last_error,
+            }
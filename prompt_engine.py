@@ -0,0 +1,253 @@
+import logging
+import math
+import os
+import re
+import threading
+import unicodedata
+from collections import Counter, OrderedDict
+
+logger = logging.getLogger(__name__)
+
+# Línea de encabezado de sección en prompt.txt: **🎯 Título...** o **A. TÍTULO...**
+HEADING_RE = re.compile(r"^\*\*(?:[^\w\s*\[]|[A-Z]\.\s)")
+LIST_ITEM_RE = re.compile(r"^\s*(?:[-*•]|\d+\.)\s")
+
+# Únicas secciones que pueden quedar fuera del prompt (comparación sobre el título normalizado): los
+# ejemplos resueltos. Todas las demás (reglas, estructura de la respuesta, protocolos de verificación de
+# YouTube, prohibiciones sobre enlaces, filtros de relevancia y controles de calidad) se envían siempre,
+# porque las secciones de recursos exigen citar vídeos y esas reglas dicen cómo comprobarlos
+OPTIONAL_SECTIONS = ("ejemplo de procedimiento correcto",)
+
+# Palabras clave por NEAE y por etapa; las escritas en mayúsculas solo cuentan como sigla
+NEAE_KEYWORDS = {
+    "tartamudez": ("tartamudez", "tartamudeo", "tartamudea", "disfemia", "disfluencia", "disfluencias"),
+    "tdah": ("tdah", "hiperactividad", "deficit de atencion", "TDA"),
+    "tea": ("TEA", "autismo", "autista", "asperger", "espectro autista"),
+    "dislexia": ("dislexia", "dislexico", "dislexica"),
+    "discalculia": ("discalculia",),
+    "disgrafia": ("disgrafia", "disortografia"),
+    "tdl": ("TDL", "TEL", "trastorno del lenguaje", "trastorno especifico del lenguaje"),
+    "altas_capacidades": ("altas capacidades", "superdotacion", "sobredotacion"),
+    "discapacidad_intelectual": ("discapacidad intelectual", "sindrome de down"),
+    "discapacidad_visual": ("discapacidad visual", "ceguera", "baja vision", "ciego", "ciega"),
+    "discapacidad_auditiva": ("discapacidad auditiva", "sordera", "hipoacusia", "sordo", "sorda"),
+    "discapacidad_motora": ("discapacidad motora", "discapacidad fisica", "paralisis cerebral"),
+}
+STAGE_KEYWORDS = {
+    "infantil": ("infantil",),
+    "primaria": ("primaria",),
+    "eso": ("ESO", "secundaria obligatoria", "secundaria"),
+    "bachillerato": ("bachillerato",),
+    "fp": ("FP", "formacion profesional", "grado basico", "grado medio", "grado superior", "ciclo formativo"),
+}
+
+STOPWORDS = frozenset("""
+    a al ante como con de del desde el ella en entre es esta este esto la las le les lo los mas me mi mis
+    muy no o para pero por que se si sin sobre su sus te tu un una uno unos unas y ya hay son ser tiene
+    puedo puede cual cuales donde cuando quiero necesito tengo hacer ha he
+""".split())
+
+
+def normalize_text(text: str, lower: bool = True) -> str:
+    """Strip accents and punctuation (optionally keeping case) and collapse whitespace"""
+    text = unicodedata.normalize("NFKD", text.lower() if lower else text)
+    text = "".join(ch for ch in text if not unicodedata.combining(ch))
+    return " ".join(re.sub(r"[^\w\s]", " ", text).split())
+
+
+def find_tags(text: str, table: dict) -> set:
+    """Tags of `table` whose keywords appear as whole words in `text`"""
+    lowered = f" {normalize_text(text)} "
+    cased = f" {normalize_text(text, lower=False)} "
+    return {
+        tag for tag, keywords in table.items()
+        if any(f" {kw} " in (cased if kw.isupper() else lowered) for kw in keywords)
+    }
+
+
+def tokenize(text: str) -> list:
+    return [word for word in normalize_text(text).split() if len(word) > 2 and word not in STOPWORDS]
+
+
+def estimate_tokens(text: str) -> int:
+    return len(text) // 4
+
+
+class PromptSection:
+    __slots__ = ("id", "title", "text", "neae", "stages", "pinned", "tokens")
+
+    def __init__(self, section_id: str, title: str, text: str, pinned: bool):
+        self.id = section_id
+        self.title = title
+        self.text = text
+        self.neae = find_tags(text, NEAE_KEYWORDS)
+        self.stages = find_tags(text, STAGE_KEYWORDS)
+        self.pinned = pinned
+        self.tokens = estimate_tokens(text)
+
+
+def parse_sections(prompt: str) -> list:
+    """Split prompt.txt at its bold headings into PromptSection objects (text before the first heading is the intro)"""
+    sections = []
+    title, lines = "Introducción", []
+
+    def close():
+        text = "\n".join(lines).strip("\n")
+        if not text.strip():
+            return
+        normalized = normalize_text(title)
+        slug = "-".join(normalized.split()[:5]) or "seccion"
+        pinned = not any(pattern in normalized for pattern in OPTIONAL_SECTIONS)
+        sections.append(PromptSection(f"{len(sections):02d}-{slug}", title, text, pinned))
+
+    for line in prompt.splitlines():
+        # Un encabezado sin contenido propio (p. ej. el que agrupa los protocolos de YouTube) se une al siguiente
+        if HEADING_RE.match(line) and any(text.strip() and not HEADING_RE.match(text) for text in lines):
+            close()
+            title, lines = line.strip("* ").split("**")[0].strip(" :"), []
+        lines.append(line)
+    close()
+    return sections
+
+
+class PromptEngine:
+    """Builds a per-session system prompt from the sections of prompt.txt relevant to the first question.
+
+    Every section is pinned except the clearly optional ones in
+    OPTIONAL_SECTIONS (worked examples), so the rules, the answer structure,
+    the YouTube verification protocols and the link and quality guards are
+    always sent. The
+    optional sections are ranked by TF-IDF similarity with the question plus a bonus
+    when they mention the question's NEAE or stage, and added while they score
+    at least `min_score` and fit in `section_budget` estimated tokens. Inside the
+    chosen sections, list items that only concern other NEAE are dropped when
+    the section also has items about the NEAE being asked about.
+    """
+
+    def __init__(self, prompt: str, section_budget: int = 3000, min_score: float = 0.08,
+                 max_variants: int = 64):
+        self.full_prompt = prompt
+        self.sections = parse_sections(prompt)
+        self.by_id = {section.id: section for section in self.sections}
+        self.section_budget = section_budget
+        self.min_score = min_score
+        self.full_tokens = estimate_tokens(prompt)
+        self._idf = {}
+        self._vectors = {}
+        self._build_index()
+        self._rendered = OrderedDict()
+        self._max_variants = max_variants
+        self._lock = threading.Lock()
+        self._selections = 0
+        self._prompt_tokens_total = 0
+        self._section_hits = Counter()
+
+    def _build_index(self):
+        documents = {section.id: Counter(tokenize(section.text)) for section in self.sections}
+        document_frequency = Counter(word for terms in documents.values() for word in terms)
+        total = len(documents)
+        self._idf = {word: math.log((total + 1) / (df + 1)) + 1 for word, df in document_frequency.items()}
+        self._vectors = {section_id: self._weigh(terms) for section_id, terms in documents.items()}
+
+    def _weigh(self, terms: Counter) -> dict:
+        vector = {word: (1 + math.log(count)) * self._idf.get(word, 0) for word, count in terms.items()}
+        norm = math.sqrt(sum(weight * weight for weight in vector.values())) or 1.0
+        return {word: weight / norm for word, weight in vector.items() if weight}
+
+    def signature(self) -> str:
+        """Identifies the engine settings, for cache keys of answers built from selected sections"""
+        return f"sections:{self.section_budget}:{self.min_score}:{','.join(OPTIONAL_SECTIONS)}"
+
+    def select(self, question: str) -> dict:
+        """Choose the sections for a session from its first question; the result is stored in the session"""
+        neae = find_tags(question, NEAE_KEYWORDS)
+        stages = find_tags(question, STAGE_KEYWORDS)
+        query = self._weigh(Counter(tokenize(question)))
+        scored = []
+        for section in self.sections:
+            if section.pinned:
+                continue
+            vector = self._vectors[section.id]
+            score = sum(weight * vector.get(word, 0) for word, weight in query.items())
+            if neae & section.neae:
+                score += 0.1
+            if stages & section.stages:
+                score += 0.05
+            if score >= self.min_score:
+                scored.append((score, section))
+        chosen, used = set(), 0
+        for score, section in sorted(scored, key=lambda item: item[0], reverse=True):
+            if used + section.tokens > self.section_budget:
+                continue
+            chosen.add(section.id)
+            used += section.tokens
+        selection = {
+            "sections": [section.id for section in self.sections if section.pinned or section.id in chosen],
+            "neae": sorted(neae),
+            "stages": sorted(stages),
+        }
+        prompt_tokens = estimate_tokens(self.render(selection))
+        with self._lock:
+            self._selections += 1
+            self._prompt_tokens_total += prompt_tokens
+            self._section_hits.update(chosen)
+        return selection
+
+    def render(self, selection: dict) -> str:
+        """Prompt text for a stored selection, in the original order of prompt.txt"""
+        key = (tuple(selection["sections"]), tuple(selection.get("neae", ())))
+        with self._lock:
+            text = self._rendered.get(key)
+            if text is not None:
+                self._rendered.move_to_end(key)
+                return text
+        neae = set(selection.get("neae", ()))
+        parts = [self._prune(self.by_id[section_id].text, neae)
+                 for section_id in selection["sections"] if section_id in self.by_id]
+        text = "\n\n".join(parts)
+        with self._lock:
+            self._rendered[key] = text
+            while len(self._rendered) > self._max_variants:
+                self._rendered.popitem(last=False)
+        return text
+
+    @staticmethod
+    def _prune(text: str, neae: set) -> str:
+        if not neae:
+            return text
+        lines = text.split("\n")
+        item_tags = [find_tags(line, NEAE_KEYWORDS) if LIST_ITEM_RE.match(line) else set() for line in lines]
+        if not any(tags & neae for tags in item_tags):
+            return text  # Sin ejemplos de esta NEAE: se conservan todos como referencia
+        return "\n".join(line for line, tags in zip(lines, item_tags) if not tags or tags & neae)
+
+    def stats(self):
+        with self._lock:
+            average = self._prompt_tokens_total / self._selections if self._selections else 0
+            return {
+                "sections": len(self.sections),
+                "pinned_sections": sum(1 for section in self.sections if section.pinned),
+                "section_budget_tokens": self.section_budget,
+                "full_prompt_tokens": self.full_tokens,
+                "selections": self._selections,
+                "prompt_tokens_per_session": round(average, 1),
+                "input_tokens_saved_per_session": round(self.full_tokens - average, 1) if self._selections else 0,
+                "most_selected": dict(self._section_hits.most_common(10)),
+                "rendered_variants": len(self._rendered),
+            }
+
+
+def create_prompt_engine(prompt: str):
+    """PromptEngine configured from PROMPT_SECTIONS_* variables, or None unless PROMPT_SECTIONS_ENABLED=1"""
+    if os.getenv("PROMPT_SECTIONS_ENABLED", "0").lower() not in ("1", "true", "yes"):
+        return None
+    engine = PromptEngine(
+        prompt,
+        section_budget=int(os.getenv("PROMPT_SECTIONS_BUDGET", "3000")),
+        min_score=float(os.getenv("PROMPT_SECTIONS_MIN_SCORE", "0.08")),
+    )
+    pinned_tokens = sum(section.tokens for section in engine.sections if section.pinned)
+    logger.info(f"🧩 prompt.txt dividido en {len(engine.sections)} secciones "
+                f"({pinned_tokens} de {engine.full_tokens} tokens fijos en cada sesión)")
+    return engine
+
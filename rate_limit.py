@@ -0,0 +1,268 @@
+import asyncio
+import math
+import os
+import threading
+import time
+from collections import OrderedDict, deque
+
+from model_pool import PoolSaturatedError
+
+
+class TokenBucket:
+    """Refills `rate_per_minute` units per minute up to `capacity`; the level may go negative (debt)"""
+
+    __slots__ = ("per_minute", "rate", "capacity", "level", "updated")
+
+    def __init__(self, rate_per_minute: float, capacity: float):
+        self.per_minute = rate_per_minute
+        self.rate = rate_per_minute / 60.0
+        self.capacity = capacity
+        self.level = capacity
+        self.updated = time.monotonic()
+
+    def configure(self, rate_per_minute: float, capacity: float):
+        self._refill()
+        self.per_minute = rate_per_minute
+        self.rate = rate_per_minute / 60.0
+        self.capacity = capacity
+        self.level = min(self.level, capacity)
+
+    def _refill(self):
+        now = time.monotonic()
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, amount: float) -> float:
+        """Seconds until `amount` units are available (0 if they already are)"""
+        self._refill()
+        missing = amount - self.level
+        return missing / self.rate if missing > 0 else 0.0
+
+    def take(self, amount: float):
+        self._refill()
+        self.level -= amount
+
+    def give_back(self, amount: float):
+        self._refill()
+        self.level = min(self.capacity, self.level + amount)
+
+
+class KeyRateLimiter:
+    """Per-key requests/minute and tokens/minute token buckets.
+
+    Limits come from the key's entry in the keys file (`rate_limit_rpm`,
+    `rate_limit_tpm`) or the defaults; 0 disables a limit. A request needs one
+    unit of the request bucket and a non-empty token bucket. Its real token
+    count is only known after the call, so consume_tokens() debits it
+    afterwards and a large answer makes the key wait until the debt is repaid.
+    Buckets live in the process, so with several workers each one enforces
+    the limit on its own share of traffic. With `blocking` (limits read from
+    the SQLite key store) admit() and throttle() look them up in a worker thread.
+    """
+
+    def __init__(self, limits_for, default_rpm: float = 20, default_tpm: float = 0, burst: float = 5,
+                 blocking: bool = False):
+        self.limits_for = limits_for
+        self.blocking = blocking
+        self.default_rpm = default_rpm
+        self.default_tpm = default_tpm
+        self.burst = burst
+        self._lock = threading.Lock()
+        self._buckets = {}
+        self._rejected = {"rpm": 0, "tpm": 0}
+
+    def _limits(self, key: str):
+        entry = self.limits_for(key) or {}
+        rpm = float(entry.get("rate_limit_rpm", self.default_rpm) or 0)
+        tpm = float(entry.get("rate_limit_tpm", self.default_tpm) or 0)
+        return rpm, tpm
+
+    def _buckets_for(self, key: str, rpm: float, tpm: float):
+        # Capacidad: ráfaga corta de peticiones; para tokens, lo que se recarga en un minuto
+        rpm_capacity, tpm_capacity = min(rpm, self.burst) or 1, tpm
+        buckets = self._buckets.get(key)
+        if buckets is None:
+            buckets = self._buckets[key] = {
+                "rpm": TokenBucket(rpm, rpm_capacity) if rpm else None,
+                "tpm": TokenBucket(tpm, tpm_capacity) if tpm else None,
+            }
+            return buckets
+        for name, rate, capacity in (("rpm", rpm, rpm_capacity), ("tpm", tpm, tpm_capacity)):
+            bucket = buckets[name]
+            if not rate:
+                buckets[name] = None
+            elif bucket is None:
+                buckets[name] = TokenBucket(rate, capacity)
+            elif bucket.per_minute != rate or bucket.capacity != capacity:
+                bucket.configure(rate, capacity)  # Límites cambiados al recargar las claves
+        return buckets
+
+    def check(self, key: str):
+        """Admit one request for `key`: None if allowed, else (limit, retry_after_seconds)"""
+        rpm, tpm = self._limits(key)
+        if not rpm and not tpm:
+            return None
+        with self._lock:
+            buckets = self._buckets_for(key, rpm, tpm)
+            for name, amount in (("rpm", 1), ("tpm", 1)):
+                bucket = buckets[name]
+                wait = bucket.wait_time(amount) if bucket else 0
+                if wait:
+                    self._rejected[name] += 1
+                    return name, max(1, math.ceil(wait))
+            if buckets["rpm"]:
+                buckets["rpm"].take(1)
+        return None
+
+    async def admit(self, key: str):
+        """check() without blocking the event loop on the key lookup"""
+        if self.blocking:
+            return await asyncio.to_thread(self.check, key)
+        return self.check(key)
+
+    async def throttle(self, key: str):
+        """Wait until `key` may send another request (for batch items instead of rejecting them)"""
+        while True:
+            limited = await self.admit(key)
+            if limited is None:
+                return
+            await asyncio.sleep(limited[1])
+
+    def release(self, key: str):
+        """Return the request unit taken by check() for a request that was then rejected (e.g. quota exhausted)"""
+        with self._lock:
+            buckets = self._buckets.get(key)
+            if buckets and buckets["rpm"]:
+                buckets["rpm"].give_back(1)
+
+    def consume_tokens(self, key: str, tokens: int | None):
+        if not tokens:
+            return
+        with self._lock:
+            buckets = self._buckets.get(key)
+            if buckets and buckets["tpm"]:
+                buckets["tpm"].take(tokens)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "default_rpm": self.default_rpm,
+                "default_tpm": self.default_tpm,
+                "burst": self.burst,
+                "keys_tracked": len(self._buckets),
+                "rejected": dict(self._rejected),
+            }
+
+
+class SchedulerSlot:
+    """Permission to call the model, held until release() (safe to call more than once)"""
+
+    __slots__ = ("_scheduler", "released", "waited")
+
+    def __init__(self, scheduler, waited: float):
+        self._scheduler = scheduler
+        self.released = False
+        self.waited = waited
+
+    def release(self):
+        if not self.released:
+            self.released = True
+            self._scheduler._release()
+
+
+class FairScheduler:
+    """Round-robin admission of model calls between keys.
+
+    At most `max_concurrency` calls hold a slot. When all are busy, callers
+    wait in a FIFO per key and each freed slot goes to the next key in
+    round-robin order, so a key with dozens of parallel requests gets one turn
+    per cycle like everyone else. At most `max_queue` callers wait; beyond
+    that acquire() raises PoolSaturatedError. Runs on the event loop only.
+    """
+
+    def __init__(self, max_concurrency: int, max_queue: int, retry_after: int = 5, on_wait=None):
+        self.max_concurrency = max_concurrency
+        self.max_queue = max_queue
+        self.retry_after = retry_after
+        self.on_wait = on_wait
+        self._active = 0
+        self._waiting = OrderedDict()  # key -> deque de futures, en orden de turno
+        self._queued = 0
+        self._granted = 0
+        self._queued_total = 0
+        self._rejected = 0
+
+    async def acquire(self, key: str) -> SchedulerSlot:
+        if self._active < self.max_concurrency and not self._waiting:
+            self._active += 1
+            self._granted += 1
+            return self._granted_slot(0.0)
+        if self._queued >= self.max_queue:
+            self._rejected += 1
+            raise PoolSaturatedError(self.retry_after)
+        future = asyncio.get_running_loop().create_future()
+        self._waiting.setdefault(key, deque()).append(future)
+        self._queued += 1
+        self._queued_total += 1
+        started = time.perf_counter()
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                self._release()  # El turno ya se había concedido: se pasa al siguiente
+            else:
+                self._discard(key, future)
+            raise
+        self._granted += 1
+        return self._granted_slot(time.perf_counter() - started)
+
+    def _granted_slot(self, waited: float) -> SchedulerSlot:
+        if self.on_wait:
+            self.on_wait(waited)
+        return SchedulerSlot(self, waited)
+
+    def _discard(self, key: str, future):
+        queue = self._waiting.get(key)
+        if queue and future in queue:
+            queue.remove(future)
+            self._queued -= 1
+            if not queue:
+                del self._waiting[key]
+
+    def _release(self):
+        # El hueco pasa directamente al primero de la siguiente clave (round-robin); si nadie espera, se libera
+        while self._waiting:
+            key, queue = next(iter(self._waiting.items()))
+            future = queue.popleft()
+            self._queued -= 1
+            if queue:
+                self._waiting.move_to_end(key)
+            else:
+                del self._waiting[key]
+            if not future.done():
+                future.set_result(None)
+                return
+        self._active -= 1
+
+    def stats(self):
+        return {
+            "max_concurrency": self.max_concurrency,
+            "max_queue": self.max_queue,
+            "active": self._active,
+            "queued": self._queued,
+            "keys_waiting": len(self._waiting),
+            "granted": self._granted,
+            "queued_total": self._queued_total,
+            "rejected": self._rejected,
+        }
+
+
+def create_rate_limiter(limits_for, blocking: bool = False) -> KeyRateLimiter:
+    """Limiter with defaults from RATE_LIMIT_RPM / RATE_LIMIT_TPM / RATE_LIMIT_BURST"""
+    return KeyRateLimiter(
+        limits_for,
+        default_rpm=float(os.getenv("RATE_LIMIT_RPM", "20")),
+        default_tpm=float(os.getenv("RATE_LIMIT_TPM", "0")),
+        burst=float(os.getenv("RATE_LIMIT_BURST", "5")),
+        blocking=blocking,
+    )
@@ -0,0 +1,402 @@
+import argparse
+import json
+import logging
+import math
+import os
+import sqlite3
+import threading
+import time
+import urllib.error
+import urllib.request
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from pathlib import Path
+
+from prompt_engine import NEAE_KEYWORDS, STAGE_KEYWORDS, find_tags, tokenize
+
+logger = logging.getLogger(__name__)
+
+# Tipos de recurso, con las palabras que los piden en una pregunta y el icono usado en el prompt
+RESOURCE_TYPE_KEYWORDS = {
+    "video": ("video", "videos", "youtube"),
+    "normativa": ("normativa", "decreto", "ley", "instrucciones", "boja", "boe"),
+    "guia": ("guia", "guias", "protocolo", "manual"),
+    "material": ("material", "materiales", "ficha", "fichas", "actividades", "pictogramas"),
+    "app": ("app", "apps", "aplicacion", "aplicaciones", "software"),
+    "web": ("web", "portal", "pagina"),
+}
+TYPE_ICONS = {"video": "🎥", "normativa": "📜", "guia": "📘", "material": "🧩", "app": "📱", "web": "🌐"}
+
+LINK_UNCHECKED, LINK_OK, LINK_BROKEN = "unchecked", "ok", "broken"
+# Un fallo transitorio (timeout, 5xx) no retira un enlace verificado hasta que se repite
+BROKEN_AFTER_FAILURES = 2
+GONE_STATUSES = (404, 410)
+
+
+class Resource:
+    __slots__ = ("id", "title", "url", "description", "neae", "stages", "type", "checked_at")
+
+    def __init__(self, resource_id, title, url, description, neae, stages, resource_type, checked_at):
+        self.id = resource_id
+        self.title = title
+        self.url = url
+        self.description = description
+        self.neae = neae
+        self.stages = stages
+        self.type = resource_type
+        self.checked_at = checked_at
+
+
+def resource_terms(data: dict) -> set:
+    """Inverted-index terms of a catalog entry: its tags plus the words of its title, description and keywords"""
+    text = " ".join([data["title"], data.get("description", ""), " ".join(data.get("keywords", []))])
+    terms = {f"neae:{tag}" for tag in data.get("neae", [])}
+    terms |= {f"etapa:{tag}" for tag in data.get("stages", [])}
+    terms.add(f"tipo:{data['type']}")
+    terms |= set(tokenize(text))
+    return terms
+
+
+def validate_entry(data: dict, position: int) -> dict:
+    """Check one entry of the catalog JSON; raises ValueError naming the entry"""
+    if not isinstance(data, dict):
+        raise ValueError(f"Recurso {position}: se esperaba un objeto.")
+    for field in ("id", "title", "url", "type"):
+        if not isinstance(data.get(field), str) or not data[field].strip():
+            raise ValueError(f"Recurso {position}: falta el campo '{field}'.")
+    if not data["url"].startswith(("https://", "http://")):
+        raise ValueError(f"Recurso {data['id']}: la URL debe empezar por https:// o http://.")
+    if data["type"] not in RESOURCE_TYPE_KEYWORDS:
+        raise ValueError(f"Recurso {data['id']}: tipo '{data['type']}' desconocido ({', '.join(RESOURCE_TYPE_KEYWORDS)}).")
+    for field, known in (("neae", NEAE_KEYWORDS), ("stages", STAGE_KEYWORDS)):
+        unknown = set(data.get(field, [])) - set(known)
+        if unknown:
+            raise ValueError(f"Recurso {data['id']}: valores de '{field}' desconocidos: {', '.join(sorted(unknown))}.")
+    return data
+
+
+def check_url(url: str, timeout: float = 10) -> tuple:
+    """(http_status, error) for one URL: HEAD first, GET when the server does not accept HEAD"""
+    headers = {"User-Agent": "asistente-neae-link-check/1.0"}
+    for method in ("HEAD", "GET"):
+        try:
+            with urllib.request.urlopen(urllib.request.Request(url, method=method, headers=headers), timeout=timeout) as response:
+                return response.status, None
+        except urllib.error.HTTPError as e:
+            if method == "HEAD" and e.code in (403, 405, 501):
+                continue
+            return e.code, None
+        except Exception as e:
+            return None, str(e)
+    return None, "sin respuesta"
+
+
+class ResourceCatalog:
+    """Local catalog of NEAE resources with verified links, stored in SQLite.
+
+    Entries come from a JSON file (import/refresh command below) and are
+    indexed by NEAE, stage, resource type and the words of their title and
+    description in an inverted index (`resource_terms`). An offline job
+    (check-links) keeps the link health fields up to date. The server loads
+    the entries whose link was found working in the last `max_age_days` and
+    match() picks the ones relevant to a question, so the model can cite them
+    without searching.
+    """
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS resources (
+            id TEXT PRIMARY KEY,
+            title TEXT NOT NULL,
+            url TEXT NOT NULL,
+            description TEXT NOT NULL DEFAULT '',
+            neae TEXT NOT NULL DEFAULT '[]',
+            stages TEXT NOT NULL DEFAULT '[]',
+            type TEXT NOT NULL,
+            source TEXT NOT NULL DEFAULT '',
+            link_status TEXT NOT NULL DEFAULT 'unchecked',
+            http_status INTEGER,
+            link_error TEXT,
+            link_failures INTEGER NOT NULL DEFAULT 0,
+            checked_at REAL,
+            updated_at REAL NOT NULL
+        ) WITHOUT ROWID;
+        CREATE TABLE IF NOT EXISTS resource_terms (
+            term TEXT NOT NULL,
+            resource_id TEXT NOT NULL REFERENCES resources (id) ON DELETE CASCADE,
+            PRIMARY KEY (term, resource_id)
+        ) WITHOUT ROWID;
+        CREATE INDEX IF NOT EXISTS idx_resource_terms_resource ON resource_terms (resource_id);
+        CREATE TABLE IF NOT EXISTS catalog_meta (
+            name TEXT PRIMARY KEY,
+            value TEXT NOT NULL
+        );
+    """
+
+    def __init__(self, path: str | Path, max_results: int = 6, min_score: float = 2.0, max_age_days: float = 30):
+        self.path = str(path)
+        self.max_results = max_results
+        self.min_score = min_score
+        self.max_age_days = max_age_days
+        self._lock = threading.Lock()
+        self._entries = {}
+        self._index = {}
+        self._idf = {}
+        self._version = "vacio"
+        self._matches = 0
+        self._questions = 0
+        with self._connect() as conn:
+            conn.executescript(self.SCHEMA)
+
+    @contextmanager
+    def _connect(self):
+        """Short-lived connection, committed on success: the catalog is read at load time and written offline"""
+        conn = sqlite3.connect(self.path, timeout=30)
+        try:
+            conn.execute("PRAGMA foreign_keys=ON")
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+    # --- Mantenimiento (línea de comandos) ---
+
+    def import_json(self, json_path: str | Path, prune: bool = False) -> dict:
+        """Upsert the entries of a catalog JSON file (a list of resources).
+
+        An entry whose URL is unchanged keeps its link health; a new or changed
+        URL is 'unchecked' until the next check-links run. With `prune`, entries
+        missing from the file are deleted.
+        """
+        with open(json_path, 'r', encoding='utf-8') as f:
+            raw_entries = json.load(f)
+        if not isinstance(raw_entries, list):
+            raise ValueError("El catálogo debe ser una lista de recursos.")
+        entries = [validate_entry(data, position) for position, data in enumerate(raw_entries, start=1)]
+        now = time.time()
+        counts = {"imported": 0, "url_changed": 0, "pruned": 0}
+        with self._connect() as conn:
+            known_urls = dict(conn.execute("SELECT id, url FROM resources"))
+            for data in entries:
+                url_changed = known_urls.get(data["id"], data["url"]) != data["url"]
+                conn.execute(
+                    "INSERT INTO resources (id, title, url, description, neae, stages, type, source, updated_at) "
+                    "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?) ON CONFLICT(id) DO UPDATE SET title = excluded.title, "
+                    "url = excluded.url, description = excluded.description, neae = excluded.neae, "
+                    "stages = excluded.stages, type = excluded.type, source = excluded.source, updated_at = excluded.updated_at",
+                    (data["id"], data["title"], data["url"], data.get("description", ""),
+                     json.dumps(sorted(data.get("neae", []))), json.dumps(sorted(data.get("stages", []))),
+                     data["type"], data.get("source", ""), now),
+                )
+                if url_changed:
+                    conn.execute(
+                        "UPDATE resources SET link_status = ?, http_status = NULL, link_error = NULL, "
+                        "link_failures = 0, checked_at = NULL WHERE id = ?", (LINK_UNCHECKED, data["id"]))
+                    counts["url_changed"] += 1
+                conn.execute("DELETE FROM resource_terms WHERE resource_id = ?", (data["id"],))
+                conn.executemany("INSERT INTO resource_terms (term, resource_id) VALUES (?, ?)",
+                                 [(term, data["id"]) for term in resource_terms(data)])
+                counts["imported"] += 1
+            if prune:
+                missing = set(known_urls) - {data["id"] for data in entries}
+                conn.executemany("DELETE FROM resources WHERE id = ?", [(resource_id,) for resource_id in missing])
+                counts["pruned"] = len(missing)
+            self._touch(conn, now)
+        return counts
+
+    def check_links(self, workers: int = 8, timeout: float = 10, older_than_hours: float = 0) -> dict:
+        """Check every link (or those not checked in `older_than_hours`) and record its health"""
+        cutoff = time.time() - older_than_hours * 3600
+        with self._connect() as conn:
+            rows = conn.execute(
+                "SELECT id, url, link_status, link_failures FROM resources WHERE checked_at IS NULL OR checked_at < ?",
+                (cutoff,),
+            ).fetchall()
+        with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+            results = list(executor.map(lambda row: check_url(row[1], timeout), rows))
+        now = time.time()
+        counts = {LINK_OK: 0, LINK_BROKEN: 0, "retry": 0}
+        with self._connect() as conn:
+            for (resource_id, url, status, failures), (http_status, error) in zip(rows, results):
+                if http_status is not None and 200 <= http_status < 400:
+                    status, failures = LINK_OK, 0
+                else:
+                    failures += 1
+                    if http_status in GONE_STATUSES or failures >= BROKEN_AFTER_FAILURES or status != LINK_OK:
+                        status = LINK_BROKEN
+                if status == LINK_OK and failures:
+                    # Sigue como verificado hasta el siguiente fallo; checked_at conserva la última comprobación correcta
+                    counts["retry"] += 1
+                    conn.execute("UPDATE resources SET http_status = ?, link_error = ?, link_failures = ? WHERE id = ?",
+                                 (http_status, error, failures, resource_id))
+                    continue
+                counts[status] += 1
+                conn.execute(
+                    "UPDATE resources SET link_status = ?, http_status = ?, link_error = ?, link_failures = ?, "
+                    "checked_at = ? WHERE id = ?", (status, http_status, error, failures, now, resource_id))
+            self._touch(conn, now)
+        counts["checked"] = len(rows)
+        return counts
+
+    @staticmethod
+    def _touch(conn, now: float):
+        # Versión del catálogo: cambia con cada importación o comprobación (clave de la caché de respuestas)
+        conn.execute("INSERT OR REPLACE INTO catalog_meta (name, value) VALUES ('updated_at', ?)", (str(now),))
+
+    # --- Consulta (servidor) ---
+
+    def load(self) -> int:
+        """Load the entries with a working link and their index terms into memory; returns how many"""
+        with self._connect() as conn:
+            rows = conn.execute(
+                "SELECT id, title, url, description, neae, stages, type, checked_at FROM resources WHERE link_status = ?",
+                (LINK_OK,),
+            ).fetchall()
+            terms = conn.execute(
+                "SELECT term, resource_id FROM resource_terms JOIN resources ON resources.id = resource_id "
+                "WHERE link_status = ?", (LINK_OK,),
+            ).fetchall()
+            version = conn.execute("SELECT value FROM catalog_meta WHERE name = 'updated_at'").fetchone()
+        entries = {
+            row[0]: Resource(row[0], row[1], row[2], row[3], set(json.loads(row[4])), set(json.loads(row[5])), row[6], row[7])
+            for row in rows
+        }
+        index = defaultdict(set)
+        for term, resource_id in terms:
+            index[term].add(resource_id)
+        total = len(entries)
+        idf = {term: math.log((total + 1) / (len(ids) + 1)) + 1 for term, ids in index.items()}
+        with self._lock:
+            self._entries, self._index, self._idf = entries, dict(index), idf
+            self._version = version[0] if version else "vacio"
+        logger.info(f"📚 Catálogo de recursos: {total} enlaces verificados cargados desde {self.path}")
+        return total
+
+    def signature(self) -> str:
+        """Identifies the loaded catalog, for cache keys of answers that cite it"""
+        return f"resources:{self._version}"
+
+    def match(self, question: str) -> list:
+        """Ids of the verified resources most relevant to a question, best first.
+
+        A resource tagged with NEAE or stages must share one with the question
+        when the question names any; untagged resources apply to all of them.
+        """
+        neae = find_tags(question, NEAE_KEYWORDS)
+        stages = find_tags(question, STAGE_KEYWORDS)
+        types = find_tags(question, RESOURCE_TYPE_KEYWORDS)
+        words = set(tokenize(question))
+        fresh_after = time.time() - self.max_age_days * 86400
+        with self._lock:
+            entries, index, idf = self._entries, self._index, self._idf
+        scores = defaultdict(float)
+        for word in words:
+            for resource_id in index.get(word, ()):
+                scores[resource_id] += 0.5 * idf[word]
+        for tags, prefix, weight in ((neae, "neae", 2.0), (stages, "etapa", 1.0), (types, "tipo", 1.0)):
+            for tag in tags:
+                for resource_id in index.get(f"{prefix}:{tag}", ()):
+                    scores[resource_id] += weight
+        ranked = []
+        for resource_id, score in scores.items():
+            resource = entries.get(resource_id)
+            if resource is None or score < self.min_score or (resource.checked_at or 0) < fresh_after:
+                continue
+            if (neae and resource.neae and not neae & resource.neae) or (stages and resource.stages and not stages & resource.stages):
+                continue
+            ranked.append((score, resource_id))
+        ranked.sort(key=lambda item: (-item[0], item[1]))
+        chosen = [resource_id for _, resource_id in ranked[:self.max_results]]
+        with self._lock:
+            self._questions += 1
+            self._matches += bool(chosen)
+        return chosen
+
+    def render(self, resource_ids) -> str:
+        """Prompt block listing the given resources; ids no longer verified are skipped ('' if none remain)"""
+        with self._lock:
+            entries = self._entries
+        lines = []
+        for resource_id in resource_ids or ():
+            resource = entries.get(resource_id)
+            if resource is None:
+                continue
+            details = ", ".join([resource.type] + [stage for stage in STAGE_KEYWORDS if stage in resource.stages])
+            description = f": {resource.description}" if resource.description else ""
+            lines.append(f"- {TYPE_ICONS[resource.type]} {resource.title} ({details}){description} 📄 Enlace: {resource.url}")
+        if not lines:
+            return ""
+        return (
+            "**📚 Recursos verificados del catálogo local:**\n"
+            f"Estos enlaces se han comprobado automáticamente en los últimos {self.max_age_days:g} días. "
+            "Cítalos con su URL exacta cuando sean pertinentes, sin necesidad de buscarlos ni verificarlos de nuevo; "
+            "cualquier otro recurso sigue sujeto al protocolo de verificación de enlaces.\n"
+            + "\n".join(lines)
+        )
+
+    def stats(self):
+        with self._connect() as conn:
+            link_health = dict(conn.execute("SELECT link_status, COUNT(*) FROM resources GROUP BY link_status"))
+        with self._lock:
+            return {
+                "database": self.path,
+                "version": self._version,
+                "loaded": len(self._entries),
+                "index_terms": len(self._index),
+                "link_health": link_health,
+                "max_results": self.max_results,
+                "max_age_days": self.max_age_days,
+                "questions": self._questions,
+                "questions_with_resources": self._matches,
+            }
+
+
+def create_resource_catalog():
+    """ResourceCatalog loaded from RESOURCE_CATALOG_DB, or None when disabled or not built yet"""
+    if os.getenv("RESOURCE_CATALOG_ENABLED", "1").lower() not in ("1", "true", "yes"):
+        return None
+    db_path = Path(os.getenv("RESOURCE_CATALOG_DB", Path(__file__).parent / "resource_catalog.db"))
+    if not db_path.exists():
+        logger.info(f"📚 Sin catálogo de recursos en {db_path}; créalo con 'python resource_catalog.py import'")
+        return None
+    catalog = ResourceCatalog(
+        db_path,
+        max_results=int(os.getenv("RESOURCE_CATALOG_MAX_RESULTS", "6")),
+        min_score=float(os.getenv("RESOURCE_CATALOG_MIN_SCORE", "2")),
+        max_age_days=float(os.getenv("RESOURCE_CATALOG_MAX_AGE_DAYS", "30")),
+    )
+    catalog.load()
+    return catalog
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Gestión del catálogo local de recursos NEAE")
+    parser.add_argument("--db", default=os.getenv("RESOURCE_CATALOG_DB", str(Path(__file__).parent / "resource_catalog.db")))
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    import_parser = subparsers.add_parser("import", help="Importar (o actualizar) recursos desde un JSON")
+    refresh_parser = subparsers.add_parser("refresh", help="Importar con --prune y comprobar los enlaces nuevos o caducados")
+    for command_parser in (import_parser, refresh_parser):
+        command_parser.add_argument("json_path", nargs="?", default=str(Path(__file__).parent / "resource_catalog.json"))
+    import_parser.add_argument("--prune", action="store_true", help="Eliminar los recursos que ya no están en el JSON")
+    check_parser = subparsers.add_parser("check-links", help="Comprobar los enlaces y actualizar su estado")
+    for command_parser in (refresh_parser, check_parser):
+        command_parser.add_argument("--older-than", type=float, default=24, metavar="HORAS",
+                                    help="Solo enlaces no comprobados en las últimas HORAS (0 = todos)")
+        command_parser.add_argument("--workers", type=int, default=8)
+        command_parser.add_argument("--timeout", type=float, default=10)
+    search_parser = subparsers.add_parser("search", help="Mostrar los recursos que se inyectarían para una pregunta")
+    search_parser.add_argument("pregunta")
+    args = parser.parse_args()
+
+    catalog = ResourceCatalog(args.db)
+    if args.command in ("import", "refresh"):
+        counts = catalog.import_json(args.json_path, prune=args.command == "refresh" or args.prune)
+        print(f"📥 {counts['imported']} recursos importados de {args.json_path} "
+              f"({counts['url_changed']} con URL nueva, {counts['pruned']} eliminados)")
+    if args.command in ("check-links", "refresh"):
+        counts = catalog.check_links(workers=args.workers, timeout=args.timeout, older_than_hours=args.older_than)
+        print(f"🔗 {counts['checked']} enlaces comprobados: {counts[LINK_OK]} correctos, "
+              f"{counts[LINK_BROKEN]} rotos, {counts['retry']} pendientes de confirmar")
+    if args.command == "search":
+        catalog.load()
+        print(catalog.render(catalog.match(args.pregunta)) or "Ningún recurso verificado coincide con la pregunta.")
@@ -0,0 +1,165 @@
+import hashlib
+import json
+import logging
+import os
+import re
+import tempfile
+import threading
+import time
+import unicodedata
+from collections import OrderedDict
+from pathlib import Path
+
+logger = logging.getLogger(__name__)
+
+
+def normalize_question(text: str) -> str:
+    """Lowercase, strip accents and punctuation and collapse whitespace"""
+    text = unicodedata.normalize("NFKD", text.lower())
+    text = "".join(ch for ch in text if not unicodedata.combining(ch))
+    text = re.sub(r"[^\w\s]", " ", text)
+    return " ".join(text.split())
+
+
+def prompt_version(system_prompt: str, model_name: str) -> str:
+    """Short hash identifying the prompt text and model an answer was generated with"""
+    return hashlib.sha256(f"{model_name}\0{system_prompt}".encode("utf-8")).hexdigest()[:16]
+
+
+class ResponseCache:
+    """LRU + TTL cache of answers to the first question of a session.
+
+    Keys combine the normalized question with the prompt/model version, so
+    editing prompt.txt or changing MODEL_NAME never serves stale answers. With
+    `persist_path` the cache is loaded at startup and written back atomically
+    every `persist_every` new entries and on close(). Periodic writes happen in
+    a background thread, so put() never does file I/O on the caller's thread.
+    """
+
+    def __init__(self, version: str, max_entries: int = 500, ttl: float = 86400,
+                 persist_path: str | Path | None = None, persist_every: int = 20):
+        self.version = version
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.persist_path = Path(persist_path) if persist_path else None
+        self.persist_every = persist_every
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._unsaved = 0
+        self._hits = 0
+        self._misses = 0
+        self._evictions = 0
+        self._expired = 0
+        self._wakeup = threading.Event()
+        self._stopped = threading.Event()
+        self._writer = None
+        if self.persist_path:
+            self._load()
+
+    def key(self, question: str) -> str:
+        return f"{self.version}:{normalize_question(question)}"
+
+    def get(self, question: str):
+        """Cached answer dict for a first question, or None"""
+        key = self.key(question)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and self.ttl and time.time() - entry["created_at"] > self.ttl:
+                del self._entries[key]
+                self._expired += 1
+                entry = None
+            if entry is None:
+                self._misses += 1
+                return None
+            self._hits += 1
+            self._entries.move_to_end(key)
+            return dict(entry)
+
+    def put(self, question: str, respuesta: str, usage: dict | None = None):
+        key = self.key(question)
+        with self._lock:
+            self._entries[key] = {"respuesta": respuesta, "usage": usage, "created_at": time.time()}
+            self._entries.move_to_end(key)
+            while self.max_entries and len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self._evictions += 1
+            self._unsaved += 1
+            should_persist = self.persist_path and self._unsaved >= self.persist_every
+        if should_persist:
+            self._start_writer()
+            self._wakeup.set()
+
+    def _start_writer(self):
+        with self._lock:
+            if self._writer is not None or self._stopped.is_set():
+                return
+            self._writer = threading.Thread(target=self._persist_loop, name="response-cache", daemon=True)
+        self._writer.start()
+
+    def _persist_loop(self):
+        while True:
+            self._wakeup.wait()
+            self._wakeup.clear()
+            if self._stopped.is_set():
+                return  # close() hace la escritura final
+            self.persist()
+
+    def _load(self):
+        if not self.persist_path.exists():
+            return
+        try:
+            with open(self.persist_path, 'r', encoding='utf-8') as f:
+                stored = json.load(f)
+        except Exception as e:
+            logger.warning(f"⚠️ No se pudo leer la caché de respuestas {self.persist_path}: {e}")
+            return
+        now = time.time()
+        for key, entry in stored.items():
+            # Entradas de otra versión del prompt o caducadas se descartan al cargar
+            if key.startswith(f"{self.version}:") and not (self.ttl and now - entry["created_at"] > self.ttl):
+                self._entries[key] = entry
+        logger.info(f"🗃️ {len(self._entries)} respuestas cargadas desde {self.persist_path}")
+
+    def persist(self):
+        """Atomically write the cache to `persist_path`"""
+        if not self.persist_path:
+            return
+        with self._lock:
+            data = json.dumps(self._entries, ensure_ascii=False)
+            self._unsaved = 0
+        tmp_path = None
+        try:
+            fd, tmp_path = tempfile.mkstemp(dir=self.persist_path.parent, prefix=f".{self.persist_path.name}.", suffix=".tmp")
+            with os.fdopen(fd, 'w', encoding='utf-8') as f:
+                f.write(data)
+            os.replace(tmp_path, self.persist_path)
+        except Exception as e:
+            logger.error(f"❌ Error al guardar la caché de respuestas: {e}")
+            if tmp_path and os.path.exists(tmp_path):
+                os.unlink(tmp_path)
+
+    def close(self):
+        """Stop the background writer and write any unsaved entries"""
+        self._stopped.set()
+        self._wakeup.set()
+        if self._writer is not None:
+            self._writer.join(timeout=10)
+        if self.persist_path and self._unsaved:
+            self.persist()
+
+    def stats(self):
+        with self._lock:
+            lookups = self._hits + self._misses
+            return {
+                "enabled": True,
+                "prompt_version": self.version,
+                "entries": len(self._entries),
+                "max_entries": self.max_entries,
+                "ttl_seconds": self.ttl,
+                "persist_path": str(self.persist_path) if self.persist_path else None,
+                "hits": self._hits,
+                "misses": self._misses,
+                "hit_ratio": round(self._hits / lookups, 3) if lookups else 0,
+                "evictions": self._evictions,
+                "expired": self._expired,
+            }
@@ -0,0 +1,408 @@
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from pathlib import Path
+
+logger = logging.getLogger(__name__)
+
+
+def serialize_history(history) -> list:
+    """Convert a ChatSession history (protos.Content or dicts) into compact role/parts records"""
+    records = []
+    for content in history or []:
+        if isinstance(content, dict):
+            role, parts = content.get("role"), content.get("parts", [])
+        else:
+            role, parts = getattr(content, "role", None), getattr(content, "parts", [])
+        texts = [part if isinstance(part, str) else getattr(part, "text", "") for part in parts]
+        records.append({"role": role or "model", "parts": [text for text in texts if text]})
+    return records
+
+
+def estimate_history_bytes(history) -> int:
+    """Approximate memory held by a serialized history: UTF-8 size of its text parts"""
+    return sum(len(text.encode("utf-8")) for content in history or [] for text in content["parts"])
+
+
+class SessionRecord:
+    """Serializable state of one chat session; the ChatSession is rebuilt from it on access"""
+
+    __slots__ = ("session_id", "auth_key", "history", "created_at", "last_access", "size", "prompt_selection")
+
+    def __init__(self, session_id: str, auth_key: str, history: list | None = None,
+                 created_at: float | None = None, last_access: float | None = None,
+                 prompt_selection: dict | None = None):
+        self.session_id = session_id
+        self.auth_key = auth_key
+        self.history = history or []
+        self.prompt_selection = prompt_selection  # Secciones de prompt.txt elegidas en la primera pregunta
+        self.created_at = created_at or time.time()
+        self.last_access = last_access or self.created_at
+        self.size = estimate_history_bytes(self.history)
+
+
+class SessionBackend(ABC):
+    """Interface for chat session storage.
+
+    Sessions expire after `idle_ttl` seconds without use. When the backend holds
+    more than `max_entries` sessions or more than `max_bytes` of history, the
+    least recently used ones are evicted. Each auth_key keeps at most
+    `max_per_user` sessions; starting another one evicts that user's oldest.
+    """
+
+    EVICTION_REASONS = ("idle", "lru", "bytes", "per_user")
+    # True when calls do disk I/O and should run in a worker thread, not on the event loop
+    blocking = False
+
+    def __init__(self, idle_ttl: float = 3600, max_entries: int = 1000,
+                 max_bytes: int = 256 * 1024 * 1024, max_per_user: int = 5):
+        self.idle_ttl = idle_ttl
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.max_per_user = max_per_user
+
+    @abstractmethod
+    def create(self, session_id: str, auth_key: str) -> SessionRecord:
+        """Register a new, empty session, evicting whatever the limits require"""
+
+    @abstractmethod
+    def get(self, session_id: str, auth_key: str | None = None) -> SessionRecord | None:
+        """Return the session and mark it as recently used, or None if missing, expired or not owned"""
+
+    @abstractmethod
+    def save(self, record: SessionRecord):
+        """Persist the (grown) history of an existing session"""
+
+    @abstractmethod
+    def delete(self, session_id: str):
+        """Remove a session (no-op if it does not exist)"""
+
+    @abstractmethod
+    def sweep(self) -> int:
+        """Drop every expired session; returns how many were removed"""
+
+    @abstractmethod
+    def stats(self) -> dict:
+        """Size, limits and hit/eviction counters for /admin/sessions-status"""
+
+    def close(self):
+        pass
+
+    def __len__(self):
+        return self.stats()["sessions"]
+
+    def _limits(self):
+        return {
+            "max_entries": self.max_entries,
+            "max_bytes": self.max_bytes,
+            "max_per_user": self.max_per_user,
+            "idle_ttl_seconds": self.idle_ttl,
+        }
+
+
+class MemorySessionBackend(SessionBackend):
+    """Process-local backend; only valid with a single uvicorn worker"""
+
+    def __init__(self, **limits):
+        super().__init__(**limits)
+        self._entries = OrderedDict()
+        self._by_user = {}
+        self._lock = threading.Lock()
+        self._resident_bytes = 0
+        self._hits = 0
+        self._misses = 0
+        self._evictions = dict.fromkeys(self.EVICTION_REASONS, 0)
+
+    def create(self, session_id: str, auth_key: str) -> SessionRecord:
+        record = SessionRecord(session_id, auth_key)
+        with self._lock:
+            user_sessions = self._by_user.setdefault(auth_key, OrderedDict())
+            while self.max_per_user and len(user_sessions) >= self.max_per_user:
+                self._remove(next(iter(user_sessions)), "per_user")
+            self._entries[session_id] = record
+            user_sessions[session_id] = None
+            self._resident_bytes += record.size
+            self._enforce_limits()
+        return record
+
+    def get(self, session_id: str, auth_key: str | None = None) -> SessionRecord | None:
+        with self._lock:
+            record = self._entries.get(session_id)
+            if record is not None and self._is_expired(record, time.time()):
+                self._remove(session_id, "idle")
+                record = None
+            if record is None or (auth_key is not None and record.auth_key != auth_key):
+                self._misses += 1
+                return None
+            self._hits += 1
+            record.last_access = time.time()
+            self._entries.move_to_end(session_id)
+            self._by_user[record.auth_key].move_to_end(session_id)
+            # Copia: el llamador modifica el historial y lo guarda con save()
+            return SessionRecord(record.session_id, record.auth_key, list(record.history),
+                                 record.created_at, record.last_access, record.prompt_selection)
+
+    def save(self, record: SessionRecord):
+        with self._lock:
+            stored = self._entries.get(record.session_id)
+            if stored is None:
+                return  # Expulsada mientras el modelo respondía
+            size = estimate_history_bytes(record.history)
+            self._resident_bytes += size - stored.size
+            stored.history = list(record.history)
+            stored.prompt_selection = record.prompt_selection
+            stored.size = size
+            stored.last_access = time.time()
+            self._enforce_limits()
+
+    def delete(self, session_id: str):
+        with self._lock:
+            if session_id in self._entries:
+                self._remove(session_id, None)
+
+    def sweep(self) -> int:
+        now = time.time()
+        with self._lock:
+            expired = [sid for sid, record in self._entries.items() if self._is_expired(record, now)]
+            for session_id in expired:
+                self._remove(session_id, "idle")
+        return len(expired)
+
+    def _is_expired(self, record: SessionRecord, now: float) -> bool:
+        return bool(self.idle_ttl) and now - record.last_access > self.idle_ttl
+
+    def _enforce_limits(self):
+        while self.max_entries and len(self._entries) > self.max_entries:
+            self._remove(next(iter(self._entries)), "lru")
+        # Always keep the most recent session, even if it alone exceeds the budget
+        while self.max_bytes and self._resident_bytes > self.max_bytes and len(self._entries) > 1:
+            self._remove(next(iter(self._entries)), "bytes")
+
+    def _remove(self, session_id: str, reason: str | None):
+        record = self._entries.pop(session_id)
+        self._resident_bytes -= record.size
+        user_sessions = self._by_user.get(record.auth_key)
+        if user_sessions is not None:
+            user_sessions.pop(session_id, None)
+            if not user_sessions:
+                del self._by_user[record.auth_key]
+        if reason:
+            self._evictions[reason] += 1
+
+    def stats(self):
+        with self._lock:
+            return {
+                "backend": "memory",
+                "sessions": len(self._entries),
+                "users": len(self._by_user),
+                "resident_bytes": self._resident_bytes,
+                **self._limits(),
+                "hits": self._hits,
+                "misses": self._misses,
+                "evictions": dict(self._evictions),
+                "evictions_total": sum(self._evictions.values()),
+            }
+
+
+class SQLiteSessionBackend(SessionBackend):
+    """Backend in a SQLite file shared by every worker process on the host.
+
+    History is stored as JSON role/parts records. Eviction counters live in the
+    same database so /admin/sessions-status reports totals for all workers.
+    Every call reads or commits to disk, so the server runs them in a worker
+    thread (`blocking`); the shared connection is serialized by a lock.
+    """
+
+    blocking = True
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS sessions (
+            session_id TEXT PRIMARY KEY,
+            auth_key TEXT NOT NULL,
+            history TEXT NOT NULL,
+            size INTEGER NOT NULL,
+            created_at REAL NOT NULL,
+            last_access REAL NOT NULL,
+            prompt_selection TEXT
+        );
+        CREATE INDEX IF NOT EXISTS idx_sessions_auth_key ON sessions (auth_key, last_access);
+        CREATE INDEX IF NOT EXISTS idx_sessions_last_access ON sessions (last_access);
+        CREATE TABLE IF NOT EXISTS session_evictions (
+            reason TEXT PRIMARY KEY,
+            count INTEGER NOT NULL
+        );
+    """
+
+    def __init__(self, path: str | Path, **limits):
+        super().__init__(**limits)
+        self.path = str(path)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(self.path, timeout=30, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.executescript(self.SCHEMA)
+        columns = {row[1] for row in self._conn.execute("PRAGMA table_info(sessions)")}
+        if "prompt_selection" not in columns:
+            # Bases de datos creadas antes de la selección de secciones del prompt
+            self._conn.execute("ALTER TABLE sessions ADD COLUMN prompt_selection TEXT")
+        self._conn.executemany(
+            "INSERT OR IGNORE INTO session_evictions (reason, count) VALUES (?, 0)",
+            [(reason,) for reason in self.EVICTION_REASONS],
+        )
+        self._hits = 0
+        self._misses = 0
+
+    def _transaction(self):
+        return _SQLiteTransaction(self._conn, self._lock)
+
+    def create(self, session_id: str, auth_key: str) -> SessionRecord:
+        record = SessionRecord(session_id, auth_key)
+        with self._transaction() as conn:
+            if self.max_per_user:
+                stale = conn.execute(
+                    "SELECT session_id FROM sessions WHERE auth_key = ? ORDER BY last_access DESC LIMIT -1 OFFSET ?",
+                    (auth_key, self.max_per_user - 1),
+                ).fetchall()
+                self._evict(conn, [row[0] for row in stale], "per_user")
+            conn.execute(
+                "INSERT INTO sessions (session_id, auth_key, history, size, created_at, last_access) VALUES (?, ?, ?, ?, ?, ?)",
+                (session_id, auth_key, "[]", 0, record.created_at, record.last_access),
+            )
+            self._enforce_limits(conn)
+        return record
+
+    def get(self, session_id: str, auth_key: str | None = None) -> SessionRecord | None:
+        now = time.time()
+        with self._transaction() as conn:
+            row = conn.execute(
+                "SELECT auth_key, history, created_at, last_access, prompt_selection FROM sessions WHERE session_id = ?",
+                (session_id,),
+            ).fetchone()
+            if row is not None and self.idle_ttl and now - row[3] > self.idle_ttl:
+                self._evict(conn, [session_id], "idle")
+                row = None
+            if row is None or (auth_key is not None and row[0] != auth_key):
+                self._misses += 1
+                return None
+            conn.execute("UPDATE sessions SET last_access = ? WHERE session_id = ?", (now, session_id))
+        self._hits += 1
+        return SessionRecord(session_id, row[0], json.loads(row[1]), row[2], now,
+                             json.loads(row[4]) if row[4] else None)
+
+    def save(self, record: SessionRecord):
+        history = json.dumps(record.history, ensure_ascii=False, separators=(",", ":"))
+        selection = json.dumps(record.prompt_selection) if record.prompt_selection else None
+        with self._transaction() as conn:
+            conn.execute(
+                "UPDATE sessions SET history = ?, size = ?, last_access = ?, prompt_selection = ? WHERE session_id = ?",
+                (history, estimate_history_bytes(record.history), time.time(), selection, record.session_id),
+            )
+            self._enforce_limits(conn)
+
+    def delete(self, session_id: str):
+        with self._transaction() as conn:
+            conn.execute("DELETE FROM sessions WHERE session_id = ?", (session_id,))
+
+    def sweep(self) -> int:
+        if not self.idle_ttl:
+            return 0
+        with self._transaction() as conn:
+            expired = conn.execute(
+                "SELECT session_id FROM sessions WHERE last_access < ?", (time.time() - self.idle_ttl,)
+            ).fetchall()
+            self._evict(conn, [row[0] for row in expired], "idle")
+        return len(expired)
+
+    def _enforce_limits(self, conn):
+        if self.max_entries:
+            overflow = conn.execute(
+                "SELECT session_id FROM sessions ORDER BY last_access DESC LIMIT -1 OFFSET ?", (self.max_entries,)
+            ).fetchall()
+            self._evict(conn, [row[0] for row in overflow], "lru")
+        if self.max_bytes:
+            total = conn.execute("SELECT COALESCE(SUM(size), 0) FROM sessions").fetchone()[0]
+            if total > self.max_bytes:
+                victims = []
+                # Always keep the most recent session, even if it alone exceeds the budget
+                rows = conn.execute("SELECT session_id, size FROM sessions ORDER BY last_access").fetchall()
+                for session_id, size in rows[:-1]:
+                    if total <= self.max_bytes:
+                        break
+                    victims.append(session_id)
+                    total -= size
+                self._evict(conn, victims, "bytes")
+
+    def _evict(self, conn, session_ids: list, reason: str):
+        if not session_ids:
+            return
+        conn.executemany("DELETE FROM sessions WHERE session_id = ?", [(sid,) for sid in session_ids])
+        conn.execute("UPDATE session_evictions SET count = count + ? WHERE reason = ?", (len(session_ids), reason))
+
+    def stats(self):
+        with self._lock:
+            sessions, users, resident = self._conn.execute(
+                "SELECT COUNT(*), COUNT(DISTINCT auth_key), COALESCE(SUM(size), 0) FROM sessions"
+            ).fetchone()
+            evictions = dict(self._conn.execute("SELECT reason, count FROM session_evictions").fetchall())
+        return {
+            "backend": "sqlite",
+            "path": self.path,
+            "sessions": sessions,
+            "users": users,
+            "resident_bytes": resident,
+            **self._limits(),
+            "hits": self._hits,
+            "misses": self._misses,
+            "evictions": evictions,
+            "evictions_total": sum(evictions.values()),
+        }
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+class _SQLiteTransaction:
+    """Serializes access to the shared connection and wraps it in BEGIN IMMEDIATE/COMMIT"""
+
+    def __init__(self, conn, lock):
+        self.conn = conn
+        self.lock = lock
+
+    def __enter__(self):
+        self.lock.acquire()
+        try:
+            self.conn.execute("BEGIN IMMEDIATE")
+        except BaseException:
+            self.lock.release()
+            raise
+        return self.conn
+
+    def __exit__(self, exc_type, exc, tb):
+        try:
+            self.conn.execute("ROLLBACK" if exc_type else "COMMIT")
+        finally:
+            self.lock.release()
+
+
+def create_session_backend() -> SessionBackend:
+    """Build the session backend selected by SESSION_BACKEND (memory or sqlite)"""
+    limits = {
+        "idle_ttl": float(os.getenv("SESSION_IDLE_TTL", "3600")),
+        "max_entries": int(os.getenv("SESSION_MAX_ENTRIES", "1000")),
+        "max_bytes": int(os.getenv("SESSION_MAX_BYTES", str(256 * 1024 * 1024))),
+        "max_per_user": int(os.getenv("SESSION_MAX_PER_USER", "5")),
+    }
+    backend = os.getenv("SESSION_BACKEND", "memory").lower()
+    if backend == "sqlite":
+        path = os.getenv("SESSION_DB_PATH", str(Path(__file__).parent / "chat_sessions.db"))
+        logger.info(f"🗄️ Sesiones de chat en SQLite: {path}")
+        return SQLiteSessionBackend(path, **limits)
+    if backend != "memory":
+        logger.warning(f"⚠️ SESSION_BACKEND '{backend}' desconocido; usando memoria")
+    return MemorySessionBackend(**limits)
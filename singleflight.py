@@ -0,0 +1,64 @@
+import asyncio
+import os
+
+
+class SingleFlight:
+    """Coalesces identical concurrent calls: one upstream call per key, shared by every caller.
+
+    The first caller for a key starts `call()` as a task; callers arriving
+    while it is still running wait for the same task instead of starting
+    another. Every waiter gets the result or the exception. If one waiter
+    goes away (e.g. its client disconnects), the call keeps running for the
+    others. It is cancelled only when no waiter is left. Only in-flight calls
+    are shared; finished ones are forgotten at once (the response cache covers
+    those). Runs on the event loop only.
+    """
+
+    def __init__(self):
+        self._inflight = {}  # key -> [task, waiters]
+        self._calls = 0
+        self._coalesced = 0
+        self._max_waiters = 0
+
+    async def do(self, key: str, call):
+        """Await the shared result of `call()` for `key`; returns (result, coalesced)"""
+        flight = self._inflight.get(key)
+        coalesced = flight is not None
+        if coalesced:
+            flight[1] += 1
+            self._coalesced += 1
+            self._max_waiters = max(self._max_waiters, flight[1])
+        else:
+            task = asyncio.ensure_future(call())
+            flight = self._inflight[key] = [task, 1]
+            self._calls += 1
+            task.add_done_callback(lambda done: self._finish(key, done))
+        task = flight[0]
+        try:
+            return await asyncio.shield(task), coalesced
+        except asyncio.CancelledError:
+            flight[1] -= 1
+            if not flight[1] and not task.done():
+                task.cancel()  # Nadie espera ya la respuesta
+            raise
+
+    def _finish(self, key: str, task):
+        if self._inflight.get(key, (None,))[0] is task:
+            del self._inflight[key]
+        if not task.cancelled():
+            task.exception()  # Marcada como leída aunque todos los que esperaban se hayan ido
+
+    def stats(self):
+        return {
+            "in_flight": len(self._inflight),
+            "upstream_calls": self._calls,
+            "coalesced_requests": self._coalesced,
+            "max_waiters": self._max_waiters,
+        }
+
+
+def create_single_flight():
+    """SingleFlight for first questions, or None with SINGLE_FLIGHT_ENABLED=0"""
+    if os.getenv("SINGLE_FLIGHT_ENABLED", "1").lower() not in ("1", "true", "yes"):
+        return None
+    return SingleFlight()
@@ -0,0 +1,217 @@
+import gzip
+import hashlib
+import json
+import logging
+import mimetypes
+import os
+import re
+from pathlib import Path
+
+from starlette.requests import Request
+from starlette.responses import Response
+from starlette.staticfiles import StaticFiles
+
+try:
+    import brotli  # Opcional: sin el paquete solo se sirven variantes gzip
+except ImportError:
+    brotli = None
+
+logger = logging.getLogger(__name__)
+
+# Referencias a otros ficheros estáticos dentro de HTML, JS y CSS
+ASSET_REF_RE = re.compile(r"/static/([\w./-]+\.\w+)")
+TEXT_SUFFIXES = (".html", ".js", ".css", ".json", ".svg", ".txt")
+COMPRESSIBLE_SUFFIXES = TEXT_SUFFIXES + (".ico",)
+ROUTER_PATH = "js/router.js"
+BUNDLE_PATH = "js/views.bundle.js"
+IMMUTABLE = "public, max-age=31536000, immutable"
+REVALIDATE = "no-cache"
+
+
+class Asset:
+    """One static file held in memory with its precompressed variants"""
+
+    __slots__ = ("path", "url", "hashed_url", "media_type", "digest", "variants")
+
+    def __init__(self, path: str, body: bytes, min_compress_size: int):
+        self.path = path
+        self.media_type = mimetypes.guess_type(path)[0] or "application/octet-stream"
+        if self.media_type.startswith("text/") or self.media_type in ("application/javascript", "application/json"):
+            self.media_type += "; charset=utf-8"
+        self.digest = hashlib.sha256(body).hexdigest()
+        stem, dot, suffix = path.rpartition(".")
+        self.url = f"/static/{path}"
+        self.hashed_url = f"/static/{stem}.{self.digest[:10]}.{suffix}" if dot else self.url
+        self.variants = {"identity": body}
+        if path.endswith(COMPRESSIBLE_SUFFIXES) and len(body) >= min_compress_size:
+            compressed = {"gzip": gzip.compress(body, compresslevel=9, mtime=0)}
+            if brotli is not None:
+                compressed["br"] = brotli.compress(body, quality=11)
+            for encoding, data in compressed.items():
+                if len(data) < len(body) * 0.9:  # Solo si ahorra algo apreciable
+                    self.variants[encoding] = data
+
+    def etag(self, encoding: str) -> str:
+        # ETag fuerte por representación: cada codificación es un cuerpo distinto
+        return f'"{self.digest[:32]}"' if encoding == "identity" else f'"{self.digest[:32]}-{encoding}"'
+
+
+def accepted_encodings(header: str) -> set:
+    """Content codings the client accepts (q > 0) from an Accept-Encoding header"""
+    accepted = set()
+    for item in header.split(","):
+        coding, _, params = item.strip().partition(";")
+        quality = params.strip()
+        if quality.startswith("q="):
+            try:
+                if float(quality[2:]) <= 0:
+                    continue
+            except ValueError:
+                continue
+        if coding:
+            accepted.add(coding.strip().lower())
+    return accepted
+
+
+class StaticAssets:
+    """In-memory static pipeline for the SPA in frontend/static.
+
+    At startup every file is read once, references between files
+    (`/static/...` in HTML, JS and CSS) are rewritten to content-hashed URLs
+    and compressible files get gzip (and brotli, if the package is installed)
+    variants. Hashed URLs are served with an immutable Cache-Control; the
+    plain URLs and index.html revalidate with strong ETags (304 when
+    unchanged). index.html preloads the view templates and scripts that
+    router.js loads, or with views="bundle" includes them all in one script.
+    Files added after startup are served from disk as before.
+    """
+
+    def __init__(self, directory: str | Path, views: str = "preload", min_compress_size: int = 512):
+        self.directory = Path(directory)
+        self.views = views
+        self.min_compress_size = min_compress_size
+        self.fallback = StaticFiles(directory=str(self.directory))
+        self._sources = {}
+        self._assets = {}  # ruta relativa -> Asset
+        self._by_url = {}  # URL (normal o con hash) -> (Asset, Cache-Control)
+        self.index = None
+        self._build()
+
+    def _build(self):
+        for file in sorted(self.directory.rglob("*")):
+            if file.is_file() and not file.name.startswith("."):
+                self._sources[file.relative_to(self.directory).as_posix()] = file.read_bytes()
+        for path in self._sources:
+            self._asset(path, ())
+        view_urls = self._view_urls()
+        if self.views == "bundle" and view_urls:
+            bundle = {url: self._by_url[url][0].variants["identity"].decode("utf-8") for url in view_urls}
+            body = ("// Vistas del SPA en un solo fichero (generado por static_assets.py)\n"
+                    f"window.NEAE_VIEW_BUNDLE = {json.dumps(bundle, ensure_ascii=False)};\n").encode("utf-8")
+            self._register(Asset(BUNDLE_PATH, body, self.min_compress_size))
+        self.index = Asset("index.html", self._index_html(view_urls), self.min_compress_size)
+        total = sum(len(asset.variants["identity"]) for asset in self._assets.values())
+        logger.info(f"📦 {len(self._assets)} ficheros estáticos en memoria ({total // 1024} KB, "
+                    f"{'brotli y gzip' if brotli else 'gzip'}; vistas: {self.views})")
+
+    def _asset(self, path: str, building: tuple) -> Asset:
+        """Build an asset after the ones it references, so its hash covers their hashed URLs"""
+        asset = self._assets.get(path)
+        if asset is not None:
+            return asset
+        body = self._sources[path]
+        if path.endswith(TEXT_SUFFIXES):
+            text = body.decode("utf-8")
+
+            def hashed(match):
+                target = match.group(1)
+                if target == path or target not in self._sources or target in building:
+                    return match.group(0)
+                return self._asset(target, building + (path,)).hashed_url
+
+            body = ASSET_REF_RE.sub(hashed, text).encode("utf-8")
+        asset = Asset(path, body, self.min_compress_size)
+        self._register(asset)
+        return asset
+
+    def _register(self, asset: Asset):
+        self._assets[asset.path] = asset
+        self._by_url[asset.url] = (asset, REVALIDATE)
+        self._by_url[asset.hashed_url] = (asset, IMMUTABLE)
+
+    def _view_urls(self) -> list:
+        # Plantillas y scripts de las vistas que carga router.js (ya con sus URL con hash)
+        router = self._assets.get(ROUTER_PATH)
+        if router is None:
+            return []
+        text = router.variants["identity"].decode("utf-8")
+        return [url for url in dict.fromkeys(re.findall(r"/static/views/[\w./-]+", text)) if url in self._by_url]
+
+    def _index_html(self, view_urls: list) -> bytes:
+        text = ASSET_REF_RE.sub(
+            lambda match: self._assets[match.group(1)].hashed_url if match.group(1) in self._assets else match.group(0),
+            self._sources["index.html"].decode("utf-8"),
+        )
+        if self.views == "bundle" and BUNDLE_PATH in self._assets:
+            router_tag = f'<script src="{self._assets[ROUTER_PATH].hashed_url}"></script>'
+            text = text.replace(router_tag, f'<script src="{self._assets[BUNDLE_PATH].hashed_url}"></script>\n    {router_tag}')
+        elif self.views == "preload" and view_urls:
+            links = "\n".join(
+                f'    <link rel="preload" href="{url}" as="script">' if url.endswith(".js")
+                else f'    <link rel="preload" href="{url}" as="fetch" crossorigin>'
+                for url in view_urls
+            )
+            text = text.replace("</head>", f"{links}\n</head>", 1)
+        return text.encode("utf-8")
+
+    def response(self, request: Request, asset: Asset, cache_control: str) -> Response:
+        """Best encoding the client accepts, or 304 when its If-None-Match already has it"""
+        accepted = accepted_encodings(request.headers.get("accept-encoding", ""))
+        encoding = next((name for name in ("br", "gzip") if name in asset.variants and name in accepted), "identity")
+        etag = asset.etag(encoding)
+        headers = {"ETag": etag, "Cache-Control": cache_control, "Vary": "Accept-Encoding"}
+        if_none_match = request.headers.get("if-none-match", "")
+        if if_none_match.strip() == "*" or etag in [tag.strip() for tag in if_none_match.split(",")]:
+            return Response(status_code=304, headers=headers)
+        body = asset.variants[encoding]
+        if encoding != "identity":
+            headers["Content-Encoding"] = encoding
+        if request.method == "HEAD":
+            headers["Content-Length"] = str(len(body))
+            body = b""
+        return Response(body, media_type=asset.media_type, headers=headers)
+
+    def index_response(self, request: Request) -> Response:
+        return self.response(request, self.index, REVALIDATE)
+
+    async def __call__(self, scope, receive, send):
+        # Montado en /static: lo que no está en memoria se sirve desde disco con StaticFiles
+        if scope["type"] == "http" and scope["method"] in ("GET", "HEAD"):
+            found = self._by_url.get("/static/" + Path(self.fallback.get_path(scope)).as_posix())
+            if found is not None:
+                await self.response(Request(scope, receive), *found)(scope, receive, send)
+                return
+        await self.fallback(scope, receive, send)
+
+    def stats(self):
+        return {
+            "files": len(self._assets),
+            "bytes": sum(len(asset.variants["identity"]) for asset in self._assets.values()),
+            "compressed_bytes": {
+                encoding: sum(len(asset.variants.get(encoding, asset.variants["identity"])) for asset in self._assets.values())
+                for encoding in ("gzip", "br") if encoding == "gzip" or brotli is not None
+            },
+            "views": self.views,
+            "brotli": brotli is not None,
+        }
+
+
+def create_static_assets(directory: str | Path):
+    """StaticAssets for the SPA, or None with STATIC_PIPELINE=0 (files served straight from disk)"""
+    if os.getenv("STATIC_PIPELINE", "1").lower() not in ("1", "true", "yes"):
+        return None
+    views = os.getenv("STATIC_VIEWS", "preload").lower()
+    if views not in ("preload", "bundle", "none"):
+        logger.warning(f"⚠️ STATIC_VIEWS '{views}' desconocido; usando 'preload'")
+        views = "preload"
+    return StaticAssets(directory, views=views)
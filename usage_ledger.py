@@ -0,0 +1,317 @@
+import atexit
+import bisect
+import copy
+import json
+import logging
+import os
+import tempfile
+import threading
+from pathlib import Path
+
+try:
+    import fcntl  # Solo POSIX: en Windows no se comprueba que el fichero lo use un único proceso
+except ImportError:
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_USER_KEYS = {
+    "supersecretkey": {"count": 0, "max_uses": 100, "user_id": "user1", "description": "Usuario principal"},
+    "anothersecretkey": {"count": 0, "max_uses": 50, "user_id": "user2", "description": "Usuario secundario"}
+}
+
+
+def usage_percentage(data: dict) -> float:
+    """Share of a key's uses already consumed (100 for a key without uses)"""
+    if not data["max_uses"]:
+        return 100.0
+    return round(data["count"] / data["max_uses"] * 100, 1)
+
+
+def empty_totals() -> dict:
+    return {"keys": 0, "uses": 0, "max_uses": 0, "exhausted": 0}
+
+
+def with_usage_percentage(totals: dict) -> dict:
+    return {**totals, "usage_percentage": round(totals["uses"] / totals["max_uses"] * 100, 1) if totals["max_uses"] else 0}
+
+
+class UsageLedger:
+    """User keys and usage counters kept in memory and written behind to user_keys.json.
+
+    Quota checks and increments happen atomically under a lock through
+    reserve()/refund(). The file is rewritten (temp file + rename) at most every
+    `flush_interval` seconds, or sooner once `flush_every` changes are pending,
+    and always on close(). Totals over all keys are adjusted on every change,
+    and a sorted list of keys serves paginated listings.
+
+    Counts live in this process's memory and every write replaces the whole
+    file, so only one server process may use it: start() takes an exclusive
+    lock on `<file>.lock` and fails if another process holds it. Deployments
+    with several workers must use the SQLite key store (key_store.py).
+    """
+
+    # True when calls do disk I/O and should run in a worker thread, not on the event loop
+    blocking = False
+
+    def __init__(self, path: str | Path, flush_interval: float = 5.0, flush_every: int = 50):
+        self.path = Path(path)
+        self.flush_interval = flush_interval
+        self.flush_every = flush_every
+        self._lock = threading.Lock()
+        self._write_lock = threading.Lock()
+        self._keys = {}
+        self._order = []  # Claves ordenadas, para paginar por cursor
+        self._totals = empty_totals()
+        self._file_counts = {}  # Contador de cada clave en el fichero según la última lectura o escritura
+        self._pending = 0
+        self._writes = 0
+        self._reserved = 0
+        self._rejected = 0
+        self._refunded = 0
+        self._wakeup = threading.Event()
+        self._stopped = threading.Event()
+        self._flusher = None
+        self._lock_file = None
+
+    def load(self):
+        """Load user keys from the JSON file, creating it with defaults if missing"""
+        try:
+            if self.path.exists():
+                with open(self.path, 'r', encoding='utf-8') as f:
+                    keys_data = json.load(f)
+                logger.info(f"✅ User keys loaded from {self.path}")
+                logger.info(f"📊 Found {len(keys_data)} user keys configured")
+            else:
+                logger.warning(f"⚠️ User keys file not found: {self.path}")
+                logger.info("📝 Creating default user keys file...")
+                keys_data = copy.deepcopy(DEFAULT_USER_KEYS)
+        except json.JSONDecodeError as e:
+            logger.error(f"❌ Error parsing user keys JSON: {e}")
+            keys_data = {}
+        except Exception as e:
+            logger.error(f"❌ Error loading user keys: {e}")
+            keys_data = {}
+        for data in keys_data.values():
+            data.setdefault("count", 0)
+            data.setdefault("max_uses", 0)
+        with self._lock:
+            self._keys = keys_data
+            self._order = sorted(keys_data)
+            self._totals = empty_totals()
+            for data in keys_data.values():
+                self._account(data, 1)
+            self._file_counts = {key: data["count"] for key, data in keys_data.items()}
+            self._pending = 0
+        if not self.path.exists() and keys_data:
+            self.flush(force=True)
+        return self.snapshot()
+
+    def reload(self):
+        """Apply the changes made to the keys file since it was last read or written.
+
+        Only added, removed and edited entries are touched, and uses reserved
+        since the last write are kept: a count edited in the file is applied as
+        a delta on the in-memory count. Returns the keys added, updated and removed.
+        """
+        changes = {"added": [], "updated": [], "removed": []}
+        # Sin escrituras mientras tanto, para que _file_counts corresponda al fichero leído
+        with self._write_lock:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                keys_data = json.load(f)
+            with self._lock:
+                for key in [key for key in self._keys if key not in keys_data]:
+                    self._account(self._keys.pop(key), -1)
+                    del self._order[bisect.bisect_left(self._order, key)]
+                    self._file_counts.pop(key, None)
+                    changes["removed"].append(key)
+                for key, data in keys_data.items():
+                    data.setdefault("count", 0)
+                    data.setdefault("max_uses", 0)
+                    current = self._keys.get(key)
+                    if current is None:
+                        self._keys[key] = data
+                        self._account(data, 1)
+                        bisect.insort(self._order, key)
+                        self._file_counts[key] = data["count"]
+                        changes["added"].append(key)
+                        continue
+                    delta = data["count"] - self._file_counts.get(key, data["count"])
+                    definition = {field: value for field, value in data.items() if field != "count"}
+                    if not delta and definition == {field: value for field, value in current.items() if field != "count"}:
+                        continue
+                    self._account(current, -1)
+                    count = max(0, current["count"] + delta)
+                    current.clear()
+                    current.update(definition, count=count)
+                    self._account(current, 1)
+                    self._file_counts[key] = data["count"]
+                    changes["updated"].append(key)
+        logger.info(f"🔄 User keys reloaded from {self.path}: {len(changes['added'])} added, "
+                    f"{len(changes['updated'])} updated, {len(changes['removed'])} removed")
+        return changes
+
+    def start(self):
+        """Claim the keys file for this process and start the background flusher thread"""
+        if self._flusher is None:
+            self._claim_file()
+            self._flusher = threading.Thread(target=self._flush_loop, name="usage-ledger", daemon=True)
+            self._flusher.start()
+            atexit.register(self.close)
+
+    def close(self):
+        """Stop the flusher and write any pending counts"""
+        self._stopped.set()
+        self._wakeup.set()
+        if self._flusher is not None and self._flusher is not threading.current_thread():
+            self._flusher.join(timeout=10)
+        self.flush()
+        if self._lock_file is not None:
+            self._lock_file.close()  # Libera el bloqueo
+            self._lock_file = None
+
+    def _claim_file(self):
+        if fcntl is None:
+            return
+        lock_file = open(self.path.with_name(self.path.name + ".lock"), "a")
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            lock_file.close()
+            raise RuntimeError(
+                f"{self.path} ya lo está usando otro proceso del servidor. Con el fichero JSON los contadores viven "
+                "en la memoria de cada proceso y se sobrescribirían entre sí: usa un solo worker o USER_KEYS_BACKEND=sqlite."
+            )
+        self._lock_file = lock_file
+
+    def __contains__(self, key):
+        with self._lock:
+            return key in self._keys
+
+    def __len__(self):
+        with self._lock:
+            return len(self._keys)
+
+    def get(self, key: str):
+        """Copy of a key's entry, or None"""
+        with self._lock:
+            data = self._keys.get(key)
+            return dict(data) if data is not None else None
+
+    def snapshot(self):
+        """Copy of every entry, safe to iterate while counts keep changing"""
+        with self._lock:
+            return {key: dict(data) for key, data in self._keys.items()}
+
+    def page(self, cursor: str | None = None, limit: int = 100, min_usage: float | None = None,
+             user_id_prefix: str | None = None):
+        """Entries after `cursor` in key order that pass the filters, as ([(key, entry)], next_cursor)"""
+        items = []
+        with self._lock:
+            start = bisect.bisect_right(self._order, cursor) if cursor is not None else 0
+            for index in range(start, len(self._order)):
+                key = self._order[index]
+                data = self._keys[key]
+                if user_id_prefix and not str(data.get("user_id", "")).startswith(user_id_prefix):
+                    continue
+                if min_usage is not None and usage_percentage(data) < min_usage:
+                    continue
+                items.append((key, dict(data)))
+                if len(items) >= limit:
+                    break
+        return items, items[-1][0] if len(items) >= limit else None
+
+    def totals(self):
+        """Keys, uses and exhausted keys over the whole store, kept up to date on every change"""
+        with self._lock:
+            return with_usage_percentage(self._totals)
+
+    def _account(self, data: dict, sign: int):
+        # Suma (sign=1) o resta (sign=-1) la contribución de una entrada a los totales
+        self._totals["keys"] += sign
+        self._totals["uses"] += sign * data["count"]
+        self._totals["max_uses"] += sign * data["max_uses"]
+        self._totals["exhausted"] += sign * (data["count"] >= data["max_uses"])
+
+    def reserve(self, key: str) -> bool:
+        """Atomically consume one use if the key has any left"""
+        with self._lock:
+            data = self._keys.get(key)
+            if data is None or data["count"] >= data["max_uses"]:
+                self._rejected += 1
+                return False
+            self._reserved += 1
+            data["count"] += 1
+            self._totals["uses"] += 1
+            self._totals["exhausted"] += data["count"] == data["max_uses"]
+            self._mark_dirty()
+        return True
+
+    def refund(self, key: str):
+        """Give back a use reserved for a request that failed"""
+        with self._lock:
+            data = self._keys.get(key)
+            if data is not None and data["count"] > 0:
+                self._totals["exhausted"] -= data["count"] == data["max_uses"]
+                data["count"] -= 1
+                self._totals["uses"] -= 1
+                self._refunded += 1
+                self._mark_dirty()
+
+    def _mark_dirty(self):
+        self._pending += 1
+        if self._pending >= self.flush_every:
+            self._wakeup.set()
+
+    def _flush_loop(self):
+        while not self._stopped.is_set():
+            self._wakeup.wait(self.flush_interval)
+            self._wakeup.clear()
+            try:
+                self.flush()
+            except Exception as e:
+                logger.error(f"❌ Error saving user keys: {e}")
+
+    def flush(self, force: bool = False):
+        """Atomically rewrite the keys file if there are pending changes"""
+        with self._write_lock:
+            with self._lock:
+                if not self._pending and not force:
+                    return False
+                data = json.dumps(self._keys, indent=4, ensure_ascii=False)
+                file_counts = {key: entry["count"] for key, entry in self._keys.items()}
+                flushed = self._pending
+                self._pending = 0
+            tmp_path = None
+            try:
+                fd, tmp_path = tempfile.mkstemp(dir=self.path.parent, prefix=f".{self.path.name}.", suffix=".tmp")
+                with os.fdopen(fd, 'w', encoding='utf-8') as f:
+                    f.write(data)
+                    f.flush()
+                    os.fsync(f.fileno())
+                os.replace(tmp_path, self.path)
+            except Exception:
+                with self._lock:
+                    self._pending += flushed  # Reintentar en el siguiente ciclo
+                if tmp_path and os.path.exists(tmp_path):
+                    os.unlink(tmp_path)
+                raise
+            with self._lock:
+                self._file_counts = file_counts
+            self._writes += 1
+            logger.info(f"💾 User keys saved to {self.path} ({flushed} cambios)")
+            return True
+
+    def stats(self):
+        with self._lock:
+            return {
+                "backend": "json",
+                "keys_file": str(self.path),
+                "pending_changes": self._pending,
+                "file_writes": self._writes,
+                "flush_interval_seconds": self.flush_interval,
+                "flush_every": self.flush_every,
+                "reserved": self._reserved,
+                "rejected": self._rejected,
+                "refunded": self._refunded,
+            }